@@ -1,19 +1,49 @@
+from sh.concurrency import AdaptiveLimiter
 from sh.context import Context
+from sh.disk_space import DiskSpace
+from sh.download_queue import DOWNLOAD_ORDERS, DownloadQueue, QueuedDownload
+from sh.local_verify import find_changed_local_files, stat_local_file
+from sh.materialize import LINK_MODES, link_file, link_tree
 from sh.helpers import *
 from sh.logger import Logger
 from sh.metadata import MetadataManager, ContextError, ContextFileType
-from sh.processes import ProcessManager, ContextualFutureResult, ResultStatus
+from sh.metadata_store import (
+    BinaryMetadataStore,
+    JsonMetadataStore,
+    MetadataStoreError,
+    SqliteMetadataStore,
+)
+from sh.processes import (
+    ProcessManager,
+    ProcessType,
+    ContextualFutureResult,
+    ResultStatus,
+)
 from sh.progress import ContextProgress, ProgressManager
-from sh.rclone import RClone
-from sh.sevenzip import SevenZip
+from sh.rclone import ChunkedDownload, RClone, RCloneError, RCloneTemporaryError
+from sh.rclone_rc import RCloneRC
+from sh.retry import RetryPolicy, RetryScheduler
+from sh.native_extract import extract_native_archive
+from sh.sevenzip import SevenZip, SevenZipNotArchiveError
+from sh.stream_extract import (
+    StreamNotArchiveError,
+    extract_tar_stream,
+    get_stream_compression,
+)
 
-from concurrent.futures import as_completed, wait
+from concurrent.futures import Future, ProcessPoolExecutor, wait
+from functools import partial
 from pathlib import Path
+from queue import Empty, SimpleQueue
+from time import time
 from traceback import format_exception
+from typing import Any
 
 # import argparse
 import dataclasses
 import json
+import os
+import shutil
 import signal
 import sys
 
@@ -23,6 +53,50 @@ metadata_manager: MetadataManager | None = None
 progress_manager: ProgressManager | None = None
 process_manager: ProcessManager | None = None
 exiting: bool | None = None
+rclone_classes: dict[str, type[RClone]] | None = None  # Backend used for each source
+nested_archive_memory_limit: int = (
+    0  # Largest nested archive the native engine extracts from memory
+)
+failed_source_names: set[str] | None = None
+# Skipped files whose local outputs failed verification, with the archive members among them, to be processed again
+failed_verifications: dict[Path, set[Path]] | None = None
+dedup_link_mode: str | None = None  # None if identical content is not deduplicated
+# Context first processed in this run for each remote hash, and files with the same hash waiting for it to finish
+run_hash_index: dict[str, Context] | None = None
+waiting_duplicates: dict[Path, list[tuple[str, tuple[str, str, str, str]]]] | None = (
+    None
+)
+download_queue: DownloadQueue | None = (
+    None  # Downloads waiting for a free download worker of their remote
+)
+retry_scheduler: RetryScheduler | None = (
+    None  # Downloads waiting to be retried after temporary errors
+)
+
+LISTING_POLL_SECONDS: float = (
+    0.2  # How often listed files are dispatched while listings are running
+)
+LISTING_DISPATCH_BATCH_SIZE: int = (
+    1000  # Listed files dispatched between checks for completed futures
+)
+CHUNKED_DOWNLOAD_CHUNK_SIZE: int = (
+    128 * 1024 * 1024  # Default chunk size for remotes with a chunked_download_cutoff
+)
+CHUNKED_DOWNLOAD_STREAMS: int = (
+    4  # Default number of chunks fetched at once for remotes with a chunked_download_cutoff
+)
+DOWNLOAD_BATCH_SIZE: int = (
+    500  # Default number of files per rclone copy for remotes in the batch download_mode
+)
+MAX_RETRIES_PER_FILE: int = (
+    3  # Default number of times a download is retried after temporary errors
+)
+RETRY_BUDGET: int = 100  # Default number of retries for all files of a remote in a run
+RETRY_BASE_DELAY_SECONDS: float = 5.0  # Default delay before the first retry
+RETRY_MAX_DELAY_SECONDS: float = 300.0  # Default cap on the delay between retries
+INCREMENTAL_MAX_AGE_SLACK_SECONDS: int = (
+    3600  # Added to --max-age to allow for clock skew and modtimes set late by uploads
+)
 
 
 def main(arguments: list[str]) -> None:
@@ -91,6 +165,40 @@ def main(arguments: list[str]) -> None:
         config["sources"],
     )
 
+    global rclone_classes
+    rclone_classes = dict[str, type[RClone]]()
+    for source_name, source_config in config["sources"].items():
+        rclone_backend = (
+            config["remote_configs"]
+            .get(source_config["remote_name"], {})
+            .get("backend", "subprocess")
+        )
+        match rclone_backend:
+            case "subprocess":
+                rclone_classes[source_name] = RClone
+            case "rcd":
+                rclone_classes[source_name] = RCloneRC
+            case _:
+                print(
+                    f'ERROR: Unknown backend for remote_name: {source_config["remote_name"]}: {rclone_backend}'
+                )
+                sys.exit(1)
+    if RCloneRC in rclone_classes.values():
+        try:
+            RCloneRC.configure(
+                "file_operator",
+                rclone_path,
+                destination_root_dir,
+                rclone_config_path,
+                config["sources"],
+                config["settings"].get("rclone_rc_url"),
+            )
+        except Exception as error:
+            print("ERROR: Could not start rclone rcd")
+            print(format_exception(None, error, error.__traceback__))
+            sys.exit(1)
+        logger.set_stats_callback(RCloneRC.get_stats_summary)
+
     sevenzip_path = None
     try:
         sevenzip_path = Path(config["settings"]["7zip_path"])
@@ -99,15 +207,47 @@ def main(arguments: list[str]) -> None:
     except KeyError:
         sevenzip_path = cwd / "7z.exe"
 
-    SevenZip.configure("file_operator", sevenzip_path, destination_root_dir)
+    extract_mode = config["settings"].get("extract_mode", "test_first")
+    if extract_mode not in ("test_first", "single_pass"):
+        print(f"ERROR: Unknown extract_mode: {extract_mode}")
+        sys.exit(1)
+    SevenZip.configure(
+        "file_operator",
+        sevenzip_path,
+        destination_root_dir,
+        extract_mode == "test_first",
+    )
+
+    disk_space_headroom = config["settings"].get("disk_space_headroom_bytes", 0)
+    if not isinstance(disk_space_headroom, int) or disk_space_headroom < 0:
+        print(f"ERROR: Invalid disk_space_headroom_bytes: {disk_space_headroom}")
+        sys.exit(1)
+    DiskSpace.configure(destination_root_dir, disk_space_headroom)
 
     MetadataManager.configure("metadata")
     global metadata_manager
     try:
+        metadata_backend = config["settings"].get("metadata_backend", "json")
+        match metadata_backend:
+            case "json":
+                metadata_store = JsonMetadataStore(cwd / "metadata.json", True)
+            case "sqlite":
+                metadata_store = SqliteMetadataStore(
+                    cwd / "metadata.sqlite3", cwd / "metadata.json"
+                )
+            case "binary":
+                metadata_store = BinaryMetadataStore(
+                    cwd / "metadata.bin", cwd / "metadata.json"
+                )
+            case _:
+                raise MetadataStoreError(
+                    f"Unknown metadata_backend: {safe_str(metadata_backend)}"
+                )
         metadata_manager = MetadataManager(
-            cwd / "metadata.json",
+            metadata_store,
             config["settings"]["metadata_flush_loop_seconds"],
-            True,
+            config["settings"].get("metadata_flush_change_threshold"),
+            config["settings"].get("metadata_flush_bytes_threshold"),
         )
     except Exception as error:
         print("ERROR: Could not setup metadata manager")
@@ -119,6 +259,7 @@ def main(arguments: list[str]) -> None:
 
     remote_names = set([source["remote_name"] for source in config["sources"].values()])
     download_workers_per_remote = dict[str, int]()
+    list_workers_per_remote = dict[str, int]()
     source_remote_name_map = dict[str, str]()
     for remote_name in remote_names:
         try:
@@ -130,6 +271,9 @@ def main(arguments: list[str]) -> None:
                 f"ERROR: max_concurrent_downloads not configured for remote_name: {remote_name}"
             )
             sys.exit(1)
+        list_workers_per_remote[remote_name] = config["remote_configs"][
+            remote_name
+        ].get("max_concurrent_listings", 1)
     for source_name, source_config in config["sources"].items():
         remote_name = source_config["remote_name"]
         if remote_name not in download_workers_per_remote:
@@ -142,6 +286,88 @@ def main(arguments: list[str]) -> None:
                 remote_name
             ]["max_concurrent_downloads"]
         source_remote_name_map[source_name] = remote_name
+        remote_config = config["remote_configs"][remote_name]
+        if remote_config.get("download_mode", "single") not in ("single", "batch"):
+            print(
+                f'ERROR: Unknown download_mode for remote_name: {remote_name}: {remote_config["download_mode"]}'
+            )
+            sys.exit(1)
+        if source_config.get("listing_mode", "full") not in ("full", "incremental"):
+            print(
+                f'ERROR: Unknown listing_mode for source_name: {source_name}: {source_config["listing_mode"]}'
+            )
+            sys.exit(1)
+        if source_config.get("download_order", "listed") not in DOWNLOAD_ORDERS:
+            print(
+                f'ERROR: Unknown download_order for source_name: {source_name}: {source_config["download_order"]}'
+            )
+            sys.exit(1)
+
+    download_limiters_per_remote = dict[str, AdaptiveLimiter]()
+    for remote_name, download_workers in download_workers_per_remote.items():
+        remote_config = config["remote_configs"][remote_name]
+        if not remote_config.get("adaptive_concurrent_downloads", False):
+            continue
+        min_downloads = remote_config.get("min_concurrent_downloads", 1)
+        if (
+            not isinstance(min_downloads, int)
+            or min_downloads < 1
+            or min_downloads > download_workers
+        ):
+            print(
+                f"ERROR: Invalid min_concurrent_downloads for remote_name: {remote_name}: {min_downloads}"
+            )
+            sys.exit(1)
+        # Download pools keep max_concurrent_downloads workers, of which the limiter lets a varying number run
+        download_limiters_per_remote[remote_name] = AdaptiveLimiter(
+            remote_name,
+            min_downloads,
+            download_workers,
+            remote_config.get("initial_concurrent_downloads", min_downloads),
+            log_download_limit_change,
+        )
+
+    global download_queue
+    download_queue = DownloadQueue(
+        {
+            source_name: source_config.get("download_order", "listed")
+            for source_name, source_config in config["sources"].items()
+        },
+        source_remote_name_map,
+    )
+
+    global retry_scheduler
+    retry_policies_per_remote = dict[str, RetryPolicy]()
+    for remote_name in download_workers_per_remote.keys():
+        remote_config = config["remote_configs"][remote_name]
+        retry_policies_per_remote[remote_name] = RetryPolicy(
+            remote_config.get("max_retries_per_file", MAX_RETRIES_PER_FILE),
+            remote_config.get("retry_budget", RETRY_BUDGET),
+            remote_config.get("retry_base_delay_seconds", RETRY_BASE_DELAY_SECONDS),
+            remote_config.get("retry_max_delay_seconds", RETRY_MAX_DELAY_SECONDS),
+        )
+    retry_scheduler = RetryScheduler(retry_policies_per_remote)
+
+    global nested_archive_memory_limit
+    nested_archive_memory_limit = config["settings"].get(
+        "nested_archive_memory_limit_bytes", 0
+    )
+
+    verify_local_files = config["settings"].get("verify_local_files", False)
+    verify_workers = config["settings"].get("verify_workers", 4)
+    if verify_local_files and (
+        not isinstance(verify_workers, int) or verify_workers < 1
+    ):
+        print(f"ERROR: Invalid verify_workers: {verify_workers}")
+        sys.exit(1)
+
+    global dedup_link_mode
+    dedup_link_mode = config["settings"].get("dedup_link_mode", "none")
+    if dedup_link_mode not in LINK_MODES + ("none",):
+        print(f"ERROR: Unknown dedup_link_mode: {dedup_link_mode}")
+        sys.exit(1)
+    if dedup_link_mode == "none":
+        dedup_link_mode = None
 
     global process_manager
     process_manager = ProcessManager(
@@ -149,6 +375,10 @@ def main(arguments: list[str]) -> None:
         config["settings"]["max_concurrent_extracts"],
         config["settings"]["max_concurrent_deletes"],
         source_remote_name_map,
+        list_workers_per_remote,
+        config["settings"].get("native_extract_workers", 0),
+        verify_workers if verify_local_files else 0,
+        download_limiters_per_remote,
     )
 
     global exiting
@@ -160,206 +390,763 @@ def main(arguments: list[str]) -> None:
     signal.signal(signal.SIGINT, exit_signal_handler)
 
     try:
-        print("INFO: Fetching file lists from sources")
-        rclone = RClone()
-        remote_files = dict()
-        remote_file_count = 0
-        for source_name in config["sources"].keys():
-            if exiting:
-                break
-            rclone.set_context_source_name(source_name)
-            remote_files[source_name] = []
-            for file_info in rclone.fetch_file_info_list():
-                if exiting:
-                    break
-                remote_file_count += 1
-                remote_files[source_name].append(file_info)
-            remote_files[source_name].sort(key=lambda item: item[0])
-        del rclone
-
-        remote_files = dict(sorted(remote_files.items()))
         print("INFO: Starting processes")
         metadata_manager.start_flush_metadata_process()
-        contexts_in_progress = dict()
-        for source_name, file_info_list in remote_files.items():
+        contexts_in_progress = dict[Path, ContextProgress]()
+        logger.set_total_files(0)
+        logger.start_drawing_progress()
+
+        print("INFO: Fetching file lists from sources and processing files")
+        global failed_source_names
+        failed_source_names = set[str]()
+        sync_state_path = cwd / "sync_state.json"
+        last_successful_syncs = load_last_successful_syncs(sync_state_path)
+        listing_start_times = dict[str, float]()
+        source_remote_configs = {
+            source_name: config["remote_configs"][remote_name]
+            for source_name, remote_name in source_remote_name_map.items()
+        }
+        listed_files = SimpleQueue[tuple[str, tuple[str, str, str, str]]]()
+        listing_futures = dict[Future, str]()
+        verify_futures = set[Future]() if verify_local_files else None
+        global failed_verifications
+        failed_verifications = dict[Path, set[Path]]()
+        global run_hash_index
+        global waiting_duplicates
+        run_hash_index = dict[str, Context]()
+        waiting_duplicates = dict[Path, list[tuple[str, tuple[str, str, str, str]]]]()
+        for source_name, source_config in config["sources"].items():
+            max_age = None
+            if (
+                source_config.get("incremental_max_age", False)
+                and source_name in last_successful_syncs
+            ):
+                max_age = f"{int(time() - last_successful_syncs[source_name]) + INCREMENTAL_MAX_AGE_SLACK_SECONDS}s"
+            listing_start_times[source_name] = time()
+            listing_future = process_manager.submit_list_task(
+                source_name,
+                list_remote_files,
+                source_name,
+                rclone_classes[source_name](),
+                listed_files,
+                source_config.get("listing_mode", "full") == "incremental",
+                max_age,
+            )
+            listing_futures[listing_future] = source_name
+        while (
+            len(listing_futures) > 0
+            or not listed_files.empty()
+            or process_manager.get_future_count() > 0
+            or (verify_futures is not None and len(verify_futures) > 0)
+            or len(retry_scheduler) > 0
+            or len(download_queue) > 0
+        ):
             if exiting:
                 break
-            for file_info in file_info_list:
-                if exiting:
-                    break
-                remote_file_path = Path(file_info[0])
-                file_size = file_info[1]
-                file_hash = file_info[2]
-                metadata_manager.set_context_source_name(source_name)
-                metadata_manager.set_context_file_path(remote_file_path)
-
-                if (
-                    metadata_manager.metadata_exists()
-                    and not metadata_manager.error_exists()
-                    and metadata_manager.get_remote_hash() == file_hash
-                ):
-                    # If the file was previously successfully processed and the remote hash hasn't changed, then skip the file
-                    remote_file_count -= 1
-                else:
-                    context = metadata_manager.get_context()
+            # Checked before draining the queue so that no listed file is missed
+            for listing_future in [
+                future for future in listing_futures.keys() if future.done()
+            ]:
+                source_name = listing_futures.pop(listing_future)
+                if listing_future.exception() is not None:
+                    failed_source_names.add(source_name)
+                    log_error(
+                        f"ERROR: Failed to list files for source_name: {source_name}",
+                        listing_future.exception(),
+                    )
+            if verify_futures is not None:
+                for verify_future in [
+                    future for future in verify_futures if future.done()
+                ]:
+                    verify_futures.discard(verify_future)
+                    if verify_future.exception() is not None:
+                        log_error(
+                            "ERROR: Failed to verify local files",
+                            verify_future.exception(),
+                        )
+                        continue
+                    # Files with changed local outputs are listed again to be processed like changed remote files
+                    for (
+                        source_name,
+                        file_info,
+                        changed_file_paths,
+                    ) in verify_future.result():
+                        failed_verifications[Path(source_name, file_info[0])] = (
+                            changed_file_paths
+                        )
+                        listed_files.put((source_name, file_info))
+            queue_due_retries(contexts_in_progress)
+            dispatch_listed_files(
+                listed_files,
+                contexts_in_progress,
+                source_remote_configs,
+                config["settings"].get("stream_extract", False),
+                verify_futures,
+            )
+            submit_queued_downloads(contexts_in_progress, config["remote_configs"])
+            timeout = (
+                LISTING_POLL_SECONDS
+                if len(listing_futures) > 0
+                or (verify_futures is not None and len(verify_futures) > 0)
+                else 10
+            )
+            seconds_until_retry = retry_scheduler.get_seconds_until_next_due()
+            if seconds_until_retry is not None:
+                timeout = min(timeout, seconds_until_retry)
+            try:
+                future = process_manager.get_completed_future(
+                    timeout=timeout
+                )  # On TimeoutError, simply fall back to while loop for regular exiting check
+            except TimeoutError:
+                continue
+            process_completed_future(future, contexts_in_progress, listed_files)
+        print("INFO: Finished processing results")
+        if not exiting:
+            # Sources are only recorded once every listed file was processed, so --max-age never skips a failed file
+            for source_name in config["sources"].keys():
+                if source_name not in failed_source_names:
+                    last_successful_syncs[source_name] = listing_start_times[
+                        source_name
+                    ]
+            save_last_successful_syncs(sync_state_path, last_successful_syncs)
+    except Exception as error:
+        log_error("ERROR: Caught exception", error)
+    finally:
+        process_manager.submit_exit_task(stop_processes)
+        print("INFO: Main thread waiting for exit process")
+        wait([process_manager.get_exit_future()])
+        print(
+            f"INFO: {progress_manager.get_processed_files()}/{progress_manager.get_total_files()} files have been successfully processed"
+        )
 
-                    # If file was previously an archive, clear any metadata for previous members
-                    if metadata_manager.metadata_exists():
-                        metadata_manager.delete_archive_members_metadata()
 
-                    metadata_manager.initialize_metadata()
-                    metadata_manager.set_remote_hash(file_hash)
-                    metadata_manager.set_error_code_status(
-                        ContextError.CANCELLED, True
-                    )  # Assume cancelled until proven otherwise
-                    context_path = context.as_path(include_source=True)
-                    contexts_in_progress[context_path] = ContextProgress(
-                        context,
-                        metadata_manager.get_metadata(),
-                        set(),
-                        [],
-                        {remote_file_path},
-                        False,
-                    )
+def load_last_successful_syncs(sync_state_path: Path) -> dict[str, float]:
+    if not sync_state_path.is_file():
+        return dict[str, float]()
+    with open(sync_state_path, "r") as sync_state_file:
+        return dict[str, float](json.load(sync_state_file)["last_successful_syncs"])
 
-                    thread_rclone = RClone()
-                    thread_sevenzip = SevenZip()
-                    download_file_future = process_manager.submit_download_task(
-                        context,
-                        download_file,
-                        context,
-                        thread_rclone,
-                        thread_sevenzip,
+
+def save_last_successful_syncs(
+    sync_state_path: Path, last_successful_syncs: dict[str, float]
+) -> None:
+    tmp_path = sync_state_path.with_name(sync_state_path.name + ".tmp")
+    with open(tmp_path, "w") as sync_state_file:
+        json.dump({"last_successful_syncs": last_successful_syncs}, sync_state_file)
+    os.replace(tmp_path, sync_state_path)
+
+
+def list_remote_files(
+    source_name: str,
+    rclone: RClone,
+    listed_files: SimpleQueue[tuple[str, tuple[str, str, str, str]]],
+    incremental: bool = False,
+    max_age: str | None = None,
+) -> None:
+    global metadata_manager
+    global exiting
+    if exiting:
+        return
+    rclone.set_context_source_name(source_name)
+    if incremental:
+        file_infos = rclone.iter_changed_file_info(
+            lambda file_path, file_size, file_modtime: metadata_manager.is_remote_file_unchanged(
+                Path(source_name, file_path), int(file_size), file_modtime
+            ),
+            max_age,
+        )
+    else:
+        file_infos = rclone.iter_file_info()
+    for file_info in file_infos:
+        if exiting:
+            break
+        listed_files.put((source_name, file_info))
+
+
+def dispatch_listed_files(
+    listed_files: SimpleQueue[tuple[str, tuple[str, str, str, str]]],
+    contexts_in_progress: dict[Path, ContextProgress],
+    source_remote_configs: dict[str, dict[str, Any]],
+    stream_extract: bool = False,
+    verify_futures: set[Future] | None = None,
+) -> None:
+    # Local outputs of skipped files are verified if verify_futures is set, which collects the verification tasks
+    global logger
+    global metadata_manager
+    global process_manager
+    global progress_manager
+    global exiting
+    global rclone_classes
+    global failed_verifications
+    global dedup_link_mode
+    global run_hash_index
+    global waiting_duplicates
+    global download_queue
+    dispatched_files = 0
+    verify_candidates = list[
+        tuple[str, tuple[str, str, str, str], dict[Path, tuple[int, int, int]]]
+    ]()
+    while dispatched_files < LISTING_DISPATCH_BATCH_SIZE:
+        if exiting:
+            break
+        try:
+            source_name, file_info = listed_files.get_nowait()
+        except Empty:
+            break
+        dispatched_files += 1
+        remote_file_path = Path(file_info[0])
+        file_size = int(file_info[1])
+        file_hash = file_info[2]
+        file_modtime = file_info[3]
+        metadata_manager.set_context_source_name(source_name)
+        metadata_manager.set_context_file_path(remote_file_path)
+
+        changed_file_paths = failed_verifications.pop(
+            Path(source_name, remote_file_path), None
+        )
+        if (
+            changed_file_paths is None
+            and metadata_manager.metadata_exists()
+            and not metadata_manager.error_exists()
+            and metadata_manager.get_remote_hash() == file_hash
+        ):
+            # If the file was previously successfully processed and the remote hash hasn't changed, then skip the file
+            # Size and modtime are still refreshed so the next incremental listing doesn't request the hash again
+            if metadata_manager.get_remote_size() != file_size:
+                metadata_manager.set_remote_size(file_size)
+            if metadata_manager.get_remote_modtime() != file_modtime:
+                metadata_manager.set_remote_modtime(file_modtime)
+            if verify_futures is not None:
+                if metadata_manager.is_archive():
+                    expected_local_stats = (
+                        metadata_manager.get_archive_member_local_stats()
+                    )
+                elif metadata_manager.get_local_stat() is not None:
+                    expected_local_stats = {
+                        remote_file_path: metadata_manager.get_local_stat()
+                    }
+                else:
+                    expected_local_stats = dict[Path, tuple[int, int, int]]()
+                if len(expected_local_stats) > 0:
+                    verify_candidates.append(
+                        (source_name, file_info, expected_local_stats)
                     )
-                    contexts_in_progress[context_path].futures.add(download_file_future)
+            continue
 
-        metadata_manager.free_context()
-        progress_manager.set_total_files(remote_file_count)
-        logger.set_total_files(remote_file_count)
-        logger.start_drawing_progress()
+        context = metadata_manager.get_context()
+        context_path = context.as_path(include_source=True)
+        known_file_type = metadata_manager.get_file_type_for_remote_hash(file_hash)
 
-        print("INFO: Waiting for processes")
-        while len(process_manager.get_futures()) > 0:
-            if exiting:
+        primary_context = None
+        primary_member_info = None
+        if dedup_link_mode is not None and file_hash != "":
+            primary_context = run_hash_index.get(file_hash)
+            if primary_context is None:
+                run_hash_index[file_hash] = context
+                waiting_duplicates[context_path] = []
+            elif primary_context.as_path(include_source=True) in waiting_duplicates:
+                # Listed again once the identical content has been processed, and only then counted
+                waiting_duplicates[primary_context.as_path(include_source=True)].append(
+                    (source_name, file_info)
+                )
+                continue
+            else:
+                metadata_manager.set_context(primary_context)
+                if metadata_manager.is_archive():
+                    primary_member_info = metadata_manager.get_archive_member_info()
+                metadata_manager.set_context(context)
+
+        # If file was previously an archive, clear any metadata for previous members
+        previous_member_info = None
+        if metadata_manager.metadata_exists():
+            if metadata_manager.is_archive():
+                # Kept until extraction so that unchanged members are not extracted again
+                previous_member_info = metadata_manager.get_archive_member_info()
+                # Members whose local output failed verification are extracted again as if they had changed
+                for changed_file_path in changed_file_paths or ():
+                    previous_member_info.pop(changed_file_path, None)
+            metadata_manager.delete_archive_members_metadata()
+
+        metadata_manager.initialize_metadata()
+        metadata_manager.set_remote_hash(file_hash)
+        metadata_manager.set_remote_size(file_size)
+        metadata_manager.set_remote_modtime(file_modtime)
+        metadata_manager.set_error_code_status(
+            ContextError.CANCELLED, True
+        )  # Assume cancelled until proven otherwise
+        contexts_in_progress[context_path] = ContextProgress(
+            context,
+            metadata_manager.get_metadata(),
+            set(),
+            [],
+            {remote_file_path},
+            False,
+            previous_member_info,
+        )
+
+        remote_config = source_remote_configs[source_name]
+        chunked_download = None
+        if remote_config.get("chunked_download_cutoff") and file_size >= int(
+            remote_config["chunked_download_cutoff"]
+        ):
+            # Large files are fetched in resumable chunks, even in the batch download_mode or if they could be streamed
+            chunked_download = ChunkedDownload(
+                file_size,
+                file_hash,
+                remote_config.get(
+                    "chunked_download_chunk_size", CHUNKED_DOWNLOAD_CHUNK_SIZE
+                ),
+                remote_config.get("chunked_download_streams", CHUNKED_DOWNLOAD_STREAMS),
+            )
+        stream_compression = (
+            get_stream_compression(remote_file_path)
+            if stream_extract
+            and known_file_type != ContextFileType.REGULAR
+            and chunked_download is None
+            else None
+        )
+        if primary_context is not None:
+            materialize_file_future = process_manager.submit_extract_task(
+                context,
+                materialize_duplicate_file,
+                context,
+                primary_context,
+                SevenZip(),
+                dedup_link_mode,
+                primary_member_info,
+            )
+            contexts_in_progress[context_path].futures.add(materialize_file_future)
+        elif stream_compression is not None:
+            contexts_in_progress[context_path].queued_download = QueuedDownload(
+                context,
+                file_size,
+                known_file_type,
+                partial(
+                    submit_stream_extract,
+                    context,
+                    stream_compression,
+                    file_size,
+                    previous_member_info,
+                ),
+            )
+            download_queue.push(contexts_in_progress[context_path].queued_download)
+        else:
+            contexts_in_progress[context_path].queued_download = QueuedDownload(
+                context,
+                file_size,
+                known_file_type,
+                partial(
+                    submit_file_download,
+                    context,
+                    known_file_type,
+                    file_size,
+                    chunked_download,
+                ),
+                remote_config.get("download_mode") == "batch"
+                and chunked_download is None,
+            )
+            download_queue.push(contexts_in_progress[context_path].queued_download)
+        progress_manager.increment_total_files()
+        logger.set_total_files(progress_manager.get_total_files())
+        logger.add_total_bytes(file_size)
+    metadata_manager.free_context()
+
+    if len(verify_candidates) > 0:
+        try:
+            verify_futures.add(
+                process_manager.submit_verify_task(
+                    verify_local_files,
+                    SevenZip().get_destination_root_dir(),
+                    verify_candidates,
+                )
+            )
+        except RuntimeError:
+            pass  # Ignore thread pool shutting down
+
+
+def submit_queued_downloads(
+    contexts_in_progress: dict[Path, ContextProgress],
+    remote_configs: dict[str, dict[str, Any]],
+) -> None:
+    # Queued downloads are only submitted while their remote has a free worker, so that the download_order of each
+    # source decides what runs next rather than the order files were listed in
+    global process_manager
+    global download_queue
+    global rclone_classes
+    for remote_name in download_queue.get_remote_names():
+        remote_config = remote_configs[remote_name]
+        while process_manager.get_download_task_count(
+            remote_name
+        ) < process_manager.get_download_capacity(remote_name):
+            queued_downloads = download_queue.pop_for_remote(
+                remote_name,
+                remote_config.get("download_batch_size", DOWNLOAD_BATCH_SIZE),
+            )
+            if len(queued_downloads) == 0:
                 break
             try:
-                # Process only the first future, then fall back to while loop and get a fresh iterator that includes new futures
-                for future in as_completed(
-                    process_manager.get_futures(), timeout=10
-                ):  # On TimeoutError, catch it and simply fall back to while loop for regular exiting check
-                    root_context = process_manager.get_context_for_future(future)
-                    process_manager.remove_future(future)
-                    metadata_manager.set_context(root_context)
-                    root_context_path = metadata_manager.context.as_path(
-                        include_source=True
+                if queued_downloads[0].batchable:
+                    batch_size_bytes = sum(
+                        queued_download.file_size
+                        for queued_download in queued_downloads
                     )
-                    contexts_in_progress[root_context_path].futures.discard(future)
-                    contexts_in_progress[root_context_path].files_to_process.discard(
-                        root_context.file_path
+                    context_futures = process_manager.submit_batch_download_task(
+                        [
+                            queued_download.context
+                            for queued_download in queued_downloads
+                        ],
+                        download_files,
+                        rclone_classes[queued_downloads[0].context.source_name](),
+                        SevenZip(),
+                        remote_config.get("transfers"),
+                        remote_config.get("checkers"),
+                        {
+                            queued_download.context: queued_download.known_file_type
+                            for queued_download in queued_downloads
+                        },
+                        batch_size_bytes,
+                        transfer_bytes=batch_size_bytes,
                     )
-                    if future.cancelled():
-                        contexts_in_progress[root_context_path].cancelled = (
-                            True  # Consider the status of a root archive cancelled if any tasks for its members are cancelled
+                else:
+                    context_futures = {
+                        queued_downloads[0]
+                        .context: queued_downloads[0]
+                        .submit_download()
+                    }
+            except RuntimeError:
+                return  # Ignore thread pool shutting down
+            for context, download_file_future in context_futures.items():
+                contexts_in_progress[context.as_path(include_source=True)].futures.add(
+                    download_file_future
+                )
+
+
+def submit_file_download(
+    context: Context,
+    known_file_type: ContextFileType,
+    file_size: int,
+    chunked_download: ChunkedDownload | None = None,
+) -> Future:
+    global process_manager
+    global rclone_classes
+    return process_manager.submit_download_task(
+        context,
+        download_file,
+        context,
+        rclone_classes[context.source_name](),
+        SevenZip(),
+        known_file_type,
+        file_size,
+        chunked_download,
+        transfer_bytes=file_size,
+    )
+
+
+def submit_stream_extract(
+    context: Context,
+    compression: str,
+    file_size: int,
+    previous_member_info: dict[Path, tuple[int | None, str | None]] | None,
+) -> Future:
+    global process_manager
+    global rclone_classes
+    return process_manager.submit_download_task(
+        context,
+        stream_extract_file,
+        context,
+        rclone_classes[context.source_name](),
+        SevenZip(),
+        compression,
+        file_size,
+        previous_member_info,
+        transfer_bytes=file_size,
+    )
+
+
+def schedule_download_retry(
+    context_progress: ContextProgress, error: Exception
+) -> bool:
+    # Returns False if the failed download of a root file should not be retried
+    global process_manager
+    global retry_scheduler
+    context = context_progress.context
+    if (
+        not isinstance(error, RCloneTemporaryError)
+        or context_progress.queued_download is None
+    ):
+        return False
+    delay_seconds = retry_scheduler.schedule(
+        process_manager.get_remote_name(context.source_name),
+        context.as_path(include_source=True),
+    )
+    if delay_seconds is None:
+        return False
+    context_progress.files_to_process.add(
+        context.file_path
+    )  # Keeps the context in progress until the retry completes
+    log_error(
+        f"WARNING: Temporary error while downloading file, retrying in {delay_seconds:.1f} seconds. source_name: {context.source_name}, file_path: {context.file_path}",
+        error,
+    )
+    return True
+
+
+def queue_due_retries(contexts_in_progress: dict[Path, ContextProgress]) -> None:
+    # Retries wait for a free download worker of their remote in the order of their source, like fresh downloads
+    global download_queue
+    global retry_scheduler
+    for context_path in retry_scheduler.pop_due():
+        download_queue.push(contexts_in_progress[context_path].queued_download)
+
+
+def process_completed_future(
+    future: Future,
+    contexts_in_progress: dict[Path, ContextProgress],
+    listed_files: SimpleQueue[tuple[str, tuple[str, str, str, str]]],
+) -> None:
+    global logger
+    global metadata_manager
+    global process_manager
+    global run_hash_index
+    global waiting_duplicates
+    global nested_archive_memory_limit
+    future_context = process_manager.get_context_for_future(future)
+    future_info = process_manager.get_info_for_future(future)
+    root_context = future_info.root_context
+    process_manager.remove_future(future)
+    metadata_manager.set_context(root_context)
+    root_context_path = metadata_manager.context.as_path(include_source=True)
+    contexts_in_progress[root_context_path].futures.discard(future)
+    contexts_in_progress[root_context_path].files_to_process.discard(
+        future_context.file_path
+    )
+    if future.cancelled():
+        contexts_in_progress[root_context_path].cancelled = (
+            True  # Consider the status of a root archive cancelled if any tasks for its members are cancelled
+        )
+    else:
+        result: ContextualFutureResult
+        for result in future.result():
+            context = dataclasses.replace(result.context)  # Make a copy
+            match result.status:
+                case ResultStatus.DONE:
+                    if (
+                        future_info.process_type == ProcessType.DOWNLOAD
+                        and context == root_context
+                    ):
+                        # Recorded so the classification is reused for the same remote hash
+                        metadata_manager.set_file_type(ContextFileType.REGULAR)
+                        if result.local_stats is not None:
+                            metadata_manager.set_local_stat(
+                                result.local_stats.get(context.file_path)
+                            )
+                        contexts_in_progress[root_context_path].metadata = (
+                            metadata_manager.get_metadata()
                         )
-                    else:
-                        result: ContextualFutureResult
-                        for result in future.result():
-                            context = dataclasses.replace(root_context)  # Make a copy
-                            match result.status:
-                                case ResultStatus.DONE:
-                                    pass  # Nothing to do
-                                case ResultStatus.EXTRACT_NEEDED:
-                                    metadata_manager.set_file_type(
-                                        ContextFileType.ARCHIVE
-                                    )
-                                    contexts_in_progress[root_context_path].metadata = (
-                                        metadata_manager.get_metadata()
-                                    )
-                                    thread_sevenzip = SevenZip()
-                                    try:
-                                        extract_archive_file_future = (
-                                            process_manager.submit_extract_task(
-                                                context,
-                                                extract_archive_file,
-                                                context,
-                                                thread_sevenzip,
-                                                root_context,
-                                            )
-                                        )
-                                        contexts_in_progress[
-                                            root_context_path
-                                        ].futures.add(extract_archive_file_future)
-                                        contexts_in_progress[
-                                            root_context_path
-                                        ].files_to_process.add(context.file_path)
-                                    except RuntimeError:
-                                        pass  # Ignore thread pool shutting down
-                                case (
-                                    ResultStatus.DOWNLOAD_FAILED
-                                    | ResultStatus.EXTRACT_FAILED
-                                ):
+                    elif (
+                        future_info.process_type == ProcessType.DELETE
+                        and context == root_context
+                    ):
+                        # The remote hash still marks the archive as processed while it is no longer on disk
+                        metadata_manager.set_archive_deleted(True)
+                        contexts_in_progress[root_context_path].metadata = (
+                            metadata_manager.get_metadata()
+                        )
+                    elif future_info.process_type == ProcessType.DELETE:
+                        # Deleted nested archives are not expected to be found by verification
+                        metadata_manager.clear_archive_member_local_stat(
+                            context.file_path
+                        )
+                case ResultStatus.DELETE_FAILED:
+                    # The extracted files are kept, so other tasks for the root context carry on
+                    contexts_in_progress[root_context_path].errors.append(result.error)
+                    metadata_manager.set_error_code_status(
+                        ContextError.ARCHIVE_DELETION_FAILED, True
+                    )
+                    contexts_in_progress[root_context_path].metadata = (
+                        metadata_manager.get_metadata()
+                    )
+                case ResultStatus.EXTRACT_NEEDED:
+                    metadata_manager.set_file_type(ContextFileType.ARCHIVE)
+                    contexts_in_progress[root_context_path].metadata = (
+                        metadata_manager.get_metadata()
+                    )
+                    thread_sevenzip = SevenZip()
+                    try:
+                        extract_archive_file_future = (
+                            process_manager.submit_extract_task(
+                                context,
+                                extract_archive_file,
+                                context,
+                                thread_sevenzip,
+                                root_context,
+                                process_manager.get_native_extract_pool(),
+                                nested_archive_memory_limit,
+                                (
                                     contexts_in_progress[
                                         root_context_path
-                                    ].errors.append(result.error)
-                                    if result.status == ResultStatus.DOWNLOAD_FAILED:
-                                        metadata_manager.set_error_code_status(
-                                            ContextError.DOWNLOAD_FAILED, True
-                                        )
-                                    if result.status == ResultStatus.EXTRACT_FAILED:
-                                        metadata_manager.set_error_code_status(
-                                            ContextError.EXTRACT_FAILED, True
-                                        )
-                                    contexts_in_progress[root_context_path].metadata = (
-                                        metadata_manager.get_metadata()
-                                    )
-                                    for context_future in contexts_in_progress[
-                                        root_context_path
-                                    ].futures:  # Cancel all further processing for the root context at the first failure
-                                        context_future.cancel()
-                    if (
-                        len(contexts_in_progress[root_context_path].files_to_process)
-                        == 0
-                    ):  # True for completed or failed downloads of non-archives as well as fully processed or failed root archives
-                        metadata_manager.set_error_code_status(
-                            ContextError.CANCELLED,
-                            contexts_in_progress[root_context_path].cancelled,
+                                    ].previous_member_info
+                                    if context == root_context
+                                    else None
+                                ),
+                                root_context=root_context,
+                            )
+                        )
+                        contexts_in_progress[root_context_path].futures.add(
+                            extract_archive_file_future
+                        )
+                        contexts_in_progress[root_context_path].files_to_process.add(
+                            context.file_path
+                        )
+                    except RuntimeError:
+                        pass  # Ignore thread pool shutting down
+                case ResultStatus.DELETE_NEEDED:
+                    if context == root_context and result.member_info is not None:
+                        metadata_manager.set_archive_member_info(
+                            result.member_info, result.local_stats
+                        )
+                    thread_sevenzip = SevenZip()
+                    try:
+                        delete_archive_file_future = process_manager.submit_delete_task(
+                            context,
+                            delete_archive_file,
+                            context,
+                            thread_sevenzip,
+                            root_context=root_context,
+                        )
+                        contexts_in_progress[root_context_path].futures.add(
+                            delete_archive_file_future
+                        )
+                        contexts_in_progress[root_context_path].files_to_process.add(
+                            context.file_path
+                        )
+                    except RuntimeError:
+                        pass  # Ignore thread pool shutting down
+                case ResultStatus.MATERIALIZED:
+                    if result.member_info is None:
+                        metadata_manager.set_file_type(ContextFileType.REGULAR)
+                        metadata_manager.set_local_stat(
+                            result.local_stats.get(context.file_path)
                         )
+                    else:
+                        # The archive itself is never on disk, as only its extracted members are linked
+                        metadata_manager.set_file_type(ContextFileType.ARCHIVE)
+                        metadata_manager.set_archive_member_info(
+                            result.member_info, result.local_stats
+                        )
+                        metadata_manager.set_archive_deleted(True)
+                    contexts_in_progress[root_context_path].metadata = (
+                        metadata_manager.get_metadata()
+                    )
+                case ResultStatus.EXTRACTED:
+                    if context == root_context:
+                        # The archive was streamed, so it is never on disk
+                        metadata_manager.set_file_type(ContextFileType.ARCHIVE)
+                        metadata_manager.set_archive_member_info(
+                            result.member_info, result.local_stats
+                        )
+                        metadata_manager.set_archive_deleted(True)
                         contexts_in_progress[root_context_path].metadata = (
                             metadata_manager.get_metadata()
                         )
-                        metadata_manager.free_context()
-                        register_processed_file(contexts_in_progress[root_context_path])
-                    break  # Fall back to while loop
-            except TimeoutError:
-                pass
-        print("INFO: Finished processing results")
-    except Exception as error:
-        message = "ERROR: Caught exception"
-        logger.submit_output(message)
-        logger.write_to_log_file(
-            f"{message}\n"
-            + "\n".join(format_exception(None, error, error.__traceback__))
+                case ResultStatus.NOT_ARCHIVE:
+                    if context == root_context:
+                        metadata_manager.set_file_type(ContextFileType.REGULAR)
+                        metadata_manager.set_local_stat(
+                            result.local_stats.get(context.file_path)
+                        )
+                        contexts_in_progress[root_context_path].metadata = (
+                            metadata_manager.get_metadata()
+                        )
+                case ResultStatus.DOWNLOAD_FAILED | ResultStatus.EXTRACT_FAILED:
+                    if (
+                        result.status == ResultStatus.DOWNLOAD_FAILED
+                        and future_info.process_type == ProcessType.DOWNLOAD
+                        and context == root_context
+                        and schedule_download_retry(
+                            contexts_in_progress[root_context_path], result.error
+                        )
+                    ):
+                        continue
+                    contexts_in_progress[root_context_path].errors.append(result.error)
+                    if result.status == ResultStatus.DOWNLOAD_FAILED:
+                        metadata_manager.set_error_code_status(
+                            ContextError.DOWNLOAD_FAILED, True
+                        )
+                    if result.status == ResultStatus.EXTRACT_FAILED:
+                        metadata_manager.set_error_code_status(
+                            ContextError.EXTRACT_FAILED, True
+                        )
+                    contexts_in_progress[root_context_path].metadata = (
+                        metadata_manager.get_metadata()
+                    )
+                    for context_future in contexts_in_progress[
+                        root_context_path
+                    ].futures:  # Cancel all further processing for the root context at the first failure
+                        context_future.cancel()
+        root_context_progress = contexts_in_progress[root_context_path]
+        if (
+            future_info.process_type == ProcessType.DOWNLOAD
+            and future_context == root_context
+            and root_context_progress.metadata is not None
+            and not root_context_progress.bytes_done
+            and all(
+                result.status != ResultStatus.DOWNLOAD_FAILED
+                for result in future.result()
+            )
+        ):
+            # Credited when the download finishes rather than once the whole root file is processed, so the ETA
+            # follows the transfers while archives are still being extracted
+            logger.add_done_bytes(root_context_progress.metadata.remote_size or 0)
+            root_context_progress.bytes_done = True
+    if (
+        len(contexts_in_progress[root_context_path].files_to_process) == 0
+    ):  # True for completed or failed downloads of non-archives as well as fully processed or failed root archives
+        metadata_manager.set_error_code_status(
+            ContextError.CANCELLED,
+            contexts_in_progress[root_context_path].cancelled,
         )
-    finally:
-        process_manager.submit_exit_task(stop_processes)
-        print("INFO: Main thread waiting for exit process")
-        wait([process_manager.get_exit_future()])
-        print(
-            f"INFO: {progress_manager.get_processed_files()}/{progress_manager.get_total_files()} files have been successfully processed"
+        contexts_in_progress[root_context_path].metadata = (
+            metadata_manager.get_metadata()
         )
+        remote_hash = metadata_manager.get_remote_hash()
+        metadata_manager.free_context()
+        register_processed_file(contexts_in_progress[root_context_path])
+        if root_context_path in waiting_duplicates:
+            # Duplicates are listed again to be linked, or to be processed themselves if this context failed
+            if (
+                contexts_in_progress[root_context_path].cancelled
+                or len(contexts_in_progress[root_context_path].errors) > 0
+            ):
+                del run_hash_index[remote_hash]
+            for duplicate_file in waiting_duplicates.pop(root_context_path):
+                listed_files.put(duplicate_file)
 
 
 def download_file(
-    context: Context, rclone: RClone, sevenzip: SevenZip
+    context: Context,
+    rclone: RClone,
+    sevenzip: SevenZip,
+    known_file_type: ContextFileType = ContextFileType.UNKNOWN,
+    reserve_bytes: int = 0,
+    chunked_download: ChunkedDownload | None = None,
 ) -> list[ContextualFutureResult]:
     result = ContextualFutureResult(ResultStatus.DONE, context, None)
     try:
         rclone.set_context(context)
-        rclone.download()
+        with DiskSpace.reserve(reserve_bytes):
+            if chunked_download is None:
+                rclone.download()
+            else:
+                rclone.download_chunked(chunked_download)
         rclone.free_context()
         sevenzip.set_context(context)
-        if sevenzip.is_archive_file():
+        if is_archive_file(sevenzip, known_file_type):
             result.status = ResultStatus.EXTRACT_NEEDED
+        else:
+            result.local_stats = {
+                context.file_path: stat_local_file(sevenzip.get_destination_path())
+            }
         sevenzip.free_context()
     except Exception as e:
         result.status = ResultStatus.DOWNLOAD_FAILED
@@ -370,57 +1157,400 @@ def download_file(
     return [result]
 
 
+def download_files(
+    contexts: list[Context],
+    rclone: RClone,
+    sevenzip: SevenZip,
+    transfers: int | None = None,
+    checkers: int | None = None,
+    known_file_types: dict[Context, ContextFileType] | None = None,
+    reserve_bytes: int = 0,
+) -> dict[Context, list[ContextualFutureResult]]:
+    # Batched counterpart of download_file for contexts of a single source. reserve_bytes covers the whole batch
+    results = dict[Context, list[ContextualFutureResult]]()
+    try:
+        rclone.set_context_source_name(contexts[0].source_name)
+        with DiskSpace.reserve(reserve_bytes):
+            file_errors = rclone.download_batch(
+                [context.file_path for context in contexts], transfers, checkers
+            )
+    except Exception as e:
+        file_errors = {context.file_path: e for context in contexts}
+    finally:
+        rclone.free_context()
+    for context in contexts:
+        result = ContextualFutureResult(ResultStatus.DONE, context, None)
+        try:
+            if file_errors[context.file_path] is not None:
+                raise file_errors[context.file_path]
+            sevenzip.set_context(context)
+            if is_archive_file(
+                sevenzip,
+                (
+                    ContextFileType.UNKNOWN
+                    if known_file_types is None
+                    else known_file_types.get(context, ContextFileType.UNKNOWN)
+                ),
+            ):
+                result.status = ResultStatus.EXTRACT_NEEDED
+            else:
+                result.local_stats = {
+                    context.file_path: stat_local_file(sevenzip.get_destination_path())
+                }
+        except Exception as e:
+            result.status = ResultStatus.DOWNLOAD_FAILED
+            result.error = e
+        finally:
+            sevenzip.free_context()
+        results[context] = [result]
+    return results
+
+
+def is_archive_file(sevenzip: SevenZip, known_file_type: ContextFileType) -> bool:
+    # Content already classified under the same remote hash is not read again
+    if known_file_type != ContextFileType.UNKNOWN:
+        return known_file_type == ContextFileType.ARCHIVE
+    return sevenzip.is_archive_file()
+
+
 def extract_archive_file(
-    context: Context, sevenzip: SevenZip, root_context: Context | None = None
+    context: Context,
+    sevenzip: SevenZip,
+    root_context: Context | None = None,
+    native_extract_pool: ProcessPoolExecutor | None = None,
+    nested_size_limit: int = 0,
+    previous_member_info: dict[Path, tuple[int | None, str | None]] | None = None,
 ) -> list[ContextualFutureResult]:
+    # With previous_member_info for an earlier version of the archive whose extraction is still on disk, only new or
+    # changed members are extracted by 7-Zip and members that no longer exist are removed
     if root_context is None:
-        root_context = context.copy()
+        root_context = dataclasses.replace(context)
     try:
         sevenzip.set_context(context)
-        destination_root_dir = sevenzip.get_destination_root_dir()
         archive_extract_dir = sevenzip.get_extract_root_dir()
         archive_result = ContextualFutureResult(
             ResultStatus.DONE, context, None
         )  # Always included in return value as the last element
-        sevenzip.extract()
+        listed_member_info = sevenzip.get_member_info()
+        members_file_path = Path(f"{context.file_path}.x")
+        archive_result.member_info = {
+            members_file_path / member_path: member_info
+            for member_path, member_info in listed_member_info.items()
+        }
+        changed_member_paths = None
+        if (
+            previous_member_info
+            and len(listed_member_info) > 0
+            and archive_extract_dir.is_dir()
+        ):
+            changed_member_paths = [
+                member_path
+                for member_path, member_info in listed_member_info.items()
+                if previous_member_info.get(members_file_path / member_path)
+                != member_info
+            ]
+            remove_stale_members(
+                archive_extract_dir,
+                [
+                    member_file_path.relative_to(members_file_path)
+                    for member_file_path in previous_member_info.keys()
+                    if member_file_path not in archive_result.member_info
+                ],
+                changed_member_paths,
+            )
+        with DiskSpace.reserve(
+            sum(
+                listed_member_info[member_path][0]
+                for member_path in (
+                    listed_member_info
+                    if changed_member_paths is None
+                    else changed_member_paths
+                )
+            )
+        ):
+            if changed_member_paths is not None:
+                if len(changed_member_paths) > 0:
+                    sevenzip.extract(changed_member_paths)
+            # zip and tar families are extracted by the standard library in a worker process, anything else by 7-Zip
+            elif (
+                native_extract_pool is None
+                or not native_extract_pool.submit(
+                    extract_native_archive,
+                    sevenzip.get_destination_path(),
+                    archive_extract_dir,
+                    nested_size_limit,
+                ).result()
+            ):
+                sevenzip.extract()
+    except SevenZipNotArchiveError:
+        archive_result.status = ResultStatus.NOT_ARCHIVE
+        archive_result.local_stats = {
+            context.file_path: stat_local_file(sevenzip.get_destination_path())
+        }
+        sevenzip.free_context()
+        return [archive_result]
     except Exception as e:
         archive_result.status = ResultStatus.EXTRACT_FAILED
         archive_result.error = e
         sevenzip.free_context()
         return [archive_result]
-    results = []
-    for dirpath, dirnames, filenames in archive_extract_dir.walk():
-        for filename in filenames:
-            full_file_path = dirpath / filename
-            result_file_path = Path(
-                *(
-                    full_file_path.parts[
-                        len(destination_root_dir.parts) + 1 : len(full_file_path.parts)
-                    ]
-                )
-            )  # Get the path relative from the source directory
-            try:
-                sevenzip.set_context_file_path(result_file_path)
-                extracted_file_result = ContextualFutureResult(
-                    ResultStatus.DONE, sevenzip.get_context(), None
-                )
-                if sevenzip.is_archive_file():
-                    extracted_file_result.status = ResultStatus.EXTRACT_NEEDED
-            except Exception as e:
-                archive_result.status = ResultStatus.EXTRACT_FAILED
-                archive_result.error = e
-                sevenzip.free_context()
-                return [
-                    archive_result
-                ]  # Minimise further processing for the root archive by returning only the first error
-            results.append(extracted_file_result)
+    try:
+        results = classify_extracted_files(
+            sevenzip,
+            archive_extract_dir,
+            (
+                None
+                if changed_member_paths is None
+                else [
+                    archive_extract_dir / member_path
+                    for member_path in changed_member_paths
+                ]
+            ),
+        )
+    except Exception as e:
+        archive_result.status = ResultStatus.EXTRACT_FAILED
+        archive_result.error = e
+        sevenzip.free_context()
+        return [
+            archive_result
+        ]  # Minimise further processing for the root archive by returning only the first error
+    # Nested archives are stat'ed before they are extracted and deleted, which clears their stats again
+    source_dir = sevenzip.get_destination_root_dir() / context.source_name
+    archive_result.local_stats = {
+        member_file_path: stat_local_file(source_dir / member_file_path)
+        for member_file_path in archive_result.member_info.keys()
+    }
     sevenzip.free_context()
+    archive_result.status = ResultStatus.DELETE_NEEDED
     return results + [archive_result]
 
 
+def materialize_duplicate_file(
+    context: Context,
+    primary_context: Context,
+    sevenzip: SevenZip,
+    link_mode: str,
+    primary_member_info: dict[Path, tuple[int | None, str | None]] | None = None,
+) -> list[ContextualFutureResult]:
+    # Links the local outputs of primary_context, which has the same remote hash, instead of downloading the file.
+    # primary_member_info is set if the primary is an archive, in which case its extracted members are linked
+    result = ContextualFutureResult(ResultStatus.MATERIALIZED, context, None)
+    try:
+        sevenzip.set_context(context)
+        # The primary context may be linked from by several tasks at once, so it is never set on a SevenZip
+        primary_path = get_local_file_path_for_context(
+            primary_context, sevenzip.get_destination_root_dir()
+        )
+        if primary_member_info is None:
+            link_file(primary_path, sevenzip.get_destination_path(), link_mode)
+            result.local_stats = {
+                context.file_path: stat_local_file(sevenzip.get_destination_path())
+            }
+        else:
+            link_tree(
+                Path(f"{primary_path}.x"), sevenzip.get_extract_root_dir(), link_mode
+            )
+            primary_members_file_path = Path(f"{primary_context.file_path}.x")
+            members_file_path = Path(f"{context.file_path}.x")
+            result.member_info = {
+                members_file_path
+                / member_file_path.relative_to(primary_members_file_path): member_info
+                for member_file_path, member_info in primary_member_info.items()
+            }
+            source_dir = sevenzip.get_destination_root_dir() / context.source_name
+            result.local_stats = {
+                member_file_path: stat_local_file(source_dir / member_file_path)
+                for member_file_path in result.member_info.keys()
+            }
+    except Exception as e:
+        result.status = ResultStatus.DOWNLOAD_FAILED
+        result.error = e
+    finally:
+        sevenzip.free_context()
+    return [result]
+
+
+def remove_stale_members(
+    archive_extract_dir: Path,
+    removed_member_paths: list[Path],
+    changed_member_paths: list[Path],
+) -> None:
+    # Extractions of nested archives are removed for changed members too, as they are extracted again from scratch
+    for member_path in removed_member_paths:
+        (archive_extract_dir / member_path).unlink(missing_ok=True)
+    for member_path in removed_member_paths + changed_member_paths:
+        shutil.rmtree(
+            Path(f"{archive_extract_dir / member_path}.x"), ignore_errors=True
+        )
+
+
+def delete_archive_file(
+    context: Context, sevenzip: SevenZip
+) -> list[ContextualFutureResult]:
+    result = ContextualFutureResult(ResultStatus.DONE, context, None)
+    try:
+        sevenzip.set_context(context)
+        sevenzip.delete_archive()
+        DiskSpace.notify_space_freed()
+    except Exception as e:
+        result.status = ResultStatus.DELETE_FAILED
+        result.error = e
+    finally:
+        sevenzip.free_context()
+    return [result]
+
+
+def stream_extract_file(
+    context: Context,
+    rclone: RClone,
+    sevenzip: SevenZip,
+    compression: str,
+    reserve_bytes: int = 0,
+    previous_member_info: dict[Path, tuple[int | None, str | None]] | None = None,
+) -> list[ContextualFutureResult]:
+    # Extracts an archive from rclone cat without writing the archive itself to disk. Files that turn out not to be
+    # the expected archive are downloaded and classified as usual. The unpacked size is unknown up front, so
+    # reserve_bytes is the size of the archive. The whole archive is always extracted again, but with
+    # previous_member_info for an earlier version members that no longer exist are removed afterwards
+    archive_result = ContextualFutureResult(
+        ResultStatus.EXTRACTED, context, None
+    )  # Always included in return value as the last element
+    try:
+        sevenzip.set_context(context)
+        archive_extract_dir = sevenzip.get_extract_root_dir()
+        sevenzip.free_context()
+        rclone.set_context(context)
+        with DiskSpace.reserve(reserve_bytes):
+            try:
+                with rclone.open_stream() as stream:
+                    listed_member_info = extract_tar_stream(
+                        stream, compression, archive_extract_dir
+                    )
+            except StreamNotArchiveError:
+                rclone.free_context()
+                return download_file(context, rclone, sevenzip)
+        rclone.free_context()
+        members_file_path = Path(f"{context.file_path}.x")
+        archive_result.member_info = {
+            members_file_path / member_path: member_info
+            for member_path, member_info in listed_member_info.items()
+        }
+        if previous_member_info:
+            remove_stale_members(
+                archive_extract_dir,
+                [
+                    member_file_path.relative_to(members_file_path)
+                    for member_file_path in previous_member_info.keys()
+                    if member_file_path not in archive_result.member_info
+                ],
+                [
+                    member_path
+                    for member_path, member_info in listed_member_info.items()
+                    if previous_member_info.get(members_file_path / member_path)
+                    != member_info
+                ],
+            )
+        sevenzip.set_context(context)
+        results = classify_extracted_files(sevenzip, archive_extract_dir)
+        source_dir = sevenzip.get_destination_root_dir() / context.source_name
+        archive_result.local_stats = {
+            member_file_path: stat_local_file(source_dir / member_file_path)
+            for member_file_path in archive_result.member_info.keys()
+        }
+    except Exception as e:
+        archive_result.status = (
+            ResultStatus.DOWNLOAD_FAILED
+            if isinstance(e, RCloneError)
+            else ResultStatus.EXTRACT_FAILED
+        )
+        archive_result.error = e
+        return [archive_result]
+    finally:
+        rclone.free_context()
+        sevenzip.free_context()
+    return results + [archive_result]
+
+
+def classify_extracted_files(
+    sevenzip: SevenZip,
+    archive_extract_dir: Path,
+    full_file_paths: list[Path] | None = None,
+) -> list[ContextualFutureResult]:
+    # Returns a result for each extracted file, with EXTRACT_NEEDED for nested archives. Raises on the first error
+    # Every file in archive_extract_dir is classified unless full_file_paths limits it to the files just extracted
+    destination_root_dir = sevenzip.get_destination_root_dir()
+    if full_file_paths is None:
+        full_file_paths = [
+            dirpath / filename
+            for dirpath, dirnames, filenames in archive_extract_dir.walk()
+            for filename in filenames
+        ]
+    results = []
+    for full_file_path in full_file_paths:
+        result_file_path = Path(
+            *(
+                full_file_path.parts[
+                    len(destination_root_dir.parts) + 1 : len(full_file_path.parts)
+                ]
+            )
+        )  # Get the path relative from the source directory
+        sevenzip.set_context_file_path(result_file_path)
+        extracted_file_result = ContextualFutureResult(
+            ResultStatus.DONE, sevenzip.get_context(), None
+        )
+        if sevenzip.is_archive_file():
+            extracted_file_result.status = ResultStatus.EXTRACT_NEEDED
+        results.append(extracted_file_result)
+    return results
+
+
+def verify_local_files(
+    destination_root_dir: Path,
+    candidates: list[
+        tuple[str, tuple[str, str, str, str], dict[Path, tuple[int, int, int]]]
+    ],
+) -> list[tuple[str, tuple[str, str, str, str], set[Path]]]:
+    # Returns the candidates with a local output that is missing or whose stat changed, alongside those outputs as
+    # file paths within the source
+    expected_stats = dict[Path, tuple[int, int, int]]()
+    for source_name, file_info, expected_local_stats in candidates:
+        for file_path, local_stat in expected_local_stats.items():
+            expected_stats[destination_root_dir / source_name / file_path] = local_stat
+    changed_full_file_paths = find_changed_local_files(expected_stats)
+    failed_candidates = []
+    for source_name, file_info, expected_local_stats in candidates:
+        changed_file_paths = {
+            file_path
+            for file_path in expected_local_stats.keys()
+            if destination_root_dir / source_name / file_path in changed_full_file_paths
+        }
+        if len(changed_file_paths) > 0:
+            failed_candidates.append((source_name, file_info, changed_file_paths))
+    return failed_candidates
+
+
+def log_error(message: str, error: Exception) -> None:
+    global logger
+    logger.submit_output(message)
+    logger.write_to_log_file(
+        f"{message}\n" + "\n".join(format_exception(None, error, error.__traceback__))
+    )
+
+
 def register_processed_file(context_progress) -> None:
     global logger
     global progress_manager
+    global failed_source_names
+    if context_progress is not None and (
+        context_progress.cancelled or len(context_progress.errors) > 0
+    ):
+        failed_source_names.add(context_progress.context.source_name)
+    if (
+        context_progress is not None
+        and context_progress.metadata is not None
+        and not context_progress.bytes_done
+    ):
+        logger.add_done_bytes(context_progress.metadata.remote_size or 0)
     if context_progress is None or context_progress.cancelled:
         processed_files, failed_files = progress_manager.register_failed_file()
     elif len(context_progress.errors) == 0:
@@ -445,6 +1575,15 @@ def register_processed_file(context_progress) -> None:
     logger.set_done_files(processed_files + failed_files)
 
 
+def log_download_limit_change(
+    remote_name: str, previous_limit: int, limit: int, reason: str
+) -> None:
+    global logger
+    message = f"INFO: Download concurrency for remote_name: {remote_name} changed from {previous_limit} to {limit} ({reason})"
+    logger.submit_output(message)
+    logger.write_to_log_file(f"{message}\n")
+
+
 def stop_processes() -> None:
     global logger
     global metadata_manager
@@ -457,15 +1596,28 @@ def stop_processes() -> None:
         if logger.is_drawing():
             logger.stop_drawing_progress()
         metadata_manager.stop_flush_metadata_process()
-        pools = process_manager.get_download_pools() + [
-            process_manager.get_extract_pool(),
-            process_manager.get_delete_pool(),
-        ]
+        DiskSpace.stop()  # Tasks waiting for disk space would otherwise hold up the pool shutdown
+        for download_limiter in process_manager.get_download_limiters():
+            download_limiter.stop()  # As do downloads waiting for their remote's concurrency limit
+        RClone.stop_chunked_downloads()  # Their progress is kept to resume from
+        pools = (
+            process_manager.get_list_pools()
+            + process_manager.get_download_pools()
+            + [
+                process_manager.get_extract_pool(),
+                process_manager.get_native_extract_pool(),
+                process_manager.get_delete_pool(),
+                process_manager.get_verify_pool(),
+            ]
+        )
         print("INFO: Waiting for current processes to finish...")
         for pool in pools:
             if pool is not None:
                 pool.shutdown(wait=True, cancel_futures=True)
+        if RCloneRC.is_class_configured():
+            RCloneRC.stop_daemon()
         metadata_manager.flush_metadata()
+        metadata_manager.close_metadata_store()
         process_manager.get_exit_pool().shutdown(
             wait=False, cancel_futures=True
         )  # Main thread waits for this
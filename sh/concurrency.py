@@ -0,0 +1,176 @@
+from .helpers import *
+
+from collections.abc import Callable
+from contextlib import contextmanager
+from threading import Condition
+from time import monotonic
+from typing import Iterator
+
+import dataclasses
+
+THROUGHPUT_GAIN_FACTOR: float = (
+    1.05  # A window must beat the throughput of the last by this much to raise the limit
+)
+LATENCY_BACKOFF_FACTOR: float = (
+    1.5  # The limit is cut if the time taken per byte per running task grows by this much between windows
+)
+
+
+@dataclasses.dataclass
+class SlotOutcome:
+    # Set by the task run in AdaptiveLimiter.slot if it hit a temporary error, such as rate limiting
+    temporary_error: bool = False
+
+
+class AdaptiveLimiter:
+    """AIMD controller for the number of tasks that may run at once against a remote
+
+    Completed tasks are measured in windows of as many tasks as the current limit. The first window at the start
+    and after each cut only sets a baseline. The limit is then raised by one once as a probe, and after each window
+    whose aggregate throughput beat the last. It is halved on a temporary error, or when throughput fell while the
+    time taken per byte rose by LATENCY_BACKOFF_FACTOR, never leaving the configured bounds. Time per byte is
+    divided by the limit, so tasks sharing the remote's bandwidth do not look slower as the limit grows. Errors from
+    tasks that started before the last change are ignored, so a burst of rate limiting only cuts the limit once.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        min_limit: int,
+        max_limit: int,
+        initial_limit: int,
+        on_limit_change: Callable[[str, int, int, str], None] | None = None,
+        clock: Callable[[], float] = monotonic,
+    ) -> None:
+        self._name = name
+        self._min_limit = min_limit
+        self._max_limit = max_limit
+        self._limit = min(max(initial_limit, min_limit), max_limit)
+        self._on_limit_change = on_limit_change
+        self._clock = clock
+        self._condition = Condition()
+        self._running = 0
+        self._stopped = False
+        self._limit_changed_time = self._clock()
+        self._previous_throughput: float | None = None
+        self._previous_latency: float | None = None
+        # The limit is raised once without a gain after each baseline
+        self._probe_pending = True
+        self.reset_window()
+
+    def get_name(self) -> str:
+        return self._name
+
+    def get_limit(self) -> int:
+        return self._limit
+
+    def reset_window(self) -> None:
+        self._window_start_time = self._clock()
+        self._window_completions = 0
+        self._window_bytes = 0
+        self._window_seconds = 0.0
+
+    @contextmanager
+    def slot(self, transfer_bytes: int) -> Iterator[SlotOutcome]:
+        # Blocks until fewer tasks than the limit are running, then measures the task run in the block
+        with self._condition:
+            while self._running >= self._limit:
+                if self._stopped:
+                    raise ConcurrencyWaitCancelledError(self._name)
+                self._condition.wait()
+            if self._stopped:
+                raise ConcurrencyWaitCancelledError(self._name)
+            self._running += 1
+        start_time = self._clock()
+        slot_outcome = SlotOutcome()
+        try:
+            yield slot_outcome
+        finally:
+            with self._condition:
+                self._running -= 1
+                self.record_completion(
+                    transfer_bytes,
+                    start_time,
+                    self._clock(),
+                    slot_outcome.temporary_error,
+                )
+                self._condition.notify_all()
+
+    def record_completion(
+        self,
+        transfer_bytes: int,
+        start_time: float,
+        end_time: float,
+        temporary_error: bool,
+    ) -> None:
+        # Called with the condition held
+        if start_time < self._limit_changed_time:
+            return  # Measured against a limit that no longer applies
+        if temporary_error:
+            self.set_limit(self._limit // 2, "temporary error")
+            return
+        self._window_completions += 1
+        self._window_bytes += transfer_bytes
+        self._window_seconds += end_time - start_time
+        if self._window_completions < self._limit:
+            return
+        throughput = self._window_bytes / max(end_time - self._window_start_time, 1e-9)
+        latency = self._window_seconds / max(self._window_bytes, 1) / self._limit
+        previous_throughput = self._previous_throughput
+        previous_latency = self._previous_latency
+        self._previous_throughput = throughput
+        self._previous_latency = latency
+        self.reset_window()
+        if previous_throughput is None:
+            return  # Only a baseline for the next window
+        if (
+            throughput < previous_throughput
+            and latency > previous_latency * LATENCY_BACKOFF_FACTOR
+        ):
+            self.set_limit(self._limit // 2, "rising latency")
+        elif throughput > previous_throughput * THROUGHPUT_GAIN_FACTOR:
+            self._probe_pending = False
+            self.set_limit(self._limit + 1, "throughput improved")
+        elif self._probe_pending:
+            self._probe_pending = False
+            self.set_limit(self._limit + 1, "probing for more throughput")
+
+    def set_limit(self, limit: int, reason: str) -> None:
+        # Called with the condition held
+        limit = min(max(limit, self._min_limit), self._max_limit)
+        if limit == self._limit:
+            return
+        previous_limit = self._limit
+        self._limit = limit
+        self._limit_changed_time = self._clock()
+        if limit < previous_limit:
+            # Measured again from scratch, so the limit is only raised again once the remote keeps up
+            self._previous_throughput = None
+            self._previous_latency = None
+            self._probe_pending = True
+        self.reset_window()
+        self._condition.notify_all()
+        if self._on_limit_change is not None:
+            self._on_limit_change(self._name, previous_limit, limit, reason)
+
+    def stop(self) -> None:
+        # Wakes waiting tasks so that worker pools can shut down
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+
+
+class ConcurrencyWaitCancelledError(Exception):
+    """Exception raised when a task stops waiting for a concurrency slot because the process is exiting
+
+    Attributes:
+        name    -- the name of the limiter the task was waiting on
+        message -- explanation of the error
+    """
+
+    def __init__(self, name: str, message: str | None = None) -> None:
+        self.name = name
+        if message is None:
+            message = f"Stopped waiting for a concurrency slot for: {safe_str(name)}"
+
+        super().__init__(message)
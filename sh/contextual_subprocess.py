@@ -2,8 +2,9 @@ from .helpers import *
 from .context import Contextual
 
 from pathlib import Path
-from subprocess import CompletedProcess  # For type hinting
+from subprocess import CompletedProcess, Popen  # For type hinting
 from textwrap import indent
+from typing import IO
 
 import os
 import subprocess
@@ -44,6 +45,25 @@ class ContextualSubprocess(Contextual):
             errors="backslashreplace",
         )
 
+    def open_subprocess(
+        self, cmd_args: list[str], stderr_file: IO, text: bool = True
+    ) -> Popen:
+        # stdout is streamed through a pipe; stderr goes to a file so a full pipe cannot stall the process
+        if not text:
+            return subprocess.Popen(
+                [self.get_executable_path()] + cmd_args,
+                stdout=subprocess.PIPE,
+                stderr=stderr_file,
+            )
+        return subprocess.Popen(
+            [self.get_executable_path()] + cmd_args,
+            stdout=subprocess.PIPE,
+            stderr=stderr_file,
+            text=True,
+            encoding="utf-8",
+            errors="backslashreplace",
+        )
+
 
 class SubprocessError(Exception):
     """
@@ -0,0 +1,107 @@
+from .helpers import *
+from .global_config import GloballyConfigured
+
+from contextlib import contextmanager
+from pathlib import Path
+from threading import Condition
+from typing import Iterator
+
+import shutil
+
+DISK_SPACE_POLL_SECONDS: float = (
+    1.0  # Free space is checked again at least this often while tasks wait for it
+)
+
+
+class DiskSpace(GloballyConfigured):
+    """Admission control that reserves space on the destination volume before a download or extract starts
+
+    A task waits until the free space reported for the destination, less the space reserved by running tasks and
+    the configured headroom, covers its own estimate. Running tasks also shrink the free space as they write, so
+    the check errs towards waiting. A reservation is always granted when nothing else is reserved, so an estimate
+    larger than the volume fails with the file system's own error rather than waiting forever.
+    """
+
+    _destination_root_dir: Path | None = None
+    _headroom_bytes: int = 0
+    _reserved_bytes: int = 0
+    _condition: Condition | None = None
+    _stopped: bool = False
+
+    @classmethod
+    def configure(cls, destination_root_dir: Path, headroom_bytes: int) -> None:
+        cls.raise_exception_if_class_configured()
+        cls._destination_root_dir = destination_root_dir
+        cls._headroom_bytes = headroom_bytes
+        cls._reserved_bytes = 0
+        cls._condition = Condition()
+        cls._stopped = False
+        super().configure()
+
+    @classmethod
+    def get_free_bytes(cls) -> int:
+        # The destination may not have been created yet, in which case the volume it will be created on is used
+        usage_path = cls._destination_root_dir
+        while not usage_path.exists() and usage_path.parent != usage_path:
+            usage_path = usage_path.parent
+        return shutil.disk_usage(usage_path).free
+
+    @classmethod
+    def get_reserved_bytes(cls) -> int:
+        return cls._reserved_bytes
+
+    @classmethod
+    @contextmanager
+    def reserve(cls, size: int) -> Iterator[None]:
+        # Blocks until size bytes are reserved, and releases them when the block exits
+        if not cls.is_class_configured() or size <= 0:
+            yield
+            return
+        with cls._condition:
+            while (
+                cls._reserved_bytes > 0
+                and cls.get_free_bytes() - cls._reserved_bytes - cls._headroom_bytes
+                < size
+            ):
+                if cls._stopped:
+                    raise DiskSpaceWaitCancelledError(size)
+                cls._condition.wait(DISK_SPACE_POLL_SECONDS)
+            if cls._stopped:
+                raise DiskSpaceWaitCancelledError(size)
+            cls._reserved_bytes += size
+        try:
+            yield
+        finally:
+            with cls._condition:
+                cls._reserved_bytes -= size
+                cls._condition.notify_all()
+
+    @classmethod
+    def notify_space_freed(cls) -> None:
+        if cls.is_class_configured():
+            with cls._condition:
+                cls._condition.notify_all()
+
+    @classmethod
+    def stop(cls) -> None:
+        # Wakes waiting tasks so that worker pools can shut down
+        if cls.is_class_configured():
+            with cls._condition:
+                cls._stopped = True
+                cls._condition.notify_all()
+
+
+class DiskSpaceWaitCancelledError(Exception):
+    """Exception raised when a task stops waiting for disk space because the process is exiting
+
+    Attributes:
+        size    -- the number of bytes the task was waiting to reserve
+        message -- explanation of the error
+    """
+
+    def __init__(self, size: int, message: str | None = None) -> None:
+        self.size = size
+        if message is None:
+            message = f"Stopped waiting to reserve disk space of {safe_str(size)} bytes"
+
+        super().__init__(message)
@@ -0,0 +1,201 @@
+from .helpers import *
+from .context import Context
+from .metadata import ContextFileType
+
+from abc import ABC, abstractmethod
+from collections import deque
+from collections.abc import Callable
+from concurrent.futures import Future
+
+import dataclasses
+import heapq
+
+
+@dataclasses.dataclass
+class QueuedDownload:
+    context: Context
+    file_size: int
+    known_file_type: ContextFileType
+    # Submits the download on its own, which is also used to retry it
+    submit_download: Callable[[], Future]
+    # Whether the download may be submitted with others of its source in a batch
+    batchable: bool = False
+
+
+class DownloadOrder(ABC):
+    """Base class for the order in which the queued downloads of a source are submitted"""
+
+    @abstractmethod
+    def __len__(self) -> int:
+        pass
+
+    @abstractmethod
+    def push(self, queued_download: QueuedDownload) -> None:
+        pass
+
+    @abstractmethod
+    def peek(self) -> QueuedDownload:
+        pass
+
+    @abstractmethod
+    def pop(self) -> QueuedDownload:
+        pass
+
+
+class ListedOrder(DownloadOrder):
+    """Submits downloads in the order they were listed"""
+
+    def __init__(self) -> None:
+        self._queued_downloads = deque[QueuedDownload]()
+
+    def __len__(self) -> int:
+        return len(self._queued_downloads)
+
+    def push(self, queued_download: QueuedDownload) -> None:
+        self._queued_downloads.append(queued_download)
+
+    def peek(self) -> QueuedDownload:
+        return self._queued_downloads[0]
+
+    def pop(self) -> QueuedDownload:
+        return self._queued_downloads.popleft()
+
+
+class LargestFirstOrder(DownloadOrder):
+    """Submits the largest queued download first, so that a large file listed late does not set the run time"""
+
+    def __init__(self) -> None:
+        self._heap = list[tuple[int, int, QueuedDownload]]()
+        self._sequence = 0  # Keeps files of the same size in listing order
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def get_sort_key(self, queued_download: QueuedDownload) -> int:
+        return -queued_download.file_size
+
+    def push(self, queued_download: QueuedDownload) -> None:
+        heapq.heappush(
+            self._heap,
+            (self.get_sort_key(queued_download), self._sequence, queued_download),
+        )
+        self._sequence += 1
+
+    def peek(self) -> QueuedDownload:
+        return self._heap[0][2]
+
+    def pop(self) -> QueuedDownload:
+        return heapq.heappop(self._heap)[2]
+
+
+class SmallestFirstOrder(LargestFirstOrder):
+    """Submits the smallest queued download first, so that results appear as soon as possible"""
+
+    def get_sort_key(self, queued_download: QueuedDownload) -> int:
+        return queued_download.file_size
+
+
+class InterleavedOrder(DownloadOrder):
+    """Alternates between the largest and the smallest queued download, so that large files start early while
+    small files keep completing alongside them"""
+
+    def __init__(self) -> None:
+        # Every download is in both heaps. One popped from either heap is skipped lazily when it reaches the top of
+        # the other, so pushes and pops stay O(log n)
+        self._largest_heap = list[tuple[int, int, QueuedDownload]]()
+        self._smallest_heap = list[tuple[int, int, QueuedDownload]]()
+        self._popped_sequences = set[int]()
+        self._sequence = 0
+        self._length = 0
+        self._largest_next = True
+
+    def __len__(self) -> int:
+        return self._length
+
+    def push(self, queued_download: QueuedDownload) -> None:
+        # Of files of the same size, the largest side takes the last listed and the smallest side the first listed
+        heapq.heappush(
+            self._largest_heap,
+            (-queued_download.file_size, -self._sequence, queued_download),
+        )
+        heapq.heappush(
+            self._smallest_heap,
+            (queued_download.file_size, self._sequence, queued_download),
+        )
+        self._sequence += 1
+        self._length += 1
+
+    def get_next_heap(self) -> list[tuple[int, int, QueuedDownload]]:
+        heap = self._largest_heap if self._largest_next else self._smallest_heap
+        while abs(heap[0][1]) in self._popped_sequences:
+            self._popped_sequences.remove(abs(heapq.heappop(heap)[1]))
+        return heap
+
+    def peek(self) -> QueuedDownload:
+        return self.get_next_heap()[0][2]
+
+    def pop(self) -> QueuedDownload:
+        _, sequence, queued_download = heapq.heappop(self.get_next_heap())
+        self._popped_sequences.add(abs(sequence))
+        self._length -= 1
+        self._largest_next = not self._largest_next
+        return queued_download
+
+
+DOWNLOAD_ORDERS: dict[str, type[DownloadOrder]] = {
+    "listed": ListedOrder,
+    "largest_first": LargestFirstOrder,
+    "smallest_first": SmallestFirstOrder,
+    "interleaved": InterleavedOrder,
+}
+
+
+class DownloadQueue:
+    """Downloads waiting for a free download worker of their remote, ordered per source
+
+    Sources of the same remote take turns, so that the order of one source does not hold back another.
+    """
+
+    def __init__(
+        self,
+        download_order_per_source: dict[str, str],
+        source_remote_name_map: dict[str, str],
+    ) -> None:
+        self._source_orders = dict[str, DownloadOrder]()
+        self._remote_source_names = dict[str, deque[str]]()
+        for source_name, download_order in download_order_per_source.items():
+            self._source_orders[source_name] = DOWNLOAD_ORDERS[download_order]()
+            self._remote_source_names.setdefault(
+                source_remote_name_map[source_name], deque[str]()
+            ).append(source_name)
+
+    def __len__(self) -> int:
+        return sum(len(source_order) for source_order in self._source_orders.values())
+
+    def get_remote_names(self) -> list[str]:
+        return list(self._remote_source_names.keys())
+
+    def push(self, queued_download: QueuedDownload) -> None:
+        self._source_orders[queued_download.context.source_name].push(queued_download)
+
+    def pop_for_remote(
+        self, remote_name: str, max_batch_size: int = 1
+    ) -> list[QueuedDownload]:
+        # Pops the next download of the next source of the remote with any queued, along with the downloads after
+        # it up to max_batch_size if they are all batchable. Returns an empty list if nothing is queued
+        source_names = self._remote_source_names[remote_name]
+        for _ in range(len(source_names)):
+            source_order = self._source_orders[source_names[0]]
+            source_names.rotate(-1)
+            if len(source_order) == 0:
+                continue
+            queued_downloads = [source_order.pop()]
+            while (
+                queued_downloads[0].batchable
+                and len(queued_downloads) < max_batch_size
+                and len(source_order) > 0
+                and source_order.peek().batchable
+            ):
+                queued_downloads.append(source_order.pop())
+            return queued_downloads
+        return list[QueuedDownload]()
@@ -0,0 +1,99 @@
+from .helpers import *
+
+from enum import Enum
+from pathlib import Path
+
+SNIFF_BYTES: int = (
+    4096  # Read from the start of each file, which covers every signature except ISO's
+)
+
+
+class SignatureMatch(Enum):
+    ARCHIVE = 0
+    NOT_ARCHIVE = 1
+    AMBIGUOUS = 2  # Needs a full test by 7-Zip
+
+
+# (offset, magic bytes, format name) for formats 7-Zip extracts
+_ARCHIVE_SIGNATURES: list[tuple[int, bytes, str]] = [
+    (0, b"PK\x03\x04", "zip"),
+    (0, b"PK\x05\x06", "zip"),  # Empty archive
+    (0, b"PK\x07\x08", "zip_spanned"),  # Left to 7-Zip, as zipfile cannot open it
+    (0, b"7z\xbc\xaf\x27\x1c", "7z"),
+    (0, b"Rar!\x1a\x07\x00", "rar"),
+    (0, b"Rar!\x1a\x07\x01\x00", "rar"),
+    (0, b"\x1f\x8b", "gz"),
+    (0, b"\xfd7zXZ\x00", "xz"),
+    (0, b"\x28\xb5\x2f\xfd", "zstd"),
+    (0, b"MSCF\x00\x00\x00\x00", "cab"),
+    (257, b"ustar", "tar"),
+]
+_ISO_SIGNATURE: bytes = b"CD001"
+_ISO_DESCRIPTOR_OFFSETS: tuple[int, ...] = (0x8001, 0x8801, 0x9001)
+# Common formats 7-Zip cannot extract, so they are never tested
+_NON_ARCHIVE_SIGNATURES: list[tuple[int, bytes, str]] = [
+    (0, b"\xff\xd8\xff", "jpeg"),
+    (0, b"\x89PNG\r\n\x1a\n", "png"),
+    (0, b"GIF87a", "gif"),
+    (0, b"GIF89a", "gif"),
+    (0, b"%PDF-", "pdf"),
+    (0, b"ID3", "mp3"),
+    (0, b"OggS", "ogg"),
+    (0, b"fLaC", "flac"),
+    (0, b"RIFF", "riff"),
+    (0, b"\x1a\x45\xdf\xa3", "matroska"),
+    (4, b"ftyp", "mp4"),
+]
+
+
+def sniff_file(file_path: Path) -> tuple[SignatureMatch, str | None]:
+    # Classifies a file from its first bytes. Returns the detected format name, if any, alongside the match
+    with open(file_path, "rb") as sniffed_file:
+        head = sniffed_file.read(SNIFF_BYTES)
+        iso_descriptors = list[bytes]()
+        for descriptor_offset in _ISO_DESCRIPTOR_OFFSETS:
+            sniffed_file.seek(descriptor_offset)
+            iso_descriptors.append(sniffed_file.read(len(_ISO_SIGNATURE)))
+    return classify_head(head, iso_descriptors)
+
+
+def sniff_bytes(data: bytes) -> tuple[SignatureMatch, str | None]:
+    # sniff_file for contents already held in memory
+    return classify_head(
+        data[:SNIFF_BYTES],
+        [
+            data[descriptor_offset : descriptor_offset + len(_ISO_SIGNATURE)]
+            for descriptor_offset in _ISO_DESCRIPTOR_OFFSETS
+        ],
+    )
+
+
+def classify_head(
+    head: bytes, iso_descriptors: list[bytes]
+) -> tuple[SignatureMatch, str | None]:
+    for offset, magic, format_name in _ARCHIVE_SIGNATURES:
+        if head.startswith(magic, offset):
+            return SignatureMatch.ARCHIVE, format_name
+    if head.startswith(b"BZh") and head[3:4].isdigit() and head[3:4] != b"0":
+        return SignatureMatch.ARCHIVE, "bz2"
+    for offset, magic, format_name in _NON_ARCHIVE_SIGNATURES:
+        if head.startswith(magic, offset):
+            return SignatureMatch.NOT_ARCHIVE, format_name
+    if _ISO_SIGNATURE in iso_descriptors:
+        return SignatureMatch.ARCHIVE, "iso"
+    if len(head) == 0 or is_text(head):
+        return SignatureMatch.NOT_ARCHIVE, None
+    return SignatureMatch.AMBIGUOUS, None
+
+
+def is_text(head: bytes) -> bool:
+    if b"\x00" in head:
+        return False
+    # The read may have split a multi-byte character at the end
+    for trailing_bytes in range(4):
+        try:
+            head[: len(head) - trailing_bytes].decode("utf-8")
+            return True
+        except UnicodeDecodeError:
+            continue
+    return False
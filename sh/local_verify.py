@@ -0,0 +1,50 @@
+from .helpers import *
+
+from pathlib import Path
+
+import os
+
+
+def stat_local_file(file_path: Path) -> tuple[int, int, int] | None:
+    # Size, modification time in nanoseconds and inode of a local file, or None if it does not exist
+    try:
+        file_stat = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+    return (file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino)
+
+
+def find_changed_local_files(
+    expected_stats: dict[Path, tuple[int, int, int]],
+) -> set[Path]:
+    # Returns the files that are missing or whose stat differs from the one recorded. Each directory is read once
+    # with os.scandir, which avoids a separate lookup per file. File contents are never read
+    file_names_by_dir = dict[Path, dict[str, Path]]()
+    for file_path in expected_stats.keys():
+        file_names_by_dir.setdefault(file_path.parent, dict[str, Path]())[
+            file_path.name
+        ] = file_path
+    changed_file_paths = set[Path]()
+    for dir_path, file_names in file_names_by_dir.items():
+        try:
+            with os.scandir(dir_path) as dir_entries:
+                for dir_entry in dir_entries:
+                    file_path = file_names.pop(dir_entry.name, None)
+                    if file_path is None:
+                        continue
+                    try:
+                        entry_stat = dir_entry.stat()
+                        entry_inode = dir_entry.inode()
+                    except OSError:
+                        changed_file_paths.add(file_path)
+                        continue
+                    if (
+                        entry_stat.st_size,
+                        entry_stat.st_mtime_ns,
+                        entry_inode,
+                    ) != expected_stats[file_path]:
+                        changed_file_paths.add(file_path)
+        except (FileNotFoundError, NotADirectoryError):
+            pass  # Every file expected in the directory is missing
+        changed_file_paths.update(file_names.values())
+    return changed_file_paths
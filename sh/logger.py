@@ -21,6 +21,10 @@ class Logger:
         self._outputs = []
         self._total_files = -1
         self._done_files = 0
+        self._total_bytes = 0
+        self._done_bytes = 0
+        self._progress_start_time = None
+        self._stats_callback = None
         self._drawing_enabled = False
         self._draw_proc_pool = None
         self._draw_proc_future = None
@@ -39,6 +43,7 @@ class Logger:
     def start_drawing_progress(self):
         if not self._drawing_enabled:
             self._draw_proc_pool = ThreadPoolExecutor(max_workers=1)
+            self._progress_start_time = time()
             self._drawing_enabled = True
             self._draw_proc_future = self._draw_proc_pool.submit(self.draw_process)
 
@@ -91,6 +96,32 @@ class Logger:
         self._file_counters_lock.release()
         return done_files
 
+    def add_total_bytes(self, total_bytes):
+        self._file_counters_lock.acquire()
+        self._total_bytes += total_bytes
+        self._file_counters_lock.release()
+
+    def add_done_bytes(self, done_bytes):
+        self._file_counters_lock.acquire()
+        self._done_bytes += done_bytes
+        self._file_counters_lock.release()
+
+    def get_eta_seconds(self):
+        # Estimated from the rate bytes have been processed at so far, as file counts are skewed by the order files
+        # are downloaded in. None until any bytes are done
+        self._file_counters_lock.acquire()
+        total_bytes = self._total_bytes
+        done_bytes = self._done_bytes
+        self._file_counters_lock.release()
+        if done_bytes == 0 or self._progress_start_time is None:
+            return None
+        bytes_per_second = done_bytes / max(time() - self._progress_start_time, 1)
+        return max(total_bytes - done_bytes, 0) / bytes_per_second
+
+    def set_stats_callback(self, stats_callback):
+        # Called on each progress draw for an extra line of stats, such as live transfer stats
+        self._stats_callback = stats_callback
+
     def draw_process(self):
         # self._stdscr = curses.initscr()
         # curses.noecho()
@@ -134,6 +165,24 @@ class Logger:
                     print(f"{prefix} |{bar}| {percent}% {suffix}")
                     # current_idx += 1
 
+                if self._total_bytes != 0:
+                    mebibyte = 1024 * 1024
+                    eta_seconds = self.get_eta_seconds()
+                    eta = (
+                        "unknown"
+                        if eta_seconds is None
+                        else f"{int(eta_seconds // 3600)}:{int(eta_seconds % 3600 // 60):02}:{int(eta_seconds % 60):02}"
+                    )
+                    print(
+                        f"Bytes: {self._done_bytes / mebibyte:.1f}/{self._total_bytes / mebibyte:.1f} MiB, ETA: {eta}"
+                    )
+
+                if self._stats_callback is not None:
+                    try:
+                        print(self._stats_callback())
+                    except Exception:
+                        pass  # Stats are informational only
+
                 # self._stdscr.refresh()
 
                 sleep(5)
@@ -0,0 +1,57 @@
+from .helpers import *
+
+from pathlib import Path
+
+import os
+import shutil
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+LINK_MODES: tuple[str, ...] = ("reflink", "hardlink", "copy")
+_FICLONE: int = (
+    0x40049409  # Linux ioctl that shares the extents of one file with another on Btrfs and XFS
+)
+
+
+def reflink_file(source_path: Path, target_path: Path) -> None:
+    if fcntl is None:
+        raise OSError(
+            f"Reflinks are not supported on this platform: {safe_str(target_path)}"
+        )
+    with open(source_path, "rb") as source_file, open(target_path, "wb") as target_file:
+        fcntl.ioctl(target_file.fileno(), _FICLONE, source_file.fileno())
+    shutil.copystat(source_path, target_path)
+
+
+def link_file(source_path: Path, target_path: Path, link_mode: str) -> None:
+    # Materialises source_path at target_path with the first of reflink, hardlink and copy that succeeds, starting
+    # from link_mode. Reflinks come first by default as writes to a hardlink show up through every other link too
+    target_path.parent.mkdir(parents=True, exist_ok=True)
+    target_path.unlink(missing_ok=True)
+    for fallback_mode in LINK_MODES[LINK_MODES.index(link_mode) :]:
+        try:
+            match fallback_mode:
+                case "reflink":
+                    reflink_file(source_path, target_path)
+                case "hardlink":
+                    os.link(source_path, target_path)
+                case "copy":
+                    shutil.copy2(source_path, target_path)
+            return
+        except OSError:
+            target_path.unlink(missing_ok=True)
+            if fallback_mode == "copy":
+                raise
+
+
+def link_tree(source_dir: Path, target_dir: Path, link_mode: str) -> None:
+    # Replaces target_dir with a copy of source_dir in which every file is linked with link_file
+    shutil.rmtree(target_dir, ignore_errors=True)
+    for dirpath, dirnames, filenames in source_dir.walk():
+        target_dirpath = target_dir / dirpath.relative_to(source_dir)
+        target_dirpath.mkdir(parents=True, exist_ok=True)
+        for filename in filenames:
+            link_file(dirpath / filename, target_dirpath / filename, link_mode)
@@ -4,13 +4,14 @@ from .context import Context, Contextual, ContextualValidationError
 from concurrent.futures import ThreadPoolExecutor, wait
 from contextlib import nullcontext
 from enum import Enum
-from multiprocessing import Lock
+from multiprocessing import Event, Lock
 from pathlib import Path
 from pydantic import BaseModel, Field, ValidationError
-from time import sleep, time
-from typing import Any, Iterable
+from time import time
+from typing import TYPE_CHECKING, Any, Iterable
 
-import json
+if TYPE_CHECKING:
+    from .metadata_store import MetadataStore
 
 
 class ContextError(Enum):
@@ -24,6 +25,7 @@ class ContextError(Enum):
 class ContextFileType(Enum):
     UNKNOWN = 0
     ARCHIVE = 1
+    REGULAR = 2  # Known not to be an archive
 
 
 class ContextMetadata(BaseModel, validate_assignment=True):
@@ -37,6 +39,30 @@ class ContextMetadata(BaseModel, validate_assignment=True):
         alias="c", default=None
     )  # The metadata key of the archive the file is a member of, or None if not a member of an archive
     remote_hash: str = Field(alias="d", default="")  # From remote storage API
+    remote_size: int | None = Field(
+        alias="e", default=None
+    )  # From remote storage API, used by incremental listings
+    remote_modtime: str | None = Field(
+        alias="f", default=None
+    )  # From remote storage API as printed by rclone lsf, used by incremental listings
+    archive_deleted: bool = Field(
+        alias="g", default=False
+    )  # True once the downloaded archive was deleted after a successful extraction
+    member_size: int | None = Field(
+        alias="h", default=None
+    )  # Uncompressed size of an archive member as listed by 7-Zip
+    member_crc: str | None = Field(
+        alias="i", default=None
+    )  # CRC of an archive member as listed by 7-Zip, used to only extract changed members again
+    local_size: int | None = Field(
+        alias="j", default=None
+    )  # Size of the local output when it was written, used by verification
+    local_mtime_ns: int | None = Field(
+        alias="k", default=None
+    )  # Modification time of the local output in nanoseconds when it was written, used by verification
+    local_inode: int | None = Field(
+        alias="l", default=None
+    )  # Inode of the local output when it was written, used by verification
 
     def __delitem__(self, item: str) -> None:
         delattr(self, item)
@@ -52,8 +78,11 @@ class ContextMetadata(BaseModel, validate_assignment=True):
         return list(dict(cls.model_json_schema(by_alias=False)["properties"]).keys())
 
 
+METADATA_VERSION: str = "1.0"
+
+
 class MetadataDict(BaseModel):
-    version: str = Field(alias="v", default="1.0")
+    version: str = Field(alias="v", default=METADATA_VERSION)
     metadata: dict[Path, ContextMetadata] = Field(alias="m", default_factory=dict)
 
     def __iter__(self) -> Iterable[ContextMetadata]:
@@ -69,21 +98,158 @@ class MetadataDict(BaseModel):
         self.metadata[item] = value
 
 
+class MetadataRecord:
+    """Compact in-memory form of ContextMetadata used by the MetadataManager
+
+    Error codes are kept as a bitmask, the file type as its enum value and the parent key as an
+    interned path id (-1 for None). Plain attributes share their ContextMetadata field name.
+    """
+
+    __slots__ = (
+        "error_bits",
+        "file_type",
+        "parent_id",
+        "remote_hash",
+        "remote_size",
+        "remote_modtime",
+        "archive_deleted",
+        "member_size",
+        "member_crc",
+        "local_size",
+        "local_mtime_ns",
+        "local_inode",
+    )
+
+    def __init__(
+        self,
+        error_bits: int = 0,
+        file_type: int = ContextFileType.UNKNOWN.value,
+        parent_id: int = -1,
+        remote_hash: str = "",
+        remote_size: int | None = None,
+        remote_modtime: str | None = None,
+        archive_deleted: bool = False,
+        member_size: int | None = None,
+        member_crc: str | None = None,
+        local_size: int | None = None,
+        local_mtime_ns: int | None = None,
+        local_inode: int | None = None,
+    ) -> None:
+        self.error_bits = error_bits
+        self.file_type = file_type
+        self.parent_id = parent_id
+        self.remote_hash = remote_hash
+        self.remote_size = remote_size
+        self.remote_modtime = remote_modtime
+        self.archive_deleted = archive_deleted
+        self.member_size = member_size
+        self.member_crc = member_crc
+        self.local_size = local_size
+        self.local_mtime_ns = local_mtime_ns
+        self.local_inode = local_inode
+
+    def copy(self) -> "MetadataRecord":
+        record = MetadataRecord.__new__(MetadataRecord)
+        for slot in MetadataRecord.__slots__:
+            setattr(record, slot, getattr(self, slot))
+        return record
+
+    def get_local_stat(self) -> tuple[int, int, int] | None:
+        if (
+            self.local_size is None
+            or self.local_mtime_ns is None
+            or self.local_inode is None
+        ):
+            return None
+        return (self.local_size, self.local_mtime_ns, self.local_inode)
+
+
+# Types accepted by set_attribute for attributes stored as-is in a MetadataRecord
+_PLAIN_ATTRIBUTE_TYPES: dict[str, type | tuple[type, ...]] = {
+    "remote_hash": str,
+    "remote_size": (int, type(None)),
+    "remote_modtime": (str, type(None)),
+    "archive_deleted": bool,
+    "member_size": (int, type(None)),
+    "member_crc": (str, type(None)),
+    "local_size": (int, type(None)),
+    "local_mtime_ns": (int, type(None)),
+    "local_inode": (int, type(None)),
+}
+_ERROR_CODE_BITS: dict[ContextError, int] = {
+    error_code: 1 << error_code.value for error_code in ContextError
+}
+
+
+class PathInterner:
+    """Maps metadata key strings to small integer ids so each path string is only stored once"""
+
+    def __init__(self) -> None:
+        self._ids = dict[str, int]()
+        self._paths = list[str]()
+        self._create_lock = Lock()  # Listing threads may intern paths too
+
+    def get_id(self, path: Path | str, create: bool = True) -> int:
+        path_str = str(path)
+        path_id = self._ids.get(path_str, -1)
+        if path_id == -1 and create:
+            with self._create_lock:
+                path_id = self._ids.get(path_str, -1)
+                if path_id == -1:
+                    path_id = len(self._paths)
+                    self._paths.append(path_str)
+                    self._ids[path_str] = path_id
+        return path_id
+
+    def get_str(self, path_id: int) -> str:
+        return self._paths[path_id]
+
+    def get_path(self, path_id: int) -> Path:
+        return Path(self._paths[path_id])
+
+
+# Approximate serialised size of an entry excluding its key
+_ESTIMATED_ENTRY_BYTES: int = 64
+
+
 class MetadataManager(Contextual):
     def __init__(
-        self, metadata_file_path: Path, metadata_flush_seconds: int, minimise_json: bool
+        self,
+        metadata_store: "MetadataStore",
+        metadata_flush_seconds: int,
+        metadata_flush_change_threshold: int | None = None,
+        metadata_flush_bytes_threshold: int | None = None,
     ):
         super().__init__()
         self._metadata_lock = Lock()
         self._enable_flush_metadata_process = False
-        self._metadata_file_path = metadata_file_path
+        self._flush_requested = Event()
+        self._metadata_store = metadata_store
         self._metadata_flush_seconds = metadata_flush_seconds
-        self._minimise_json = minimise_json
-        if metadata_file_path.is_file():
-            with open(metadata_file_path, "r") as metadata_file:
-                self._metadata = MetadataDict.model_validate_json(metadata_file.read())
-        else:
-            self._metadata = MetadataDict()
+        self._metadata_flush_change_threshold = metadata_flush_change_threshold
+        self._metadata_flush_bytes_threshold = metadata_flush_bytes_threshold
+        self._paths = PathInterner()
+        self._records = dict[int, MetadataRecord]()
+        self._children_index = dict[int, set[int]]()
+        # Classifications of previously seen content, so files with a known remote hash are never tested again
+        self._file_types_by_remote_hash = dict[str, int]()
+        self._changed_ids = set[int]()  # Entries added or modified since the last flush
+        self._deleted_ids = set[int]()  # Entries deleted since the last flush
+        # For lazy stores: ids whose state is known in memory and must not be read from the store again
+        self._resolved_ids = set[int]()
+        self._children_loaded_ids = set[int]()
+        # Guards promotion of lazy entries, which listing threads may trigger alongside the main thread
+        self._lazy_records_lock = Lock()
+        self._pending_changes = 0
+        self._pending_bytes = 0
+        with self._metadata_lock:
+            for metadata_key, context_metadata in metadata_store.load():
+                metadata_id = self._paths.get_id(metadata_key)
+                record = self.record_from_model(context_metadata)
+                self._records[metadata_id] = record
+                self.add_to_children_index(metadata_id, record.parent_id)
+                self.add_to_file_type_index(record)
+        if not metadata_store.exists():
             self.flush_metadata()
 
     @staticmethod
@@ -92,22 +258,204 @@ class MetadataManager(Contextual):
 
     @staticmethod
     def attribute_name_exists(attribute_name: str) -> bool:
-        return attribute_name in ContextMetadata.get_attribute_names()
+        return attribute_name in ContextMetadata.model_fields
 
-    def get_metadata_key(self) -> str:
+    def record_from_model(self, context_metadata: ContextMetadata) -> MetadataRecord:
+        record = MetadataRecord()
+        for attribute_name in ContextMetadata.model_fields:
+            self.set_record_attribute(
+                record, attribute_name, context_metadata[attribute_name]
+            )
+        return record
+
+    def model_from_record(self, record: MetadataRecord) -> ContextMetadata:
+        # Records are only ever populated with validated values, so skip validation here
+        return ContextMetadata.model_construct(
+            **{
+                attribute_name: self.get_record_attribute(record, attribute_name)
+                for attribute_name in ContextMetadata.model_fields
+            }
+        )
+
+    def get_record_attribute(self, record: MetadataRecord, attribute_name: str) -> Any:
+        match attribute_name:
+            case "error_codes":
+                return {
+                    error_code
+                    for error_code, bit in _ERROR_CODE_BITS.items()
+                    if record.error_bits & bit
+                }
+            case "file_type":
+                return ContextFileType(record.file_type)
+            case "parent_key":
+                if record.parent_id == -1:
+                    return None
+                return self._paths.get_path(record.parent_id)
+            case _:
+                return getattr(record, attribute_name)
+
+    def set_record_attribute(
+        self, record: MetadataRecord, attribute_name: str, attribute_value: Any
+    ) -> None:
+        # Lightweight type checks take the place of pydantic validation for in-memory updates
+        match attribute_name:
+            case "error_codes":
+                if not isinstance(
+                    attribute_value, (set, frozenset, list, tuple)
+                ) or any(
+                    not isinstance(error_code, ContextError)
+                    for error_code in attribute_value
+                ):
+                    raise InvalidMetadataSubmissionError(
+                        attribute_name, attribute_value
+                    )
+                error_bits = 0
+                for error_code in attribute_value:
+                    error_bits |= _ERROR_CODE_BITS[error_code]
+                record.error_bits = error_bits
+            case "file_type":
+                if not isinstance(attribute_value, ContextFileType):
+                    raise InvalidMetadataSubmissionError(
+                        attribute_name, attribute_value
+                    )
+                record.file_type = attribute_value.value
+            case "parent_key":
+                if attribute_value is None:
+                    record.parent_id = -1
+                elif isinstance(attribute_value, (Path, str)):
+                    record.parent_id = self._paths.get_id(attribute_value)
+                else:
+                    raise InvalidMetadataSubmissionError(
+                        attribute_name, attribute_value
+                    )
+            case _:
+                if not isinstance(
+                    attribute_value, _PLAIN_ATTRIBUTE_TYPES[attribute_name]
+                ):
+                    raise InvalidMetadataSubmissionError(
+                        attribute_name, attribute_value
+                    )
+                setattr(record, attribute_name, attribute_value)
+
+    def get_metadata_key(self) -> Path:
         self.raise_exception_if_context_not_set()
         return self.context.as_path(include_source=True)
 
+    def get_metadata_id(self, create: bool = False) -> int:
+        return self._paths.get_id(self.get_metadata_key(), create)
+
+    def get_record(self) -> MetadataRecord | None:
+        record = self._records.get(self.get_metadata_id())
+        if record is None and self._metadata_store.lazy:
+            record = self.load_lazy_record(self.get_metadata_key())
+        return record
+
+    def load_lazy_record(self, metadata_key: Path | str) -> MetadataRecord | None:
+        # Decodes a single entry from a lazy store the first time it is touched
+        metadata_id = self._paths.get_id(metadata_key)
+        with self._lazy_records_lock:
+            if metadata_id in self._records:
+                return self._records[metadata_id]
+            if metadata_id in self._resolved_ids:
+                return None
+            self._resolved_ids.add(metadata_id)
+            context_metadata = self._metadata_store.lookup(str(metadata_key))
+            if context_metadata is None:
+                return None
+            record = self.record_from_model(context_metadata)
+            self._records[metadata_id] = record
+            self.add_to_children_index(metadata_id, record.parent_id)
+            self.add_to_file_type_index(record)
+            return record
+
+    def load_lazy_children(self, metadata_id: int) -> None:
+        if self._metadata_store.lazy and metadata_id not in self._children_loaded_ids:
+            self._children_loaded_ids.add(metadata_id)
+            for member_key in self._metadata_store.lookup_children(
+                self._paths.get_str(metadata_id)
+            ):
+                self.load_lazy_record(member_key)
+
     def initialize_metadata(self, use_lock: bool = True) -> None:
         self.raise_exception_if_context_not_set()
         with self._metadata_lock if use_lock else nullcontext():
-            self._metadata[self.get_metadata_key()] = self.get_initialized_metadata()
+            self.replace_record(self.get_metadata_id(create=True), MetadataRecord())
 
     def delete_metadata(self, use_lock: bool = True) -> None:
         self.raise_exception_if_context_not_set()
         with self._metadata_lock if use_lock else nullcontext():
             if self.metadata_exists():
-                del self._metadata[self.get_metadata_key()]
+                self.replace_record(self.get_metadata_id(), None)
+
+    def replace_record(self, metadata_id: int, record: MetadataRecord | None) -> None:
+        # All additions, replacements and deletions of entries go through here to keep the children index consistent
+        with self._lazy_records_lock:
+            self._resolved_ids.add(metadata_id)
+            if metadata_id in self._records:
+                self.remove_from_children_index(
+                    metadata_id, self._records[metadata_id].parent_id
+                )
+            if record is None:
+                del self._records[metadata_id]
+                self._changed_ids.discard(metadata_id)
+                self._deleted_ids.add(metadata_id)
+            else:
+                self._records[metadata_id] = record
+                self.add_to_children_index(metadata_id, record.parent_id)
+                self.add_to_file_type_index(record)
+                self._deleted_ids.discard(metadata_id)
+                self._changed_ids.add(metadata_id)
+        self.register_change(metadata_id)
+
+    def register_change(self, metadata_id: int) -> None:
+        self._pending_changes += 1
+        self._pending_bytes += (
+            len(self._paths.get_str(metadata_id)) + _ESTIMATED_ENTRY_BYTES
+        )
+        if (
+            self._metadata_flush_change_threshold is not None
+            and self._pending_changes >= self._metadata_flush_change_threshold
+        ) or (
+            self._metadata_flush_bytes_threshold is not None
+            and self._pending_bytes >= self._metadata_flush_bytes_threshold
+        ):
+            self._flush_requested.set()  # Wake the flush loop early
+
+    def add_to_children_index(self, metadata_id: int, parent_id: int) -> None:
+        if parent_id != -1:
+            self._children_index.setdefault(parent_id, set[int]()).add(metadata_id)
+
+    def remove_from_children_index(self, metadata_id: int, parent_id: int) -> None:
+        if parent_id != -1 and parent_id in self._children_index:
+            children = self._children_index[parent_id]
+            children.discard(metadata_id)
+            if len(children) == 0:
+                del self._children_index[parent_id]
+
+    def add_to_file_type_index(self, record: MetadataRecord) -> None:
+        if (
+            record.remote_hash != ""
+            and record.file_type != ContextFileType.UNKNOWN.value
+        ):
+            self._file_types_by_remote_hash[record.remote_hash] = record.file_type
+
+    def get_file_type_for_remote_hash(self, remote_hash: str) -> ContextFileType:
+        # Only records touched so far are indexed for lazy stores, so they are asked for hashes not seen yet
+        if remote_hash == "":
+            return ContextFileType.UNKNOWN
+        if (
+            remote_hash not in self._file_types_by_remote_hash
+            and self._metadata_store.lazy
+        ):
+            file_type = self._metadata_store.lookup_file_type(remote_hash)
+            if file_type != ContextFileType.UNKNOWN:
+                self._file_types_by_remote_hash[remote_hash] = file_type.value
+            return file_type
+        return ContextFileType(
+            self._file_types_by_remote_hash.get(
+                remote_hash, ContextFileType.UNKNOWN.value
+            )
+        )
 
     def get_attribute(self, attribute_name: str) -> Any:
         self.raise_exception_if_context_not_set()
@@ -116,7 +464,7 @@ class MetadataManager(Contextual):
                 attribute_name, f"Metadata requested for invalid key: {attribute_name}"
             )
         self.raise_exception_if_no_metadata()
-        return self._metadata[self.get_metadata_key()][attribute_name]
+        return self.get_record_attribute(self.get_record(), attribute_name)
 
     def set_attribute(
         self, attribute_name: str, attribute_value: Any, use_lock: bool = True
@@ -124,20 +472,23 @@ class MetadataManager(Contextual):
         self.raise_exception_if_context_not_set()
         if not self.attribute_name_exists(attribute_name):
             raise InvalidMetadataSubmissionError(
-                attribute_name, f"Metadata submitted for invalid key: {attribute_name}"
+                attribute_name,
+                attribute_value,
+                f"Metadata submitted for invalid key: {attribute_name}",
             )
         with self._metadata_lock if use_lock else nullcontext():
             if not self.metadata_exists():
                 self.initialize_metadata(use_lock=False)
-            cve = None
-            try:
-                self._metadata[self.get_metadata_key()][
-                    attribute_name
-                ] = attribute_value
-            except ValidationError as ve:
-                cve = ContextualValidationError(self.get_context(), ve)
-            if cve is not None:
-                raise cve
+            metadata_id = self.get_metadata_id()
+            record = self._records[metadata_id]
+            previous_parent_id = record.parent_id
+            self.set_record_attribute(record, attribute_name, attribute_value)
+            self.add_to_file_type_index(record)
+            self._changed_ids.add(metadata_id)
+            self.register_change(metadata_id)
+            if record.parent_id != previous_parent_id:
+                self.remove_from_children_index(metadata_id, previous_parent_id)
+                self.add_to_children_index(metadata_id, record.parent_id)
 
     def get_error_codes(self) -> set[ContextError]:
         return self.get_attribute("error_codes")
@@ -175,6 +526,54 @@ class MetadataManager(Contextual):
     def set_remote_hash(self, remote_hash: str, use_lock: bool = True) -> None:
         self.set_attribute("remote_hash", remote_hash, use_lock)
 
+    def get_remote_size(self) -> int | None:
+        return self.get_attribute("remote_size")
+
+    def set_remote_size(self, remote_size: int | None, use_lock: bool = True) -> None:
+        self.set_attribute("remote_size", remote_size, use_lock)
+
+    def get_remote_modtime(self) -> str | None:
+        return self.get_attribute("remote_modtime")
+
+    def set_remote_modtime(
+        self, remote_modtime: str | None, use_lock: bool = True
+    ) -> None:
+        self.set_attribute("remote_modtime", remote_modtime, use_lock)
+
+    def get_archive_deleted(self) -> bool:
+        return self.get_attribute("archive_deleted")
+
+    def set_archive_deleted(self, archive_deleted: bool, use_lock: bool = True) -> None:
+        self.set_attribute("archive_deleted", archive_deleted, use_lock)
+
+    def get_member_size(self) -> int | None:
+        return self.get_attribute("member_size")
+
+    def set_member_size(self, member_size: int | None, use_lock: bool = True) -> None:
+        self.set_attribute("member_size", member_size, use_lock)
+
+    def get_member_crc(self) -> str | None:
+        return self.get_attribute("member_crc")
+
+    def set_member_crc(self, member_crc: str | None, use_lock: bool = True) -> None:
+        self.set_attribute("member_crc", member_crc, use_lock)
+
+    def get_local_stat(self) -> tuple[int, int, int] | None:
+        # Size, modification time in nanoseconds and inode recorded for the local output, if any
+        record = self.get_record()
+        return record.get_local_stat() if record is not None else None
+
+    def set_local_stat(
+        self, local_stat: tuple[int, int, int] | None, use_lock: bool = True
+    ) -> None:
+        local_size, local_mtime_ns, local_inode = (
+            (None, None, None) if local_stat is None else local_stat
+        )
+        with self._metadata_lock if use_lock else nullcontext():
+            self.set_attribute("local_size", local_size, use_lock=False)
+            self.set_attribute("local_mtime_ns", local_mtime_ns, use_lock=False)
+            self.set_attribute("local_inode", local_inode, use_lock=False)
+
     def get_parent_key(self) -> Path:
         return self.get_attribute("parent_key")
 
@@ -184,7 +583,7 @@ class MetadataManager(Contextual):
     def get_metadata(self) -> ContextMetadata:
         self.raise_exception_if_context_not_set()
         self.raise_exception_if_no_metadata()
-        return self._metadata[self.get_metadata_key()].model_copy()
+        return self.model_from_record(self.get_record())
 
     def set_metadata(
         self, metadata: ContextMetadata | dict, use_lock: bool = True
@@ -194,7 +593,10 @@ class MetadataManager(Contextual):
             cve = None
             try:
                 new_metadata = ContextMetadata.model_validate(metadata)
-                self._metadata[self.get_metadata_key()] = new_metadata
+                self.replace_record(
+                    self.get_metadata_id(create=True),
+                    self.record_from_model(new_metadata),
+                )
             except ValidationError as ve:
                 cve = ContextualValidationError(self.get_context(), ve)
             if cve is not None:
@@ -202,12 +604,26 @@ class MetadataManager(Contextual):
 
     def metadata_exists(self) -> bool:
         self.raise_exception_if_context_not_set()
-        return self.get_metadata_key() in self._metadata.metadata
+        return self.get_record() is not None
 
     def error_exists(self) -> bool:
         self.raise_exception_if_context_not_set()
         self.raise_exception_if_no_metadata()
-        return len(self._metadata[self.get_metadata_key()].error_codes) > 0
+        return self.get_record().error_bits != 0
+
+    def is_remote_file_unchanged(
+        self, metadata_key: Path, remote_size: int, remote_modtime: str
+    ) -> bool:
+        # Does not use the manager's context, so listing threads can call this while the main thread works
+        record = self._records.get(self._paths.get_id(metadata_key, create=False))
+        if record is None and self._metadata_store.lazy:
+            record = self.load_lazy_record(metadata_key)
+        return (
+            record is not None
+            and record.error_bits == 0
+            and record.remote_size == remote_size
+            and record.remote_modtime == remote_modtime
+        )
 
     def is_archive_member(self) -> bool:
         return self.get_parent_key() is not None
@@ -221,38 +637,145 @@ class MetadataManager(Contextual):
         else:
             return None
 
+    def get_archive_member_keys(self) -> list[Path]:
+        metadata_id = self.get_metadata_id(create=True)
+        self.load_lazy_children(metadata_id)
+        return [
+            self._paths.get_path(member_id)
+            for member_id in self._children_index.get(metadata_id, ())
+        ]
+
     def get_archive_member_contexts(self) -> list[Context]:
-        current_metadata_key = self.get_metadata_key()
-        results = []
-        for metadata_key, context_metadata in self._metadata.metadata.items():
-            if context_metadata.parent_key == current_metadata_key:
-                results.append(Context.from_path(metadata_key))
-        return results
+        return [
+            Context.from_path(metadata_key)
+            for metadata_key in self.get_archive_member_keys()
+        ]
+
+    def get_archive_member_info(self) -> dict[Path, tuple[int | None, str | None]]:
+        # Size and CRC of each direct member, keyed by its file path within the source
+        self.raise_exception_if_context_not_set()
+        member_info = dict[Path, tuple[int | None, str | None]]()
+        for member_key in self.get_archive_member_keys():
+            record = self._records.get(self._paths.get_id(member_key))
+            if record is not None:
+                member_info[Path(*member_key.parts[1:])] = (
+                    record.member_size,
+                    record.member_crc,
+                )
+        return member_info
+
+    def get_archive_member_local_stats(self) -> dict[Path, tuple[int, int, int]]:
+        # Recorded stats of the local output of each direct member that has them, keyed by its file path within the
+        # source. Members extracted as nested archives have no local output of their own
+        self.raise_exception_if_context_not_set()
+        member_local_stats = dict[Path, tuple[int, int, int]]()
+        for member_key in self.get_archive_member_keys():
+            record = self._records.get(self._paths.get_id(member_key))
+            if record is not None and record.get_local_stat() is not None:
+                member_local_stats[Path(*member_key.parts[1:])] = (
+                    record.get_local_stat()
+                )
+        return member_local_stats
+
+    def set_archive_member_info(
+        self,
+        member_info: dict[Path, tuple[int, str]],
+        local_stats: dict[Path, tuple[int, int, int] | None] | None = None,
+        use_lock: bool = True,
+    ) -> None:
+        # Adds or replaces a member entry for each file path within the source, with the current context as parent
+        self.raise_exception_if_context_not_set()
+        with self._metadata_lock if use_lock else nullcontext():
+            parent_id = self.get_metadata_id(create=True)
+            for member_file_path, (member_size, member_crc) in member_info.items():
+                local_stat = (
+                    None if local_stats is None else local_stats.get(member_file_path)
+                )
+                local_size, local_mtime_ns, local_inode = (
+                    (None, None, None) if local_stat is None else local_stat
+                )
+                self.replace_record(
+                    self._paths.get_id(
+                        Path(self.context.source_name, member_file_path)
+                    ),
+                    MetadataRecord(
+                        parent_id=parent_id,
+                        member_size=member_size,
+                        member_crc=member_crc,
+                        local_size=local_size,
+                        local_mtime_ns=local_mtime_ns,
+                        local_inode=local_inode,
+                    ),
+                )
+
+    def clear_archive_member_local_stat(
+        self, member_file_path: Path, use_lock: bool = True
+    ) -> None:
+        # For members whose local output was removed on purpose, such as nested archives after their extraction
+        self.raise_exception_if_context_not_set()
+        with self._metadata_lock if use_lock else nullcontext():
+            member_id = self._paths.get_id(
+                Path(self.context.source_name, member_file_path), create=False
+            )
+            record = self._records.get(member_id)
+            if record is not None and record.parent_id == self.get_metadata_id():
+                record.local_size = None
+                record.local_mtime_ns = None
+                record.local_inode = None
+                self._changed_ids.add(member_id)
+                self.register_change(member_id)
 
     def delete_archive_members_metadata(self, use_lock: bool = True) -> None:
         self.raise_exception_if_context_not_set()
-        context = self.get_context()
         with self._metadata_lock if use_lock else nullcontext():
             if self.is_archive():
-                for member_context in self.get_archive_member_contexts():
-                    self.set_context(member_context)
-                    self.delete_archive_members_metadata(use_lock=False)  # Recurse
-                    self.delete_metadata(use_lock=False)
-            self.set_context(context)
+                # Walk the subtree through the children index rather than scanning all metadata
+                metadata_id = self.get_metadata_id(create=True)
+                self.load_lazy_children(metadata_id)
+                pending_ids = list(self._children_index.get(metadata_id, ()))
+                while len(pending_ids) > 0:
+                    member_id = pending_ids.pop()
+                    self.load_lazy_children(member_id)
+                    pending_ids.extend(self._children_index.get(member_id, ()))
+                    if member_id in self._records:
+                        self.replace_record(member_id, None)
 
     def flush_metadata(self, use_lock: bool = True) -> None:
         with self._metadata_lock if use_lock else nullcontext():
-            metadata = self._metadata.model_copy()
-        with open(self._metadata_file_path, "w") as metadata_file:
-            metadata_file.write(
-                json.dumps(
-                    metadata.model_dump(
-                        mode="json", by_alias=self._minimise_json, exclude_none=True
-                    ),
-                    indent=(2 if not self._minimise_json else None),
-                    separators=((",", ":") if self._minimise_json else None),
-                )
+            if (
+                len(self._changed_ids) == 0
+                and len(self._deleted_ids) == 0
+                and self._metadata_store.exists()
+            ):
+                return  # Nothing to write
+            # Only the changed records are copied while holding the lock, so writers are not blocked by serialisation
+            changed_ids, self._changed_ids = self._changed_ids, set[int]()
+            deleted_ids, self._deleted_ids = self._deleted_ids, set[int]()
+            changed_records = {
+                metadata_id: self._records[metadata_id].copy()
+                for metadata_id in changed_ids
+            }
+            self._pending_changes = 0
+            self._pending_bytes = 0
+            self._flush_requested.clear()
+        try:
+            self._metadata_store.flush(
+                METADATA_VERSION,
+                {
+                    self._paths.get_str(metadata_id): self.model_from_record(record)
+                    for metadata_id, record in changed_records.items()
+                },
+                {self._paths.get_str(metadata_id) for metadata_id in deleted_ids},
             )
+        except Exception:
+            # Keep the entries dirty so the next flush retries them
+            with self._metadata_lock if use_lock else nullcontext():
+                self._changed_ids.update(changed_ids - self._deleted_ids)
+                self._deleted_ids.update(deleted_ids - self._changed_ids)
+            raise
+
+    def close_metadata_store(self) -> None:
+        self._metadata_store.close()
 
     def start_flush_metadata_process(self) -> None:
         if not self._enable_flush_metadata_process:
@@ -265,6 +788,7 @@ class MetadataManager(Contextual):
     def stop_flush_metadata_process(self) -> None:
         if self._enable_flush_metadata_process:
             self._enable_flush_metadata_process = False
+            self._flush_requested.set()
             wait([self._flush_metadata_proc_future])
             self._flush_metadata_proc_pool.shutdown(wait=True, cancel_futures=False)
             self._flush_metadata_proc_pool = None
@@ -273,15 +797,21 @@ class MetadataManager(Contextual):
     def flush_metadata_loop(self) -> None:
         start = time() - self._metadata_flush_seconds  # Don't wait for first cycle
         while self._enable_flush_metadata_process:
-            # Loop often and check time since last flush to allow faster exiting
-            if self._metadata_flush_seconds - (time() - start) <= 0:
+            # Flush on the timer, or earlier once enough changes have accumulated
+            if (
+                self._metadata_flush_seconds - (time() - start) <= 0
+                or self._flush_requested.is_set()
+            ):
                 start = time()
                 self.flush_metadata()
-            sleep(5)
+            self._flush_requested.wait(
+                max(0, min(5, self._metadata_flush_seconds - (time() - start)))
+            )
 
     def raise_exception_if_no_metadata(self) -> None:
         if not self.metadata_exists():
-            raise NoMetadataError()
+            context = self.get_context()
+            raise NoMetadataError(context.source_name, context.file_path)
 
 
 class InvalidMetadataFetchError(Exception):
@@ -0,0 +1,886 @@
+from .helpers import *
+from .metadata import METADATA_VERSION, ContextFileType, ContextMetadata
+
+from abc import ABC, abstractmethod
+from heapq import merge
+from multiprocessing import Lock
+from pathlib import Path
+from typing import Iterator
+
+import json
+import mmap
+import os
+import sqlite3
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class MetadataStore(ABC):
+    """Base class for the persistent storage backends used by the MetadataManager
+
+    Backends only receive the entries that changed since the previous flush, and are expected to
+    leave previously flushed metadata intact if a flush fails part-way.
+
+    Lazy backends yield nothing from load and instead answer lookup and lookup_children for the
+    entries the manager actually touches.
+    """
+
+    lazy: bool = False
+    _legacy_json_file_path: Path | None = None
+
+    @abstractmethod
+    def exists(self) -> bool:
+        pass
+
+    @abstractmethod
+    def load(self) -> Iterator[tuple[str, ContextMetadata]]:
+        # Yields (metadata key, validated metadata) pairs so callers can convert entries one at a time
+        pass
+
+    @abstractmethod
+    def lookup(self, metadata_key: str) -> ContextMetadata | None:
+        pass
+
+    @abstractmethod
+    def lookup_children(self, parent_key: str) -> list[str]:
+        pass
+
+    def lookup_file_type(self, remote_hash: str) -> ContextFileType:
+        # Only asked by the manager of lazy backends, as it indexes every entry of the others when they are loaded
+        return ContextFileType.UNKNOWN
+
+    def migrate_legacy_json(self) -> None:
+        # One-shot import of a v1.0 metadata.json, which is renamed with a .migrated suffix afterwards
+        if self._legacy_json_file_path is None:
+            return
+        legacy_store = JsonMetadataStore(self._legacy_json_file_path, True)
+        if not legacy_store.exists():
+            return
+        self.flush(METADATA_VERSION, dict(legacy_store.load()), set())
+        self._legacy_json_file_path.rename(
+            self._legacy_json_file_path.with_name(
+                f"{self._legacy_json_file_path.name}.migrated"
+            )
+        )
+
+    @abstractmethod
+    def flush(
+        self,
+        version: str,
+        changed_entries: dict[str, ContextMetadata],
+        deleted_keys: set[str],
+    ) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class JsonMetadataStore(MetadataStore):
+    """JSON backend that keeps each entry serialised between flushes
+
+    Only changed entries are serialised again on a flush. The file is written to a temporary file
+    next to it and then atomically renamed over the previous version.
+    """
+
+    def __init__(self, metadata_file_path: Path, minimise_json: bool) -> None:
+        self._metadata_file_path = metadata_file_path
+        self._minimise_json = minimise_json
+        self._flush_lock = Lock()
+        self._serialized_entries = dict[str, str]()
+
+    def exists(self) -> bool:
+        return self._metadata_file_path.is_file()
+
+    def load(self) -> Iterator[tuple[str, ContextMetadata]]:
+        if not self.exists():
+            return
+        with open(self._metadata_file_path, "r") as metadata_file:
+            raw_metadata = json.load(metadata_file)
+        version = raw_metadata.get("v" if self._minimise_json else "version")
+        if version != METADATA_VERSION:
+            raise MetadataStoreError(
+                f"Unsupported metadata version in {safe_str(self._metadata_file_path)}: {safe_str(version)}"
+            )
+        raw_entries = raw_metadata.get("m" if self._minimise_json else "metadata", {})
+        with self._flush_lock:
+            self._serialized_entries = dict[str, str]()
+            for metadata_key, raw_entry in raw_entries.items():
+                metadata_key = str(Path(metadata_key))
+                self._serialized_entries[metadata_key] = self.serialize_entry(raw_entry)
+                yield metadata_key, self.validate_entry(raw_entry)
+
+    def lookup(self, metadata_key: str) -> ContextMetadata | None:
+        with self._flush_lock:
+            serialized_entry = self._serialized_entries.get(metadata_key)
+        if serialized_entry is None:
+            return None
+        return self.validate_entry(json.loads(serialized_entry))
+
+    def lookup_children(self, parent_key: str) -> list[str]:
+        # Scans every entry, as this backend is not lazy and keeps no children index
+        parent_key_field = "c" if self._minimise_json else "parent_key"
+        with self._flush_lock:
+            serialized_entries = list(self._serialized_entries.items())
+        children = list[str]()
+        for metadata_key, serialized_entry in serialized_entries:
+            entry_parent_key = json.loads(serialized_entry).get(parent_key_field)
+            if entry_parent_key is not None and str(Path(entry_parent_key)) == (
+                parent_key
+            ):
+                children.append(metadata_key)
+        return children
+
+    def validate_entry(self, raw_entry: dict) -> ContextMetadata:
+        # Entries are written with field names rather than aliases unless the JSON is minimised
+        return ContextMetadata.model_validate(
+            raw_entry, by_alias=self._minimise_json, by_name=not self._minimise_json
+        )
+
+    def serialize_entry(self, raw_entry: dict) -> str:
+        if self._minimise_json:
+            return json.dumps(raw_entry, separators=(",", ":"))
+        else:
+            return json.dumps(raw_entry, indent=2).replace("\n", "\n    ")
+
+    def flush(
+        self,
+        version: str,
+        changed_entries: dict[str, ContextMetadata],
+        deleted_keys: set[str],
+    ) -> None:
+        with self._flush_lock:
+            for metadata_key in deleted_keys:
+                self._serialized_entries.pop(metadata_key, None)
+            for metadata_key, context_metadata in changed_entries.items():
+                self._serialized_entries[metadata_key] = self.serialize_entry(
+                    context_metadata.model_dump(
+                        mode="json", by_alias=self._minimise_json, exclude_none=True
+                    )
+                )
+            temp_file_path = self._metadata_file_path.with_name(
+                f"{self._metadata_file_path.name}.tmp"
+            )
+            with open(temp_file_path, "w") as metadata_file:
+                if self._minimise_json:
+                    metadata_file.write(f'{{"v":{json.dumps(version)},"m":{{')
+                    metadata_file.write(
+                        ",".join(
+                            f"{json.dumps(metadata_key)}:{serialized_entry}"
+                            for metadata_key, serialized_entry in self._serialized_entries.items()
+                        )
+                    )
+                    metadata_file.write("}}")
+                else:
+                    metadata_file.write(
+                        f'{{\n  "version": {json.dumps(version)},\n  "metadata": {{'
+                    )
+                    metadata_file.write(
+                        ",".join(
+                            f"\n    {json.dumps(metadata_key)}: {serialized_entry}"
+                            for metadata_key, serialized_entry in self._serialized_entries.items()
+                        )
+                    )
+                    metadata_file.write("\n  }\n}")
+                metadata_file.flush()
+                os.fsync(metadata_file.fileno())
+            os.replace(temp_file_path, self._metadata_file_path)
+
+
+class SqliteMetadataStore(MetadataStore):
+    """SQLite backend that upserts only the entries changed since the previous flush
+
+    If the database does not exist yet and a v1.0 JSON metadata file is given, its entries are
+    migrated into the database once and the JSON file is renamed with a .migrated suffix.
+    """
+
+    def __init__(
+        self, database_file_path: Path, legacy_json_file_path: Path | None = None
+    ) -> None:
+        self._database_file_path = database_file_path
+        self._legacy_json_file_path = legacy_json_file_path
+        self._connection_lock = Lock()
+        self._existed = database_file_path.is_file()
+        self._connection = sqlite3.connect(
+            database_file_path, check_same_thread=False, isolation_level=None
+        )  # Access is serialised by _connection_lock
+        with self._connection_lock:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS info (name TEXT PRIMARY KEY, value TEXT NOT NULL)"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, parent_key TEXT, data TEXT NOT NULL)"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS metadata_parent_key ON metadata (parent_key)"
+            )
+
+    def exists(self) -> bool:
+        return self._existed
+
+    def load(self) -> Iterator[tuple[str, ContextMetadata]]:
+        if not self._existed:
+            self.migrate_legacy_json()
+        with self._connection_lock:
+            version = self._connection.execute(
+                "SELECT value FROM info WHERE name = 'version'"
+            ).fetchone()
+            if version is not None and version[0] != METADATA_VERSION:
+                raise MetadataStoreError(
+                    f"Unsupported metadata version in {safe_str(self._database_file_path)}: {safe_str(version[0])}"
+                )
+            rows = self._connection.execute("SELECT key, data FROM metadata")
+            while len(batch := rows.fetchmany(10000)) > 0:
+                for metadata_key, data in batch:
+                    yield metadata_key, ContextMetadata.model_validate_json(data)
+
+    def lookup(self, metadata_key: str) -> ContextMetadata | None:
+        with self._connection_lock:
+            row = self._connection.execute(
+                "SELECT data FROM metadata WHERE key = ?", (metadata_key,)
+            ).fetchone()
+        if row is None:
+            return None
+        return ContextMetadata.model_validate_json(row[0])
+
+    def lookup_children(self, parent_key: str) -> list[str]:
+        with self._connection_lock:
+            rows = self._connection.execute(
+                "SELECT key FROM metadata WHERE parent_key = ? ORDER BY key",
+                (parent_key,),
+            ).fetchall()
+        return [metadata_key for (metadata_key,) in rows]
+
+    def flush(
+        self,
+        version: str,
+        changed_entries: dict[str, ContextMetadata],
+        deleted_keys: set[str],
+    ) -> None:
+        rows = [
+            (
+                key,
+                (
+                    str(context_metadata.parent_key)
+                    if context_metadata.parent_key is not None
+                    else None
+                ),
+                context_metadata.model_dump_json(by_alias=True, exclude_none=True),
+            )
+            for key, context_metadata in changed_entries.items()
+        ]
+        with self._connection_lock:
+            self._connection.execute("BEGIN")
+            try:
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO info (name, value) VALUES ('version', ?)",
+                    (version,),
+                )
+                self._connection.executemany(
+                    "DELETE FROM metadata WHERE key = ?",
+                    [(key,) for key in deleted_keys],
+                )
+                self._connection.executemany(
+                    "INSERT INTO metadata (key, parent_key, data) VALUES (?, ?, ?) "
+                    "ON CONFLICT (key) DO UPDATE SET parent_key = excluded.parent_key, data = excluded.data",
+                    rows,
+                )
+                self._connection.execute("COMMIT")
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+        self._existed = True
+
+    def close(self) -> None:
+        with self._connection_lock:
+            self._connection.close()
+
+
+# Header: magic, format version, flags, metadata version, entry count, key index offset, children index offset,
+# file type index offset
+_BINARY_HEADER = struct.Struct("<4sHH8sQQQQ")
+_BINARY_MAGIC = b"SHMD"
+_BINARY_FORMAT_VERSION = 2
+_BINARY_FLAG_MSGPACK = 0x1
+# Key index entry: key offset, key length, payload offset, payload length
+_BINARY_KEY_ENTRY = struct.Struct("<QIQI")
+# Children index entry: parent key offset, parent key length, child entry number
+_BINARY_CHILD_ENTRY = struct.Struct("<QII")
+# File type index entry: remote hash offset, remote hash length, entry number, file type
+_BINARY_FILE_TYPE_ENTRY = struct.Struct("<QIIB")
+# Delta header: magic, format version, flags, metadata version
+_BINARY_DELTA_HEADER = struct.Struct("<4sHH8s")
+_BINARY_DELTA_MAGIC = b"SHMd"
+# Delta record: key length, parent key length, payload length, followed by the key, parent key and payload
+_BINARY_DELTA_RECORD = struct.Struct("<III")
+_BINARY_DELTA_NONE = 0xFFFFFFFF  # Parent key length of an entry without a parent, payload length of a deletion
+_BINARY_COMPACT_MIN_ENTRIES = 4096
+_BINARY_COMPACT_RATIO = 8  # The delta is compacted once it holds more entries than this fraction of the main file
+
+
+class BinaryMetadataStore(MetadataStore):
+    """Compact binary backend that is memory-mapped and decoded one entry at a time
+
+    Entries are stored sorted by key with a fixed-width key index, plus a children index sorted by
+    parent key and a file type index sorted by remote hash, so all lookups are binary searches over
+    the mapped file. Payloads are the same
+    aliased entries as metadata.json, encoded with msgpack when it is installed and JSON otherwise.
+    Flushes append the changed and deleted entries to a delta file next to it, which lookups consult
+    first. The delta is compacted into a new main file that atomically replaces the old one once it
+    grows past a fraction of the main file, and on close. Replaying a delta is idempotent, so one
+    left behind by a crash during compaction is still correct.
+    """
+
+    lazy = True
+
+    def __init__(
+        self, metadata_file_path: Path, legacy_json_file_path: Path | None = None
+    ) -> None:
+        self._metadata_file_path = metadata_file_path
+        self._delta_file_path = metadata_file_path.with_name(
+            f"{metadata_file_path.name}.delta"
+        )
+        self._legacy_json_file_path = legacy_json_file_path
+        self._flush_lock = Lock()
+        self._mmap_lock = Lock()
+        self._file = None
+        self._mmap = None
+        self._entry_count = 0
+        self._version = METADATA_VERSION
+        # Delta entries by key as (parent key, payload, (remote hash, file type)), with a payload of None for
+        # deleted entries
+        self._delta_entries = dict[
+            bytes,
+            tuple[bytes | None, bytes | None, tuple[bytes, int] | None],
+        ]()
+        self._delta_children = dict[bytes, set[bytes]]()
+        self._delta_file_types = dict[bytes, int]()
+        self._delta_flags = self.get_encoding_flags()
+        self._delta_length = (
+            0  # Length of the delta file up to its last complete record
+        )
+        self.open_mmap()
+        self.open_delta()
+
+    def exists(self) -> bool:
+        return self._metadata_file_path.is_file() or self._delta_file_path.is_file()
+
+    def open_mmap(self) -> None:
+        if (
+            not self._metadata_file_path.is_file()
+            or self._metadata_file_path.stat().st_size == 0
+        ):
+            return
+        self._file = open(self._metadata_file_path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        (
+            magic,
+            format_version,
+            flags,
+            version,
+            entry_count,
+            index_offset,
+            children_offset,
+            file_types_offset,
+        ) = _BINARY_HEADER.unpack_from(self._mmap, 0)
+        if magic != _BINARY_MAGIC or format_version != _BINARY_FORMAT_VERSION:
+            self.close_mmap()
+            raise MetadataStoreError(
+                f"Unsupported binary metadata format in {safe_str(self._metadata_file_path)}"
+            )
+        self.check_version_and_flags(version, flags, self._metadata_file_path)
+        self._flags = flags
+        self._entry_count = entry_count
+        self._index_offset = index_offset
+        self._children_offset = children_offset
+        (self._children_count,) = struct.unpack_from("<Q", self._mmap, children_offset)
+        self._file_types_offset = file_types_offset
+        (self._file_types_count,) = struct.unpack_from(
+            "<Q", self._mmap, file_types_offset
+        )
+
+    def open_delta(self) -> None:
+        if not self._delta_file_path.is_file():
+            return
+        with open(self._delta_file_path, "rb") as delta_file:
+            delta = delta_file.read()
+        if len(delta) < _BINARY_DELTA_HEADER.size:
+            return  # Torn while being created, so holds no records
+        magic, format_version, flags, version = _BINARY_DELTA_HEADER.unpack_from(
+            delta, 0
+        )
+        if magic != _BINARY_DELTA_MAGIC or format_version != _BINARY_FORMAT_VERSION:
+            raise MetadataStoreError(
+                f"Unsupported binary metadata format in {safe_str(self._delta_file_path)}"
+            )
+        self.check_version_and_flags(version, flags, self._delta_file_path)
+        self._delta_flags = flags
+        offset = _BINARY_DELTA_HEADER.size
+        while offset + _BINARY_DELTA_RECORD.size <= len(delta):
+            key_length, parent_length, payload_length = (
+                _BINARY_DELTA_RECORD.unpack_from(delta, offset)
+            )
+            key_offset = offset + _BINARY_DELTA_RECORD.size
+            parent_offset = key_offset + key_length
+            payload_offset = parent_offset + (
+                parent_length if parent_length != _BINARY_DELTA_NONE else 0
+            )
+            end_offset = payload_offset + (
+                payload_length if payload_length != _BINARY_DELTA_NONE else 0
+            )
+            if end_offset > len(delta):
+                break  # A record torn by an interrupted flush is dropped
+            payload = (
+                delta[payload_offset:end_offset]
+                if payload_length != _BINARY_DELTA_NONE
+                else None
+            )
+            self.apply_delta_record(
+                delta[key_offset:parent_offset],
+                (
+                    delta[parent_offset:payload_offset]
+                    if parent_length != _BINARY_DELTA_NONE
+                    else None
+                ),
+                payload,
+                (
+                    self.get_file_type_entry(self.decode_payload(payload, flags))
+                    if payload is not None
+                    else None
+                ),
+            )
+            offset = end_offset
+        self._delta_length = offset
+
+    def check_version_and_flags(
+        self, version: bytes, flags: int, file_path: Path
+    ) -> None:
+        if version.rstrip(b"\0").decode() != METADATA_VERSION:
+            self.close_mmap()
+            raise MetadataStoreError(
+                f"Unsupported metadata version in {safe_str(file_path)}: {safe_str(version)}"
+            )
+        if flags & _BINARY_FLAG_MSGPACK and msgpack is None:
+            self.close_mmap()
+            raise MetadataStoreError(
+                f"msgpack is required to read {safe_str(file_path)}"
+            )
+
+    def apply_delta_record(
+        self,
+        key: bytes,
+        parent_key: bytes | None,
+        payload: bytes | None,
+        file_type_entry: tuple[bytes, int] | None,
+    ) -> None:
+        # Called with the mmap lock held, or before the store is shared
+        previous_entry = self._delta_entries.get(key)
+        if previous_entry is not None and previous_entry[0] is not None:
+            self._delta_children[previous_entry[0]].discard(key)
+        self._delta_entries[key] = (parent_key, payload, file_type_entry)
+        if payload is not None and parent_key is not None:
+            self._delta_children.setdefault(parent_key, set[bytes]()).add(key)
+        if file_type_entry is not None:
+            self._delta_file_types[file_type_entry[0]] = file_type_entry[1]
+
+    @staticmethod
+    def get_file_type_entry(raw_entry: dict) -> tuple[bytes, int] | None:
+        # Returns the remote hash and file type of an aliased entry, or None if either is unknown
+        remote_hash = raw_entry.get("d", "")
+        file_type = raw_entry.get("b", ContextFileType.UNKNOWN.value)
+        if remote_hash == "" or file_type == ContextFileType.UNKNOWN.value:
+            return None
+        return remote_hash.encode(), file_type
+
+    def load(self) -> Iterator[tuple[str, ContextMetadata]]:
+        if not self.exists():
+            self.migrate_legacy_json()
+        return iter(())
+
+    def get_key_entry(self, entry_number: int) -> tuple[int, int, int, int]:
+        return _BINARY_KEY_ENTRY.unpack_from(
+            self._mmap, self._index_offset + entry_number * _BINARY_KEY_ENTRY.size
+        )
+
+    def get_child_entry(self, child_number: int) -> tuple[int, int, int]:
+        return _BINARY_CHILD_ENTRY.unpack_from(
+            self._mmap,
+            self._children_offset + 8 + child_number * _BINARY_CHILD_ENTRY.size,
+        )
+
+    def get_file_type_index_entry(
+        self, file_type_number: int
+    ) -> tuple[int, int, int, int]:
+        return _BINARY_FILE_TYPE_ENTRY.unpack_from(
+            self._mmap,
+            self._file_types_offset
+            + 8
+            + file_type_number * _BINARY_FILE_TYPE_ENTRY.size,
+        )
+
+    def find_entry_number(self, key: bytes) -> int | None:
+        low, high = 0, self._entry_count
+        while low < high:
+            middle = (low + high) // 2
+            key_offset, key_length, _, _ = self.get_key_entry(middle)
+            middle_key = self._mmap[key_offset : key_offset + key_length]
+            if middle_key < key:
+                low = middle + 1
+            elif middle_key > key:
+                high = middle
+            else:
+                return middle
+        return None
+
+    @staticmethod
+    def get_encoding_flags() -> int:
+        return _BINARY_FLAG_MSGPACK if msgpack is not None else 0
+
+    def decode_payload(self, payload: bytes, flags: int) -> dict:
+        if flags & _BINARY_FLAG_MSGPACK:
+            return msgpack.unpackb(payload)
+        return json.loads(payload)
+
+    def encode_payload(self, raw_entry: dict) -> bytes:
+        if msgpack is not None:
+            return msgpack.packb(raw_entry)
+        return json.dumps(raw_entry, separators=(",", ":")).encode()
+
+    def lookup(self, metadata_key: str) -> ContextMetadata | None:
+        key = metadata_key.encode()
+        with self._mmap_lock:
+            if key in self._delta_entries:
+                _, payload, _ = self._delta_entries[key]
+                if payload is None:
+                    return None  # Deleted since the last compaction
+                flags = self._delta_flags
+            else:
+                if self._mmap is None:
+                    return None
+                entry_number = self.find_entry_number(key)
+                if entry_number is None:
+                    return None
+                _, _, payload_offset, payload_length = self.get_key_entry(entry_number)
+                payload = self._mmap[payload_offset : payload_offset + payload_length]
+                flags = self._flags
+        return ContextMetadata.model_validate(self.decode_payload(payload, flags))
+
+    def lookup_children(self, parent_key: str) -> list[str]:
+        parent_key_bytes = parent_key.encode()
+        with self._mmap_lock:
+            children = list(self._delta_children.get(parent_key_bytes, ()))
+            if self._mmap is None:
+                return sorted(child.decode() for child in children)
+            low, high = 0, self._children_count
+            while low < high:  # Find the first child entry for the parent
+                middle = (low + high) // 2
+                parent_offset, parent_length, _ = self.get_child_entry(middle)
+                if self._mmap[parent_offset : parent_offset + parent_length] < (
+                    parent_key_bytes
+                ):
+                    low = middle + 1
+                else:
+                    high = middle
+            for child_number in range(low, self._children_count):
+                parent_offset, parent_length, entry_number = self.get_child_entry(
+                    child_number
+                )
+                if (
+                    self._mmap[parent_offset : parent_offset + parent_length]
+                    != parent_key_bytes
+                ):
+                    break
+                key_offset, key_length, _, _ = self.get_key_entry(entry_number)
+                key = self._mmap[key_offset : key_offset + key_length]
+                if key not in self._delta_entries:  # Otherwise changed or deleted
+                    children.append(key)
+        return sorted(child.decode() for child in children)
+
+    def lookup_file_type(self, remote_hash: str) -> ContextFileType:
+        # Content with the same hash has the same file type, so entries deleted since do not make the result stale
+        remote_hash_bytes = remote_hash.encode()
+        with self._mmap_lock:
+            if remote_hash_bytes in self._delta_file_types:
+                return ContextFileType(self._delta_file_types[remote_hash_bytes])
+            if self._mmap is None:
+                return ContextFileType.UNKNOWN
+            low, high = 0, self._file_types_count
+            while low < high:
+                middle = (low + high) // 2
+                hash_offset, hash_length, _, file_type = self.get_file_type_index_entry(
+                    middle
+                )
+                middle_hash = self._mmap[hash_offset : hash_offset + hash_length]
+                if middle_hash < remote_hash_bytes:
+                    low = middle + 1
+                elif middle_hash > remote_hash_bytes:
+                    high = middle
+                else:
+                    return ContextFileType(file_type)
+        return ContextFileType.UNKNOWN
+
+    def iter_raw_entries(
+        self,
+    ) -> Iterator[tuple[bytes, bytes | None, bytes, tuple[bytes, int] | None]]:
+        # Yields (key, parent key, payload, (remote hash, file type)) for every entry of the main file in key order
+        # without decoding payloads
+        if self._mmap is None:
+            return
+        file_type_entries = dict[int, tuple[bytes, int]]()
+        for file_type_number in range(self._file_types_count):
+            hash_offset, hash_length, entry_number, file_type = (
+                self.get_file_type_index_entry(file_type_number)
+            )
+            file_type_entries[entry_number] = (
+                self._mmap[hash_offset : hash_offset + hash_length],
+                file_type,
+            )
+        parent_keys = dict[int, bytes]()
+        for child_number in range(self._children_count):
+            parent_offset, parent_length, entry_number = self.get_child_entry(
+                child_number
+            )
+            parent_keys[entry_number] = self._mmap[
+                parent_offset : parent_offset + parent_length
+            ]
+        for entry_number in range(self._entry_count):
+            key_offset, key_length, payload_offset, payload_length = self.get_key_entry(
+                entry_number
+            )
+            yield (
+                self._mmap[key_offset : key_offset + key_length],
+                parent_keys.get(entry_number),
+                self._mmap[payload_offset : payload_offset + payload_length],
+                file_type_entries.get(entry_number),
+            )
+
+    def flush(
+        self,
+        version: str,
+        changed_entries: dict[str, ContextMetadata],
+        deleted_keys: set[str],
+    ) -> None:
+        with self._flush_lock:
+            self._version = version
+            if self._delta_flags != self.get_encoding_flags():
+                self.compact()  # Delta records are all in one encoding
+            records = [
+                (metadata_key.encode(), None, None, None)
+                for metadata_key in deleted_keys
+            ]
+            for metadata_key, context_metadata in changed_entries.items():
+                raw_entry = context_metadata.model_dump(
+                    mode="json", by_alias=True, exclude_none=True
+                )
+                records.append(
+                    (
+                        metadata_key.encode(),
+                        (
+                            str(context_metadata.parent_key).encode()
+                            if context_metadata.parent_key is not None
+                            else None
+                        ),
+                        self.encode_payload(raw_entry),
+                        self.get_file_type_entry(raw_entry),
+                    )
+                )
+            delta = bytearray()
+            for key, parent_key, payload, _ in records:
+                delta += _BINARY_DELTA_RECORD.pack(
+                    len(key),
+                    len(parent_key) if parent_key is not None else _BINARY_DELTA_NONE,
+                    len(payload) if payload is not None else _BINARY_DELTA_NONE,
+                )
+                delta += key + (parent_key or b"") + (payload or b"")
+            if self._delta_length == 0:
+                self._delta_flags = self.get_encoding_flags()
+                with open(self._delta_file_path, "wb") as delta_file:
+                    delta_file.write(
+                        _BINARY_DELTA_HEADER.pack(
+                            _BINARY_DELTA_MAGIC,
+                            _BINARY_FORMAT_VERSION,
+                            self._delta_flags,
+                            version.encode(),
+                        )
+                    )
+                self._delta_length = _BINARY_DELTA_HEADER.size
+            with open(self._delta_file_path, "r+b") as delta_file:
+                delta_file.seek(self._delta_length)
+                delta_file.truncate()  # Drops any record torn by an earlier failed flush
+                delta_file.write(delta)
+                delta_file.flush()
+                os.fsync(delta_file.fileno())
+            self._delta_length += len(delta)
+            with self._mmap_lock:
+                for record in records:
+                    self.apply_delta_record(*record)
+            if len(self._delta_entries) > max(
+                _BINARY_COMPACT_MIN_ENTRIES, self._entry_count // _BINARY_COMPACT_RATIO
+            ):
+                self.compact()
+
+    def compact(self) -> None:
+        # Called with the flush lock held. Merges the raw bytes of unchanged entries of the main file with the
+        # delta into a new main file, then removes the delta
+        if len(self._delta_entries) == 0 and self._delta_length == 0:
+            return
+        encoding_flags = self.get_encoding_flags()
+        new_entries = sorted(
+            (
+                key,
+                parent_key,
+                (
+                    payload
+                    if self._delta_flags == encoding_flags
+                    else self.encode_payload(
+                        self.decode_payload(payload, self._delta_flags)
+                    )
+                ),
+                file_type_entry,
+            )
+            for key, (
+                parent_key,
+                payload,
+                file_type_entry,
+            ) in self._delta_entries.items()
+            if payload is not None
+        )
+        if self._mmap is not None and self._flags != encoding_flags:
+            # Re-encode existing payloads if the available encoding changed since the last write
+            kept_entries = (
+                (
+                    key,
+                    parent_key,
+                    self.encode_payload(self.decode_payload(payload, self._flags)),
+                    file_type_entry,
+                )
+                for key, parent_key, payload, file_type_entry in self.iter_raw_entries()
+                if key not in self._delta_entries
+            )
+        else:
+            kept_entries = (
+                entry
+                for entry in self.iter_raw_entries()
+                if entry[0] not in self._delta_entries
+            )
+        temp_file_path = self._metadata_file_path.with_name(
+            f"{self._metadata_file_path.name}.tmp"
+        )
+        key_index = bytearray()
+        children = list[tuple[bytes, int]]()
+        file_types = list[tuple[bytes, int, int]]()
+        with open(temp_file_path, "wb") as metadata_file:
+            metadata_file.write(b"\0" * _BINARY_HEADER.size)
+            offset = _BINARY_HEADER.size
+            entry_count = 0
+            for key, parent_key, payload, file_type_entry in merge(
+                kept_entries, new_entries, key=lambda entry: entry[0]
+            ):
+                metadata_file.write(key)
+                metadata_file.write(payload)
+                key_index += _BINARY_KEY_ENTRY.pack(
+                    offset, len(key), offset + len(key), len(payload)
+                )
+                if parent_key is not None:
+                    children.append((parent_key, entry_count))
+                if file_type_entry is not None:
+                    file_types.append(
+                        (file_type_entry[0], entry_count, file_type_entry[1])
+                    )
+                offset += len(key) + len(payload)
+                entry_count += 1
+            # Parent keys are written once each so children entries can point at them
+            children.sort()
+            children_index = bytearray(struct.pack("<Q", len(children)))
+            parent_key_offsets = dict[bytes, int]()
+            for parent_key, entry_number in children:
+                if parent_key not in parent_key_offsets:
+                    parent_key_offsets[parent_key] = offset
+                    metadata_file.write(parent_key)
+                    offset += len(parent_key)
+                children_index += _BINARY_CHILD_ENTRY.pack(
+                    parent_key_offsets[parent_key], len(parent_key), entry_number
+                )
+            # Remote hashes are written once each in the same way
+            file_types.sort()
+            file_types_index = bytearray(struct.pack("<Q", len(file_types)))
+            remote_hash_offsets = dict[bytes, int]()
+            for remote_hash, entry_number, file_type in file_types:
+                if remote_hash not in remote_hash_offsets:
+                    remote_hash_offsets[remote_hash] = offset
+                    metadata_file.write(remote_hash)
+                    offset += len(remote_hash)
+                file_types_index += _BINARY_FILE_TYPE_ENTRY.pack(
+                    remote_hash_offsets[remote_hash],
+                    len(remote_hash),
+                    entry_number,
+                    file_type,
+                )
+            index_offset = offset
+            metadata_file.write(key_index)
+            children_offset = index_offset + len(key_index)
+            metadata_file.write(children_index)
+            file_types_offset = children_offset + len(children_index)
+            metadata_file.write(file_types_index)
+            metadata_file.seek(0)
+            metadata_file.write(
+                _BINARY_HEADER.pack(
+                    _BINARY_MAGIC,
+                    _BINARY_FORMAT_VERSION,
+                    encoding_flags,
+                    self._version.encode(),
+                    entry_count,
+                    index_offset,
+                    children_offset,
+                    file_types_offset,
+                )
+            )
+            metadata_file.flush()
+            os.fsync(metadata_file.fileno())
+        with self._mmap_lock:
+            self.close_mmap()  # The mapped file cannot be replaced on every platform while open
+            os.replace(temp_file_path, self._metadata_file_path)
+            self.open_mmap()
+            self._delta_entries = dict[
+                bytes,
+                tuple[bytes | None, bytes | None, tuple[bytes, int] | None],
+            ]()
+            self._delta_children = dict[bytes, set[bytes]]()
+            self._delta_file_types = dict[bytes, int]()
+            self._delta_file_path.unlink(missing_ok=True)
+            self._delta_flags = encoding_flags
+            self._delta_length = 0
+
+    def close_mmap(self) -> None:
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def close(self) -> None:
+        with self._flush_lock:
+            self.compact()
+        with self._mmap_lock:
+            self.close_mmap()
+
+
+class MetadataStoreError(Exception):
+    """Exception raised for errors in a metadata storage backend
+
+    Attributes:
+        message -- explanation of the error
+    """
+
+    def __init__(self, message: str | None = None) -> None:
+        if message is None:
+            message = "An error occurred in the metadata store"
+
+        super().__init__(message)
@@ -0,0 +1,178 @@
+from .helpers import *
+from .file_signature import SNIFF_BYTES, SignatureMatch, sniff_bytes, sniff_file
+
+from io import BytesIO
+from pathlib import Path
+from typing import IO
+
+import gzip
+import lzma
+import os
+import shutil
+import tarfile
+import zipfile
+import zlib
+
+# Formats from sniff_file that the standard library may extract. Compressed files are only handled if they hold a tar
+NATIVE_FORMATS: set[str] = {"zip", "tar", "gz", "bz2", "xz"}
+MAX_NESTED_DEPTH: int = 16  # Guards against archives that contain themselves
+# Raised for damaged or unusual archives that 7-Zip may still extract
+NATIVE_FORMAT_ERRORS: tuple[type[Exception], ...] = (
+    NotImplementedError,
+    RuntimeError,
+    zipfile.BadZipFile,
+    tarfile.TarError,
+    EOFError,
+    zlib.error,
+    lzma.LZMAError,
+    gzip.BadGzipFile,
+)
+
+
+def get_native_format(archive_path: Path) -> str | None:
+    signature_match, format_name = sniff_file(archive_path)
+    if signature_match == SignatureMatch.ARCHIVE and format_name in NATIVE_FORMATS:
+        return format_name
+    return None
+
+
+def get_native_format_from_bytes(data: bytes) -> str | None:
+    signature_match, format_name = sniff_bytes(data)
+    if signature_match == SignatureMatch.ARCHIVE and format_name in NATIVE_FORMATS:
+        return format_name
+    return None
+
+
+def extract_native_archive(
+    archive_path: Path, extract_dir: Path, nested_size_limit: int = 0
+) -> bool:
+    # Runs in a worker process. Returns False without raising for archives that need 7-Zip instead, such as
+    # encrypted zips, zip compression methods the standard library lacks, damaged archives or compressed files
+    # that are not tars.
+    # Nested zip and tar archives up to nested_size_limit bytes are extracted from memory into "<member>.x"
+    # directories, so only their final members are written
+    format_name = get_native_format(archive_path)
+    if format_name is None:
+        return False
+    with open(archive_path, "rb") as archive_file:
+        try:
+            return extract_native_fileobj(
+                archive_file, format_name, extract_dir, nested_size_limit, 0
+            )
+        except NATIVE_FORMAT_ERRORS:
+            return False
+
+
+def extract_native_fileobj(
+    archive_file: IO[bytes],
+    format_name: str,
+    extract_dir: Path,
+    nested_size_limit: int,
+    depth: int,
+) -> bool:
+    # Members small enough to be nested archives are sniffed from their first bytes, so only those that are
+    # archives are read into memory. Other members are still decompressed only once
+    if format_name == "zip":
+        with zipfile.ZipFile(archive_file) as zip_file:
+            for member in zip_file.infolist():
+                if (
+                    not member.is_dir()
+                    and member.file_size <= nested_size_limit
+                    and depth < MAX_NESTED_DEPTH
+                ):
+                    with zip_file.open(member) as member_file:
+                        head = member_file.read(SNIFF_BYTES)
+                        if get_native_format_from_bytes(
+                            head
+                        ) is not None and extract_nested_archive(
+                            head + member_file.read(),
+                            get_safe_zip_member_path(extract_dir, member.filename),
+                            nested_size_limit,
+                            depth,
+                        ):
+                            continue
+                # Member paths are sanitised by zipfile. Zip members are read independently, so only the head of a
+                # sniffed member is decompressed twice
+                zip_file.extract(member, extract_dir)
+    else:
+        try:
+            tar_file = tarfile.open(fileobj=archive_file, mode="r:*")
+        except (tarfile.ReadError, tarfile.CompressionError):
+            return False
+        with tar_file:
+            extract_dir.mkdir(parents=True, exist_ok=True)
+            for member in tar_file:
+                if (
+                    member.isfile()
+                    and member.size <= nested_size_limit
+                    and depth < MAX_NESTED_DEPTH
+                ):
+                    filtered_member = tarfile.data_filter(member, str(extract_dir))
+                    member_path = extract_dir / filtered_member.name
+                    member_file = tar_file.extractfile(member)
+                    head = member_file.read(SNIFF_BYTES)
+                    if get_native_format_from_bytes(
+                        head
+                    ) is not None and extract_nested_archive(
+                        head + member_file.read(),
+                        member_path,
+                        nested_size_limit,
+                        depth,
+                    ):
+                        continue
+                    # Written from the bytes already read, as extracting would seek back in compressed tars
+                    write_tar_member(member_file, head, filtered_member, member_path)
+                    continue
+                tar_file.extract(member, extract_dir, filter="data")
+    return True
+
+
+def write_tar_member(
+    member_file: IO[bytes],
+    head: bytes,
+    filtered_member: tarfile.TarInfo,
+    member_path: Path,
+) -> None:
+    # Finishes writing a regular tar member of which head was already read, with the attributes tarfile would set
+    member_file.seek(len(head))
+    member_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(member_path, "wb") as output_file:
+        output_file.write(head)
+        shutil.copyfileobj(member_file, output_file)
+    if filtered_member.mode is not None:
+        os.chmod(member_path, filtered_member.mode)
+    if filtered_member.mtime is not None:
+        os.utime(member_path, (filtered_member.mtime, filtered_member.mtime))
+
+
+def extract_nested_archive(
+    data: bytes, member_path: Path, nested_size_limit: int, depth: int
+) -> bool:
+    # Returns False if the member should be written as a file instead
+    format_name = get_native_format_from_bytes(data)
+    if format_name is None:
+        return False
+    nested_extract_dir = Path(f"{member_path}.x")
+    try:
+        return extract_native_fileobj(
+            BytesIO(data), format_name, nested_extract_dir, nested_size_limit, depth + 1
+        )
+    except Exception:
+        # Left for the usual on-disk handling, which reports any error against the nested archive
+        shutil.rmtree(nested_extract_dir, ignore_errors=True)
+        return False
+
+
+def get_safe_zip_member_path(extract_dir: Path, member_name: str) -> Path:
+    # Mirrors how zipfile sanitises member paths on extraction
+    arcname = member_name.replace("/", os.path.sep)
+    if os.path.altsep:
+        arcname = arcname.replace(os.path.altsep, os.path.sep)
+    arcname = os.path.splitdrive(arcname)[1]
+    return extract_dir.joinpath(
+        *(
+            part
+            for part in arcname.split(os.path.sep)
+            if part not in ("", os.path.curdir, os.path.pardir)
+        )
+    )
@@ -1,12 +1,18 @@
 from .helpers import *
+from .concurrency import AdaptiveLimiter
 from .context import Context, ContextualError
+from .rclone import RCloneTemporaryError
 
 # from .context import InitializationError, Initializable
 
 from collections.abc import Callable
 from typing import Any
-from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from enum import Enum
+from functools import partial
+from pathlib import Path
+from queue import Empty, SimpleQueue
+from threading import Lock
 
 import dataclasses
 
@@ -18,6 +24,9 @@ class ResultStatus(Enum):
     DOWNLOAD_FAILED = 3
     EXTRACT_FAILED = 4
     DELETE_FAILED = 5
+    NOT_ARCHIVE = 6  # Extraction found the file was not an archive after all
+    EXTRACTED = 7  # The archive was extracted while it was downloaded
+    MATERIALIZED = 8  # Linked from identical content processed earlier in the run
 
 
 class ProcessType(Enum):
@@ -28,16 +37,23 @@ class ProcessType(Enum):
 
 @dataclasses.dataclass
 class ContextualFutureResult:
-    context: Context
     status: ResultStatus
+    context: Context
     error: Exception
     future_context: Context | None = None
+    # Size and CRC of each member of an extracted archive, keyed by file path within the source
+    member_info: dict[Path, tuple[int, str]] | None = None
+    # Size, modification time in nanoseconds and inode of each local output written, keyed by file path within the
+    # source. None for outputs that no longer exist
+    local_stats: dict[Path, tuple[int, int, int] | None] | None = None
 
 
 @dataclasses.dataclass
 class FutureInfo:
     future: Future
     process_type: ProcessType
+    # The context of the root file the task was submitted for
+    root_context: Context | None = None
 
 
 class ProcessManager:
@@ -47,6 +63,10 @@ class ProcessManager:
         extract_workers: int,
         delete_workers: int,
         source_remote_name_map: dict[str, str],
+        list_workers_per_remote: dict[str, int] | None = None,
+        native_extract_workers: int = 0,
+        verify_workers: int = 0,
+        download_limiters_per_remote: dict[str, AdaptiveLimiter] | None = None,
     ):
         self._source_remote_name_map = source_remote_name_map
 
@@ -55,18 +75,56 @@ class ProcessManager:
             self._download_pools[remote_name] = ThreadPoolExecutor(
                 max_workers=download_workers
             )
-        self._download_futures = list[Future]()
+        self._download_workers_per_remote = download_workers_per_remote
+        # Download tasks submitted to each remote that have not completed yet, with a batch counting as one task
+        self._download_task_counts = {
+            remote_name: 0 for remote_name in download_workers_per_remote.keys()
+        }
+        self._download_task_counts_lock = Lock()
+        # Remotes with a limiter have download pools sized to its upper bound, with the limiter deciding how many of
+        # their tasks run at once
+        self._download_limiters = (
+            dict[str, AdaptiveLimiter]()
+            if download_limiters_per_remote is None
+            else download_limiters_per_remote
+        )
+        self._download_futures = set[Future]()
 
         self._extract_pool = ThreadPoolExecutor(max_workers=extract_workers)
-        self._extract_futures = list[Future]()
+        self._extract_futures = set[Future]()
+        # Extract tasks hand decompression to worker processes when enabled, so it is not limited by the GIL
+        self._native_extract_pool = (
+            ProcessPoolExecutor(max_workers=native_extract_workers)
+            if native_extract_workers > 0
+            else None
+        )
 
         self._delete_pool = ThreadPoolExecutor(max_workers=delete_workers)
-        self._delete_futures = list[Future]()
+
+        # Only created when local files are verified
+        self._verify_pool = (
+            ThreadPoolExecutor(max_workers=verify_workers)
+            if verify_workers > 0
+            else None
+        )
+        self._delete_futures = set[Future]()
+
+        self._list_pools = dict[str, ThreadPoolExecutor]()
+        for remote_name in download_workers_per_remote.keys():
+            self._list_pools[remote_name] = ThreadPoolExecutor(
+                max_workers=(
+                    1
+                    if list_workers_per_remote is None
+                    else list_workers_per_remote.get(remote_name, 1)
+                )
+            )  # Bounds concurrent listings per remote rather than per source
 
         self._exit_pool = ThreadPoolExecutor(max_workers=1)
         self._exit_future: Future | None = None
 
         self._context_future_info_map = dict[Context, FutureInfo]()
+        self._future_context_map = dict[Future, Context]()
+        self._completed_futures = SimpleQueue[Future]()  # Fed by done callbacks
 
     def get_download_pool(self, remote_name: str) -> ThreadPoolExecutor:
         return self._download_pools[remote_name]
@@ -74,53 +132,252 @@ class ProcessManager:
     def get_download_pools(self) -> list[ThreadPoolExecutor]:
         return list(self._download_pools.values())
 
+    def get_remote_name(self, source_name: str) -> str:
+        return self._source_remote_name_map[source_name]
+
+    def get_download_capacity(self, remote_name: str) -> int:
+        # How many download tasks the remote may have submitted at once without any waiting
+        limiter = self._download_limiters.get(remote_name)
+        if limiter is not None:
+            return limiter.get_limit()
+        return self._download_workers_per_remote[remote_name]
+
+    def get_download_task_count(self, remote_name: str) -> int:
+        with self._download_task_counts_lock:
+            return self._download_task_counts[remote_name]
+
+    def count_download_task(self, remote_name: str, count: int) -> None:
+        with self._download_task_counts_lock:
+            self._download_task_counts[remote_name] += count
+
+    def get_download_limiters(self) -> list[AdaptiveLimiter]:
+        return list(self._download_limiters.values())
+
+    def get_download_limiter(self, context: Context) -> AdaptiveLimiter | None:
+        return self._download_limiters.get(
+            self._source_remote_name_map[context.source_name]
+        )
+
     def get_extract_pool(self) -> ThreadPoolExecutor:
         return self._extract_pool
 
+    def get_native_extract_pool(self) -> ProcessPoolExecutor | None:
+        return self._native_extract_pool
+
     def get_delete_pool(self) -> ThreadPoolExecutor:
         return self._delete_pool
 
+    def get_verify_pool(self) -> ThreadPoolExecutor | None:
+        return self._verify_pool
+
+    def get_list_pools(self) -> list[ThreadPoolExecutor]:
+        return list(self._list_pools.values())
+
     def get_exit_pool(self) -> ThreadPoolExecutor:
         return self._exit_pool
 
     def submit_contextual_task(
-        self, process_type: ProcessType, context: Context, task: Callable, *args: Any
+        self,
+        process_type: ProcessType,
+        context: Context,
+        task: Callable,
+        *args: Any,
+        root_context: Context | None = None,
     ) -> Future:
         if context in self._context_future_info_map.keys():
             raise FutureContextExistsError(context)
+        future = self.get_pool(process_type, context).submit(task, *args)
+        self.track_future(process_type, context, future, root_context)
+        return future
+
+    def submit_contextual_batch_task(
+        self,
+        process_type: ProcessType,
+        contexts: list[Context],
+        task: Callable,
+        *args: Any,
+        batch_done_callback: Callable[[Future], None] | None = None,
+    ) -> dict[Context, Future]:
+        # Runs task once for all contexts, which must share a pool. Each context still gets its own Future,
+        # resolved with the list of results the task returns for it in a dict keyed by Context
+        for context in contexts:
+            if context in self._context_future_info_map.keys():
+                raise FutureContextExistsError(context)
+        context_futures = dict[Context, Future]()
+        for context in contexts:
+            future = Future()
+            self.track_future(process_type, context, future)
+            context_futures[context] = future
+        batch_future = self.get_pool(process_type, contexts[0]).submit(
+            self.run_batch_task, context_futures, task, *args
+        )
+        batch_future.add_done_callback(
+            lambda batch_future: (
+                [future.cancel() for future in context_futures.values()]
+                if batch_future.cancelled()
+                else None
+            )
+        )  # Batches dropped by a pool shutdown cancel the Futures of all their contexts
+        if batch_done_callback is not None:
+            batch_future.add_done_callback(batch_done_callback)
+        return context_futures
+
+    @staticmethod
+    def run_batch_task(
+        context_futures: dict[Context, Future], task: Callable, *args: Any
+    ) -> None:
+        # Contexts whose Futures were cancelled while the batch was queued are left out of it
+        running_futures = {
+            context: future
+            for context, future in context_futures.items()
+            if future.set_running_or_notify_cancel()
+        }
+        if len(running_futures) == 0:
+            return
+        try:
+            results = task(list(running_futures.keys()), *args)
+            for context, future in running_futures.items():
+                future.set_result(results[context])
+        except Exception as error:
+            for future in running_futures.values():
+                if not future.done():
+                    future.set_exception(error)
+
+    def get_pool(
+        self, process_type: ProcessType, context: Context
+    ) -> ThreadPoolExecutor:
         match process_type:
             case ProcessType.DOWNLOAD:
-                pool = self._download_pools[
+                return self._download_pools[
                     self._source_remote_name_map[context.source_name]
                 ]
-                future_list = self._download_futures
             case ProcessType.EXTRACT:
-                pool = self._extract_pool
-                future_list = self._extract_futures
+                return self._extract_pool
             case ProcessType.DELETE:
-                pool = self._delete_pool
-                future_list = self._delete_futures
-
-        future = pool.submit(task, *args)
-        future_list.append(future)
-        self._context_future_info_map[context] = FutureInfo(future, process_type)
+                return self._delete_pool
 
-        return future
+    def track_future(
+        self,
+        process_type: ProcessType,
+        context: Context,
+        future: Future,
+        root_context: Context | None = None,
+    ) -> None:
+        self.get_futures_for_process_type(process_type).add(future)
+        self._context_future_info_map[context] = FutureInfo(
+            future, process_type, context if root_context is None else root_context
+        )
+        self._future_context_map[future] = context
+        future.add_done_callback(self._completed_futures.put)
 
     def submit_download_task(
-        self, context: Context, task: Callable, *args: Any
+        self,
+        context: Context,
+        task: Callable,
+        *args: Any,
+        root_context: Context | None = None,
+        transfer_bytes: int = 0,
     ) -> Future:
-        return self.submit_contextual_task(ProcessType.DOWNLOAD, context, task, *args)
+        limiter = self.get_download_limiter(context)
+        if limiter is not None:
+            task = partial(self.run_limited_task, limiter, transfer_bytes, task)
+        remote_name = self._source_remote_name_map[context.source_name]
+        self.count_download_task(remote_name, 1)
+        future = self.submit_contextual_task(
+            ProcessType.DOWNLOAD,
+            context,
+            partial(self.run_counted_task, remote_name, task),
+            *args,
+            root_context=root_context,
+        )
+        future.add_done_callback(
+            lambda future: (
+                self.count_download_task(remote_name, -1)
+                if future.cancelled()
+                else None
+            )
+        )  # Tasks dropped by a pool shutdown never run to count themselves as done
+        return future
+
+    def submit_batch_download_task(
+        self,
+        contexts: list[Context],
+        task: Callable,
+        *args: Any,
+        transfer_bytes: int = 0,
+    ) -> dict[Context, Future]:
+        limiter = self.get_download_limiter(contexts[0])
+        if limiter is not None:
+            task = partial(self.run_limited_task, limiter, transfer_bytes, task)
+        remote_name = self._source_remote_name_map[contexts[0].source_name]
+        self.count_download_task(remote_name, 1)
+        return self.submit_contextual_batch_task(
+            ProcessType.DOWNLOAD,
+            contexts,
+            partial(self.run_counted_task, remote_name, task),
+            *args,
+            batch_done_callback=lambda batch_future: (
+                self.count_download_task(remote_name, -1)
+                if batch_future.cancelled()
+                else None
+            ),
+        )
+
+    def run_counted_task(self, remote_name: str, task: Callable, *args: Any) -> Any:
+        # Counts the task as done before its Future completes, so the main thread sees the free worker as soon as
+        # it is woken by the completed Future
+        try:
+            return task(*args)
+        finally:
+            self.count_download_task(remote_name, -1)
+
+    @staticmethod
+    def run_limited_task(
+        limiter: AdaptiveLimiter, transfer_bytes: int, task: Callable, *args: Any
+    ) -> list[ContextualFutureResult] | dict[Context, list[ContextualFutureResult]]:
+        # Runs a download task once the limiter allows it, and reports whether any of its results hit a temporary
+        # error such as rate limiting. Tasks return failed results rather than raising
+        with limiter.slot(transfer_bytes) as slot_outcome:
+            results = task(*args)
+            result_lists = results.values() if isinstance(results, dict) else [results]
+            slot_outcome.temporary_error = any(
+                isinstance(result.error, RCloneTemporaryError)
+                for result_list in result_lists
+                for result in result_list
+            )
+        return results
 
     def submit_extract_task(
-        self, context: Context, task: Callable, *args: Any
+        self,
+        context: Context,
+        task: Callable,
+        *args: Any,
+        root_context: Context | None = None,
     ) -> Future:
-        return self.submit_contextual_task(ProcessType.EXTRACT, context, task, *args)
+        return self.submit_contextual_task(
+            ProcessType.EXTRACT, context, task, *args, root_context=root_context
+        )
 
     def submit_delete_task(
-        self, context: Context, task: Callable, *args: Any
+        self,
+        context: Context,
+        task: Callable,
+        *args: Any,
+        root_context: Context | None = None,
     ) -> Future:
-        return self.submit_contextual_task(ProcessType.DELETE, context, task, *args)
+        return self.submit_contextual_task(
+            ProcessType.DELETE, context, task, *args, root_context=root_context
+        )
+
+    def submit_list_task(self, source_name: str, task: Callable, *args: Any) -> Future:
+        # Listing tasks are not tied to a file context and report their results through their own channel
+        return self._list_pools[self._source_remote_name_map[source_name]].submit(
+            task, *args
+        )
+
+    def submit_verify_task(self, task: Callable, *args: Any) -> Future:
+        # Like listing tasks, verification tasks are not tied to a file context
+        return self._verify_pool.submit(task, *args)
 
     def submit_exit_task(self, task: Callable, *args: Any) -> Future | None:
         if self._exit_future is None:
@@ -130,45 +387,56 @@ class ProcessManager:
         else:
             return None
 
-    def get_download_futures(self) -> list[Future]:
+    def get_download_futures(self) -> set[Future]:
         return self._download_futures
 
-    def get_extract_futures(self) -> list[Future]:
+    def get_extract_futures(self) -> set[Future]:
         return self._extract_futures
 
-    def get_delete_futures(self) -> list[Future]:
+    def get_delete_futures(self) -> set[Future]:
         return self._delete_futures
 
+    def get_futures_for_process_type(self, process_type: ProcessType) -> set[Future]:
+        match process_type:
+            case ProcessType.DOWNLOAD:
+                return self._download_futures
+            case ProcessType.EXTRACT:
+                return self._extract_futures
+            case ProcessType.DELETE:
+                return self._delete_futures
+
     def get_exit_future(self) -> Future:
         return self._exit_future
 
     def get_futures(self) -> list[Future]:
-        return self._download_futures + self._extract_futures + self._delete_futures
+        return [*self._download_futures, *self._extract_futures, *self._delete_futures]
+
+    def get_future_count(self) -> int:
+        return len(self._future_context_map)
+
+    def get_completed_future(self, timeout: float | None = None) -> Future:
+        # Blocks until a tracked Future completes, in completion order
+        try:
+            return self._completed_futures.get(timeout=timeout)
+        except Empty:
+            raise TimeoutError()
 
     def get_context_for_future(self, future: Future) -> Context | None:
-        for context, future_info in self._context_future_info_map.items():
-            if future_info.future is future:
-                return context
-        raise UnknownFutureError(future)
+        try:
+            return self._future_context_map[future]
+        except KeyError:
+            raise UnknownFutureError(future)
 
-    def get_info_for_future(self, future: Future) -> Context | None:
-        for future_info in self._context_future_info_map.values():
-            if future_info.future is future:
-                return future_info
-        raise UnknownFutureError(future)
+    def get_info_for_future(self, future: Future) -> FutureInfo | None:
+        return self._context_future_info_map[self.get_context_for_future(future)]
 
     def remove_future(self, future: Future) -> None:
         context = self.get_context_for_future(future)
         future_info = self._context_future_info_map[context]
 
         del self._context_future_info_map[context]
-        match future_info.process_type:
-            case ProcessType.DOWNLOAD:
-                self._download_futures.remove(future)
-            case ProcessType.EXTRACT:
-                self._extract_futures.remove(future)
-            case ProcessType.DELETE:
-                self._delete_futures.remove(future)
+        del self._future_context_map[future]
+        self.get_futures_for_process_type(future_info.process_type).discard(future)
 
 
 class UnknownFutureError(Exception):
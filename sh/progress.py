@@ -12,6 +12,9 @@ class ContextProgress:
         errors=[],
         files_to_process=set(),
         cancelled=False,
+        previous_member_info=None,
+        queued_download=None,
+        bytes_done=False,
     ):
         self.context = context
         self.metadata = metadata
@@ -19,6 +22,12 @@ class ContextProgress:
         self.errors = errors
         self.files_to_process = files_to_process
         self.cancelled = cancelled
+        # Members of the previous version of an archive, so only changed members are extracted again
+        self.previous_member_info = previous_member_info
+        # Queued again if the download of the root file is retried after a temporary error
+        self.queued_download = queued_download
+        # Set once the remote size of the root file counts towards the ETA, which is as soon as its download finishes
+        self.bytes_done = bytes_done
 
 
 class ProgressManager:
@@ -3,16 +3,47 @@ from .context import InvalidContextError
 from .contextual_subprocess import ContextualSubprocess, SubprocessError
 from .global_config import GlobalConfigError
 
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
+from contextlib import contextmanager
+from math import ceil
 from pathlib import Path
 from subprocess import CompletedProcess  # For type hinting
-from typing import Any
+from threading import Event, Lock
+from typing import IO, Any, Callable, Iterator
+
+import dataclasses
+import hashlib
+import json
+import os
+import re
+import tempfile
+
+HASH_LISTING_BATCH_SIZE: int = (
+    1000  # Changed files whose hashes are requested per lsf call in incremental listings
+)
+
+CHUNK_READ_BYTES: int = 1024 * 1024
+CHUNK_STATE_SAVE_BYTES: int = (
+    64
+    * 1024
+    * 1024  # Progress of each chunk is saved at least this often, so little is fetched again on resume
+)
+
+
+@dataclasses.dataclass
+class ChunkedDownload:
+    file_size: int
+    file_hash: str  # Partial downloads are only resumed for the same remote content
+    chunk_size: int
+    streams: int
 
 
 class RClone(ContextualSubprocess):
     _rclone_config_path: str | None = None
     _rclone_config: ConfigParser | None = None
     _sources: dict[str, dict[str, Any]] = None
+    _stop_chunked_downloads: Event = Event()  # Shared by all backends
 
     @classmethod
     def configure(
@@ -36,7 +67,56 @@ class RClone(ContextualSubprocess):
                 )
         super().configure(context_pool_names, rclone_path, destination_root_dir)
 
-    def fetch_file_info_list(self) -> list[tuple[str, str, str]]:
+    def fetch_file_info_list(self) -> list[tuple[str, str, str, str]]:
+        return list(self.iter_file_info())
+
+    def iter_file_info(self) -> Iterator[tuple[str, str, str, str]]:
+        # Yields (path, size, hash, modtime) for each remote file as rclone prints it
+        for file_path, file_size, file_hash, file_modtime in self.iter_lsf(
+            ["--format", "psht"], 4
+        ):
+            yield (file_path, file_size, file_hash, file_modtime)
+
+    def iter_changed_file_info(
+        self,
+        is_unchanged: Callable[[str, str, str], bool],
+        max_age: str | None = None,
+    ) -> Iterator[tuple[str, str, str, str]]:
+        # Lists path, size and modtime first and only asks for hashes of files is_unchanged rejects,
+        # so backends that compute hashes by reading file contents skip unchanged files entirely
+        max_age_args = [] if max_age is None else ["--max-age", max_age]
+        candidates = dict[str, tuple[str, str]]()
+        for file_path, file_size, file_modtime in self.iter_lsf(
+            ["--format", "pst"] + max_age_args, 3
+        ):
+            if is_unchanged(file_path, file_size, file_modtime):
+                continue
+            candidates[file_path] = (file_size, file_modtime)
+            if len(candidates) >= HASH_LISTING_BATCH_SIZE:
+                yield from self.iter_candidate_hashes(candidates)
+                candidates = dict[str, tuple[str, str]]()
+        if len(candidates) > 0:
+            yield from self.iter_candidate_hashes(candidates)
+
+    def iter_candidate_hashes(
+        self, candidates: dict[str, tuple[str, str]]
+    ) -> Iterator[tuple[str, str, str, str]]:
+        with tempfile.NamedTemporaryFile(
+            mode="w", encoding="utf-8", suffix=".txt", delete=False
+        ) as files_from_file:
+            files_from_file.write("\n".join(candidates.keys()) + "\n")
+        try:
+            for file_path, file_hash in self.iter_lsf(
+                ["--format", "ph", "--files-from-raw", files_from_file.name], 2
+            ):
+                if file_path in candidates:
+                    file_size, file_modtime = candidates[file_path]
+                    yield (file_path, file_size, file_hash, file_modtime)
+        finally:
+            Path(files_from_file.name).unlink(missing_ok=True)
+
+    def iter_lsf(self, format_args: list[str], field_count: int) -> Iterator[list[str]]:
+        # Streams the fields of each line of an lsf listing of the source's remote path
         self.raise_exception_if_class_not_configured()
         context = self.get_context()
         if context.source_name is None:
@@ -54,20 +134,32 @@ class RClone(ContextualSubprocess):
             "0",
             "--disable",
             "ListR",  # Fixes incomplete results
-            "--format",
-            "psh",
+            *format_args,
             "--separator",
             "|",
             "--recursive",
             "--files-only",
         ]
-        lsf_proc = self.run_subprocess(cmd_args)
-        self.raise_exception_if_proc_failed(lsf_proc)
-        file_info_list = []
-        for line in lsf_proc.stdout.splitlines():
-            file_info = line.split("|")
-            file_info_list.append((file_info[0], file_info[1], file_info[2]))
-        return file_info_list
+        with tempfile.TemporaryFile(mode="w+", encoding="utf-8") as stderr_file:
+            lsf_proc = self.open_subprocess(cmd_args, stderr_file)
+            try:
+                for line in lsf_proc.stdout:
+                    # The path is the first field and the only one that may contain the separator
+                    fields = line.rstrip("\r\n").rsplit("|", field_count - 1)
+                    if len(fields) == field_count:
+                        yield fields
+                lsf_proc.wait()
+            finally:
+                if lsf_proc.poll() is None:
+                    lsf_proc.kill()  # The consumer stopped early
+                    lsf_proc.wait()
+                lsf_proc.stdout.close()
+            stderr_file.seek(0)
+            self.raise_exception_if_proc_failed(
+                CompletedProcess(
+                    lsf_proc.args, lsf_proc.returncode, "", stderr_file.read()
+                )
+            )
 
     def download(self) -> None:
         self.raise_exception_if_class_not_configured()
@@ -83,6 +175,324 @@ class RClone(ContextualSubprocess):
         copyto_proc = self.run_subprocess(cmd_args)
         self.raise_exception_if_proc_failed(copyto_proc)
 
+    @classmethod
+    def stop_chunked_downloads(cls) -> None:
+        # Running chunked downloads stop at their next read and keep their progress to resume from on the next run
+        cls._stop_chunked_downloads.set()
+
+    def download_chunked(self, chunked_download: ChunkedDownload) -> None:
+        # Fetches the context's remote file as chunks read by up to chunked_download.streams rclone cat processes at
+        # once. Chunks are written in place to <file>.partial and their progress to <file>.partial.json, so a failed
+        # or stopped download resumes where each chunk left off. The file is renamed into place once complete, and
+        # only if it matches the remote hash when that is an MD5, as rclone cat does not check it like copyto
+        self.raise_exception_if_class_not_configured()
+        self.raise_exception_if_context_not_set()
+        context = self.get_context()
+        remote_file = f'{self._sources[context.source_name]["remote_name"]}:{str(Path(self._sources[context.source_name]["remote_path"]) / context.file_path)}'
+        destination_path = self.get_destination_path()
+        partial_path = Path(f"{destination_path}.partial")
+        state_path = Path(f"{destination_path}.partial.json")
+        file_size = chunked_download.file_size
+        chunk_size = chunked_download.chunk_size
+        chunk_count = max(1, ceil(file_size / chunk_size))
+        chunk_done_bytes = self.load_chunk_state(
+            state_path, partial_path, chunked_download, chunk_count
+        )
+        resumed = chunk_done_bytes is not None
+        if chunk_done_bytes is None:
+            chunk_done_bytes = [0] * chunk_count
+            destination_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(partial_path, "wb") as partial_file:
+                partial_file.truncate(file_size)
+        state_lock = Lock()
+        failed = Event()  # Stops the other chunks at the first failure
+
+        def save_state() -> None:
+            with state_lock:
+                tmp_path = state_path.with_name(state_path.name + ".tmp")
+                with open(tmp_path, "w") as state_file:
+                    json.dump(
+                        {
+                            "size": file_size,
+                            "hash": chunked_download.file_hash,
+                            "chunk_size": chunk_size,
+                            "done": chunk_done_bytes,
+                        },
+                        state_file,
+                    )
+                os.replace(tmp_path, state_path)
+
+        def download_chunk(chunk_index: int) -> None:
+            chunk_start = chunk_index * chunk_size
+            chunk_end = min(file_size, chunk_start + chunk_size)
+            offset = chunk_start + chunk_done_bytes[chunk_index]
+            if offset >= chunk_end:
+                return
+            cmd_args = [
+                "--config",
+                str(self._rclone_config_path),
+                "cat",
+                "--offset",
+                str(offset),
+                "--count",
+                str(chunk_end - offset),
+                remote_file,
+            ]
+            try:
+                with tempfile.TemporaryFile(
+                    mode="w+", encoding="utf-8"
+                ) as stderr_file, open(partial_path, "r+b") as partial_file:
+                    partial_file.seek(offset)
+                    cat_proc = self.open_subprocess(cmd_args, stderr_file, text=False)
+                    unsaved_bytes = 0
+                    try:
+                        while offset < chunk_end:
+                            if failed.is_set() or self._stop_chunked_downloads.is_set():
+                                break
+                            data = cat_proc.stdout.read(
+                                min(CHUNK_READ_BYTES, chunk_end - offset)
+                            )
+                            if len(data) == 0:
+                                break
+                            partial_file.write(data)
+                            offset += len(data)
+                            unsaved_bytes += len(data)
+                            if unsaved_bytes >= CHUNK_STATE_SAVE_BYTES:
+                                # Synced first, so the state never claims bytes lost in a crash
+                                partial_file.flush()
+                                os.fsync(partial_file.fileno())
+                                chunk_done_bytes[chunk_index] = offset - chunk_start
+                                save_state()
+                                unsaved_bytes = 0
+                        if offset == chunk_end:
+                            cat_proc.wait()
+                    finally:
+                        if cat_proc.poll() is None:
+                            cat_proc.kill()  # Stopped before the end of the chunk
+                            cat_proc.wait()
+                        cat_proc.stdout.close()
+                        partial_file.flush()
+                        os.fsync(partial_file.fileno())
+                        chunk_done_bytes[chunk_index] = offset - chunk_start
+                        save_state()
+                    if offset < chunk_end and (
+                        failed.is_set() or self._stop_chunked_downloads.is_set()
+                    ):
+                        raise RCloneChunkedDownloadStoppedError(
+                            " ".join(map(str, cat_proc.args)),
+                            cat_proc.returncode,
+                            "",
+                            "",
+                        )
+                    stderr_file.seek(0)
+                    self.raise_exception_if_proc_failed(
+                        CompletedProcess(
+                            cat_proc.args, cat_proc.returncode, "", stderr_file.read()
+                        )
+                    )
+                    if offset < chunk_end:
+                        raise RCloneError(
+                            " ".join(map(str, cat_proc.args)),
+                            cat_proc.returncode,
+                            "",
+                            "",
+                            message=f"rclone cat ended {chunk_end - offset} bytes before the end of the chunk",
+                        )
+            except Exception:
+                failed.set()
+                raise
+
+        with ThreadPoolExecutor(max_workers=chunked_download.streams) as chunk_pool:
+            chunk_futures = [
+                chunk_pool.submit(download_chunk, chunk_index)
+                for chunk_index in range(chunk_count)
+            ]
+        chunk_errors = [
+            chunk_future.exception()
+            for chunk_future in chunk_futures
+            if chunk_future.exception() is not None
+        ]
+        if len(chunk_errors) > 0:
+            # The failure that stopped the others is reported rather than the stops it caused
+            raise next(
+                (
+                    chunk_error
+                    for chunk_error in chunk_errors
+                    if not isinstance(chunk_error, RCloneChunkedDownloadStoppedError)
+                ),
+                chunk_errors[0],
+            )
+        if (
+            re.fullmatch("[0-9a-f]{32}", chunked_download.file_hash) is not None
+            and self.get_file_md5(partial_path) != chunked_download.file_hash
+        ):
+            partial_path.unlink(missing_ok=True)
+            state_path.unlink(missing_ok=True)
+            if resumed:
+                # Parts written by an earlier attempt may have been damaged, so the file is fetched again from scratch
+                self.download_chunked(chunked_download)
+                return
+            raise RCloneTemporaryError(
+                f"rclone cat {remote_file}",
+                0,
+                "",
+                "",
+                message=f"Chunked download does not match the remote MD5 hash: {chunked_download.file_hash}",
+            )
+        os.replace(partial_path, destination_path)
+        state_path.unlink(missing_ok=True)
+
+    @staticmethod
+    def load_chunk_state(
+        state_path: Path,
+        partial_path: Path,
+        chunked_download: ChunkedDownload,
+        chunk_count: int,
+    ) -> list[int] | None:
+        # Returns the bytes done for each chunk of a previous attempt, or None if it cannot be resumed. Downloads
+        # are only resumed with an MD5 remote hash, which the resumed file is checked against once complete
+        if (
+            re.fullmatch("[0-9a-f]{32}", chunked_download.file_hash) is None
+            or not state_path.is_file()
+            or not partial_path.is_file()
+        ):
+            return None
+        try:
+            with open(state_path, "r") as state_file:
+                state = json.load(state_file)
+            chunk_done_bytes = [int(done_bytes) for done_bytes in state["done"]]
+        except (ValueError, KeyError, TypeError):
+            return None
+        if (
+            state.get("size") != chunked_download.file_size
+            or state.get("hash") != chunked_download.file_hash
+            or state.get("chunk_size") != chunked_download.chunk_size
+            or len(chunk_done_bytes) != chunk_count
+        ):
+            return None
+        return chunk_done_bytes
+
+    @staticmethod
+    def get_file_md5(file_path: Path) -> str:
+        md5 = hashlib.md5()
+        with open(file_path, "rb") as file:
+            while data := file.read(CHUNK_READ_BYTES):
+                md5.update(data)
+        return md5.hexdigest()
+
+    @contextmanager
+    def open_stream(self) -> Iterator[IO[bytes]]:
+        # Yields the contents of the context's remote file as it is read by rclone cat, without writing it to disk
+        self.raise_exception_if_class_not_configured()
+        self.raise_exception_if_context_not_set()
+        context = self.get_context()
+        cmd_args = [
+            "--config",
+            str(self._rclone_config_path),
+            "cat",
+            f'{self._sources[context.source_name]["remote_name"]}:{str(Path(self._sources[context.source_name]["remote_path"]) / context.file_path)}',
+        ]
+        with tempfile.TemporaryFile(mode="w+", encoding="utf-8") as stderr_file:
+            cat_proc = self.open_subprocess(cmd_args, stderr_file, text=False)
+            try:
+                yield cat_proc.stdout
+                # Drain anything the consumer left unread, such as tar padding, so rclone can exit
+                while cat_proc.stdout.read(1024 * 1024):
+                    pass
+                cat_proc.wait()
+            finally:
+                if cat_proc.poll() is None:
+                    cat_proc.kill()  # The consumer failed part way through
+                    cat_proc.wait()
+                cat_proc.stdout.close()
+            stderr_file.seek(0)
+            self.raise_exception_if_proc_failed(
+                CompletedProcess(
+                    cat_proc.args, cat_proc.returncode, "", stderr_file.read()
+                )
+            )
+
+    def download_batch(
+        self,
+        file_paths: list[Path],
+        transfers: int | None = None,
+        checkers: int | None = None,
+    ) -> dict[Path, Exception | None]:
+        # Copies many files of the context's source with one rclone process and returns the error for each file, if any
+        self.raise_exception_if_class_not_configured()
+        context = self.get_context()
+        if context.source_name is None:
+            raise InvalidContextError(
+                context.source_name,
+                context.file_path,
+                "Source name is not set in the context",
+            )
+        with tempfile.NamedTemporaryFile(
+            mode="w", encoding="utf-8", suffix=".txt", delete=False
+        ) as files_from_file:
+            files_from_file.write(
+                "\n".join(file_path.as_posix() for file_path in file_paths) + "\n"
+            )
+        try:
+            cmd_args = [
+                "--config",
+                str(self._rclone_config_path),
+                "copy",
+                f'{self._sources[context.source_name]["remote_name"]}:{self._sources[context.source_name]["remote_path"]}',
+                str(self._destination_root_dir / context.source_name),
+                "--files-from-raw",
+                files_from_file.name,
+                "--no-traverse",
+                "--use-json-log",
+                "--log-level",
+                "INFO",
+            ]
+            if transfers is not None:
+                cmd_args += ["--transfers", str(transfers)]
+            if checkers is not None:
+                cmd_args += ["--checkers", str(checkers)]
+            copy_proc = self.run_subprocess(cmd_args)
+        finally:
+            Path(files_from_file.name).unlink(missing_ok=True)
+
+        # Files rclone logged errors for fail with their own messages. Files logged as copied succeed even if others
+        # failed, including files that failed on an earlier of rclone's own retries of the copy. Files rclone skipped
+        # as unchanged are only logged at debug level so succeed if rclone did
+        cmd_string = " ".join(map(str, copy_proc.args))
+        # Errors for files of a batch that failed temporarily are temporary too, so the files are retried
+        file_error_class = (
+            RCloneTemporaryError if copy_proc.returncode == 5 else RCloneError
+        )
+        file_errors = dict[Path, Exception | None]()
+        for line in copy_proc.stderr.splitlines():
+            try:
+                log_entry = json.loads(line)
+            except ValueError:
+                continue
+            if not isinstance(log_entry, dict) or not log_entry.get("object"):
+                continue
+            file_path = Path(log_entry["object"])
+            if log_entry.get("level") == "error":
+                file_errors[file_path] = file_error_class(
+                    cmd_string,
+                    copy_proc.returncode,
+                    "",
+                    log_entry.get("msg", ""),
+                    message=f"rclone failed to copy file: {file_path}",
+                )
+            elif "Copied" in str(log_entry.get("msg", "")):
+                # Also matches "Multi-thread Copied" for large files
+                file_errors[file_path] = None
+        batch_error = None
+        try:
+            self.raise_exception_if_proc_failed(copy_proc)
+        except RCloneError as error:
+            batch_error = error
+        return {
+            file_path: file_errors.get(file_path, batch_error)
+            for file_path in file_paths
+        }
+
     def raise_exception_if_proc_failed(self, proc: CompletedProcess) -> None:
         cmd_string = " ".join(map(str, proc.args))
         if proc.returncode in [0, 9]:
@@ -108,6 +518,18 @@ class RCloneError(SubprocessError):
         return f"An error occured during the rclone operation. Return code was {rc}"
 
 
+class RCloneChunkedDownloadStoppedError(RCloneError):
+    """
+    Exception raised for chunks of a chunked download that were stopped before they were complete, either because
+    another chunk failed or because the process is exiting. Their progress is kept to resume from.
+
+    See RCloneError for more information.
+    """
+
+    def get_default_message(self, rc: int) -> str:
+        return f"A chunk of the download was stopped before it was complete. Return code was {rc}"
+
+
 class RCloneTemporaryError(RCloneError):
     """
     Exception raised for temporary errors that occur during rclone operations.
@@ -0,0 +1,328 @@
+from .helpers import *
+from .context import InvalidContextError
+from .rclone import RClone, RCloneError, RCloneTemporaryError
+
+from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from queue import Empty, SimpleQueue
+from subprocess import Popen  # For type hinting
+from time import sleep, time
+from typing import Any, Callable, Iterator
+from urllib.parse import urlsplit
+
+import http.client
+import json
+import os
+import secrets
+import socket
+import subprocess
+
+RCD_STARTUP_TIMEOUT_SECONDS: int = 30
+# Errors from the rc API that are worth retrying later, like the subprocess backend's return code 5. HTTP 429 and
+# 5xx statuses are always temporary, other statuses only if the error reports rate limiting
+_TEMPORARY_ERROR_MESSAGES: tuple[str, ...] = (
+    "rate limit",
+    "ratelimitexceeded",
+    "too many requests",
+    "try again later",
+)
+
+
+class RCloneRC(RClone):
+    """RClone backend that drives a single rclone rcd over its HTTP API instead of running a process per operation
+
+    The daemon is started when the class is configured, unless rc_url points at an rc server that is already running,
+    and is shared by all instances. Requests reuse keep-alive connections from a pool.
+    """
+
+    _rc_host: str | None = None
+    _rc_port: int | None = None
+    _rc_headers: dict[str, str] | None = None
+    _rcd_proc: Popen | None = None
+    _connections: SimpleQueue[http.client.HTTPConnection] | None = None
+
+    @classmethod
+    def configure(
+        cls,
+        context_pool_names: set[str],
+        rclone_path: Path,
+        destination_root_dir: Path,
+        rclone_config_path: Path,
+        sources: dict[str, dict[str, Any]],
+        rc_url: str | None = None,
+    ) -> None:
+        super().configure(
+            context_pool_names,
+            rclone_path,
+            destination_root_dir,
+            rclone_config_path,
+            sources,
+        )
+        cls._connections = SimpleQueue[http.client.HTTPConnection]()
+        cls._rc_headers = {"Content-Type": "application/json"}
+        if rc_url is None:
+            user = "synchero"
+            password = secrets.token_urlsafe(24)
+            cls._rc_host = "127.0.0.1"
+            cls._rc_port = cls.get_free_port()
+            cls._rcd_proc = subprocess.Popen(
+                [
+                    rclone_path,
+                    "--config",
+                    str(rclone_config_path),
+                    "rcd",
+                    "--rc-addr",
+                    f"{cls._rc_host}:{cls._rc_port}",
+                    "--rc-user",
+                    user,
+                ],
+                env={
+                    **os.environ,
+                    "RCLONE_RC_PASS": password,
+                },  # Kept off the command line, which other local users can read
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+        else:
+            split_url = urlsplit(rc_url)
+            cls._rc_host = split_url.hostname
+            cls._rc_port = split_url.port or 80
+            user = split_url.username
+            password = split_url.password
+        if user is not None:
+            cls._rc_headers["Authorization"] = "Basic " + b64encode(
+                f"{user}:{password or ''}".encode("utf-8")
+            ).decode("ascii")
+        cls.wait_for_rcd()
+
+    @staticmethod
+    def get_free_port() -> int:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as port_socket:
+            port_socket.bind(("127.0.0.1", 0))
+            return port_socket.getsockname()[1]
+
+    @classmethod
+    def wait_for_rcd(cls) -> None:
+        start = time()
+        while True:
+            try:
+                cls.call("rc/noop", {})
+                return
+            except (OSError, http.client.HTTPException) as error:
+                if cls._rcd_proc is not None and cls._rcd_proc.poll() is not None:
+                    raise RCloneRCError(
+                        "rcd",
+                        cls._rcd_proc.returncode,
+                        "",
+                        str(error),
+                        message=f"rclone rcd exited before accepting requests. Return code was {cls._rcd_proc.returncode}",
+                    ) from error
+                if time() - start > RCD_STARTUP_TIMEOUT_SECONDS:
+                    raise
+                sleep(0.1)
+
+    @classmethod
+    def stop_daemon(cls) -> None:
+        if cls._connections is not None:
+            while True:
+                try:
+                    cls._connections.get_nowait().close()
+                except Empty:
+                    break
+        if cls._rcd_proc is not None:
+            cls._rcd_proc.terminate()
+            try:
+                cls._rcd_proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                cls._rcd_proc.kill()
+                cls._rcd_proc.wait()
+            cls._rcd_proc = None
+
+    @classmethod
+    def call(cls, command: str, params: dict[str, Any]) -> dict[str, Any]:
+        body = json.dumps(params)
+        try:
+            connection = cls._connections.get_nowait()
+        except Empty:
+            connection = http.client.HTTPConnection(cls._rc_host, cls._rc_port)
+        try:
+            try:
+                connection.request("POST", f"/{command}", body, cls._rc_headers)
+                response = connection.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError):
+                # The server closed an idle keep-alive connection, so retry once on a fresh one
+                connection.close()
+                connection.request("POST", f"/{command}", body, cls._rc_headers)
+                response = connection.getresponse()
+            response_body = response.read()
+        except Exception:
+            connection.close()
+            raise
+        cls._connections.put(connection)
+        try:
+            result = json.loads(response_body) if len(response_body) > 0 else {}
+        except ValueError:
+            result = {"error": response_body.decode("utf-8", "backslashreplace")}
+        if response.status != 200:
+            error = safe_str(result.get("error", result))
+            error_class = (
+                RCloneRCTemporaryError
+                if response.status == 429
+                or response.status >= 500
+                or any(
+                    message in error.lower() for message in _TEMPORARY_ERROR_MESSAGES
+                )
+                else RCloneRCError
+            )
+            raise error_class(f"rc {command} {body}", response.status, "", error)
+        return result
+
+    @classmethod
+    def get_stats(cls) -> dict[str, Any]:
+        return cls.call("core/stats", {})
+
+    @classmethod
+    def get_stats_summary(cls) -> str:
+        stats = cls.get_stats()
+        mebibyte = 1024 * 1024
+        return (
+            f"Transfers: {stats.get('transfers', 0)} done, {len(stats.get('transferring') or [])} active, "
+            f"{stats.get('bytes', 0) / mebibyte:.1f} MiB at {stats.get('speed', 0) / mebibyte:.1f} MiB/s, "
+            f"{stats.get('errors', 0)} errors"
+        )
+
+    @staticmethod
+    def format_modtime(modtime: str) -> str:
+        # Matches the local time format of rclone lsf so stored modtimes compare equal across backends
+        if "." in modtime:
+            seconds, fraction = modtime.split(".", 1)
+            modtime = seconds + fraction.lstrip("0123456789")
+        return (
+            datetime.fromisoformat(modtime.replace("Z", "+00:00"))
+            .astimezone()
+            .strftime("%Y-%m-%d %H:%M:%S")
+        )
+
+    def get_source_fs(self, source_name: str) -> str:
+        return f'{self._sources[source_name]["remote_name"]}:{self._sources[source_name]["remote_path"]}'
+
+    def iter_list_items(
+        self, opt: dict[str, Any], max_age: str | None = None
+    ) -> Iterator[dict[str, Any]]:
+        context = self.get_context()
+        if context.source_name is None:
+            raise InvalidContextError(
+                context.source_name,
+                context.file_path,
+                "Source name is not set in the context",
+            )
+        params = {
+            "fs": self.get_source_fs(context.source_name),
+            "remote": "",
+            "opt": {"recurse": True, "filesOnly": True, **opt},
+        }
+        if max_age is not None:
+            params["_filter"] = {"MaxAge": max_age}
+        yield from self.call("operations/list", params)["list"]
+
+    def iter_file_info(self) -> Iterator[tuple[str, str, str, str]]:
+        self.raise_exception_if_class_not_configured()
+        for item in self.iter_list_items({"showHash": True, "hashTypes": ["md5"]}):
+            yield (
+                item["Path"],
+                str(item["Size"]),
+                (item.get("Hashes") or {}).get("md5", ""),
+                self.format_modtime(item["ModTime"]),
+            )
+
+    def iter_changed_file_info(
+        self,
+        is_unchanged: Callable[[str, str, str], bool],
+        max_age: str | None = None,
+    ) -> Iterator[tuple[str, str, str, str]]:
+        # Hashes of changed files are fetched one at a time, which is cheap over a kept-alive connection
+        self.raise_exception_if_class_not_configured()
+        for item in self.iter_list_items({}, max_age):
+            file_size = str(item["Size"])
+            file_modtime = self.format_modtime(item["ModTime"])
+            if is_unchanged(item["Path"], file_size, file_modtime):
+                continue
+            stat_item = self.call(
+                "operations/stat",
+                {
+                    "fs": self.get_source_fs(self.get_context_source_name()),
+                    "remote": item["Path"],
+                    "opt": {"showHash": True, "hashTypes": ["md5"]},
+                },
+            ).get("item")
+            if stat_item is not None:
+                yield (
+                    item["Path"],
+                    file_size,
+                    (stat_item.get("Hashes") or {}).get("md5", ""),
+                    file_modtime,
+                )
+
+    def copy_file(self, source_name: str, file_path: Path) -> None:
+        self.call(
+            "operations/copyfile",
+            {
+                "srcFs": self.get_source_fs(source_name),
+                "srcRemote": file_path.as_posix(),
+                "dstFs": str(self._destination_root_dir / source_name),
+                "dstRemote": file_path.as_posix(),
+            },
+        )
+
+    def download(self) -> None:
+        self.raise_exception_if_class_not_configured()
+        self.raise_exception_if_context_not_set()
+        context = self.get_context()
+        self.copy_file(context.source_name, context.file_path)
+
+    def download_batch(
+        self,
+        file_paths: list[Path],
+        transfers: int | None = None,
+        checkers: int | None = None,
+    ) -> dict[Path, Exception | None]:
+        # Up to transfers files are copied at a time, each with its own request. The daemon has no use for checkers
+        self.raise_exception_if_class_not_configured()
+        source_name = self.get_context_source_name()
+
+        def copy_file_or_error(file_path: Path) -> Exception | None:
+            try:
+                self.copy_file(source_name, file_path)
+            except Exception as error:
+                return error
+            return None
+
+        with ThreadPoolExecutor(max_workers=transfers or 1) as copy_pool:
+            return dict(zip(file_paths, copy_pool.map(copy_file_or_error, file_paths)))
+
+
+class RCloneRCError(RCloneError):
+    """
+    Exception raised for errors returned by the rclone rc API. The return code is the HTTP status.
+
+    See RCloneError for more information.
+    """
+
+    def get_default_message(self, rc: int) -> str:
+        return f"An error occured during the rclone rc call. HTTP status was {rc}"
+
+
+class RCloneRCTemporaryError(RCloneRCError, RCloneTemporaryError):
+    """
+    Exception raised for errors returned by the rclone rc API that are worth retrying, such as rate limiting. The
+    return code is the HTTP status.
+
+    See RCloneError for more information.
+    """
+
+    def get_default_message(self, rc: int) -> str:
+        return (
+            f"A temporary error occured during the rclone rc call. HTTP status was {rc}"
+        )
@@ -0,0 +1,77 @@
+from .helpers import *
+
+from collections.abc import Hashable
+from time import monotonic
+
+import dataclasses
+import heapq
+import random
+
+
+@dataclasses.dataclass
+class RetryPolicy:
+    max_retries_per_file: int
+    # Retries allowed for all files of a remote in a run, so a remote that keeps failing is not retried indefinitely
+    retry_budget: int
+    base_delay_seconds: float
+    max_delay_seconds: float
+
+
+class RetryScheduler:
+    """Delayed retries for tasks that failed with a temporary error
+
+    Retries are kept in a heap ordered by due time rather than sleeping in a worker thread, so the caller polls
+    pop_due and submits them again itself. The delay doubles with each attempt up to the policy's maximum, and half
+    of it is random jitter so that files throttled together are not retried together. Not thread safe, as retries
+    are only scheduled and collected by the main thread.
+    """
+
+    def __init__(self, policies_per_remote: dict[str, RetryPolicy]) -> None:
+        self._policies_per_remote = policies_per_remote
+        self._remaining_budgets = {
+            remote_name: policy.retry_budget
+            for remote_name, policy in policies_per_remote.items()
+        }
+        self._attempts = dict[Hashable, int]()
+        self._due_retries = list[tuple[float, int, Hashable]]()
+        self._sequence = 0  # Breaks ties between retries due at the same time
+
+    def __len__(self) -> int:
+        return len(self._due_retries)
+
+    def get_attempts(self, key: Hashable) -> int:
+        return self._attempts.get(key, 0)
+
+    def schedule(self, remote_name: str, key: Hashable) -> float | None:
+        # Returns the delay in seconds before the retry is due, or None if the file or its remote is out of retries
+        policy = self._policies_per_remote.get(remote_name)
+        attempts = self.get_attempts(key)
+        if (
+            policy is None
+            or attempts >= policy.max_retries_per_file
+            or self._remaining_budgets[remote_name] <= 0
+        ):
+            return None
+        self._remaining_budgets[remote_name] -= 1
+        self._attempts[key] = attempts + 1
+        backoff_seconds = min(
+            policy.max_delay_seconds, policy.base_delay_seconds * 2**attempts
+        )
+        delay_seconds = backoff_seconds / 2 + random.uniform(0, backoff_seconds / 2)
+        heapq.heappush(
+            self._due_retries, (monotonic() + delay_seconds, self._sequence, key)
+        )
+        self._sequence += 1
+        return delay_seconds
+
+    def pop_due(self) -> list[Hashable]:
+        now = monotonic()
+        due_keys = list[Hashable]()
+        while len(self._due_retries) > 0 and self._due_retries[0][0] <= now:
+            due_keys.append(heapq.heappop(self._due_retries)[2])
+        return due_keys
+
+    def get_seconds_until_next_due(self) -> float | None:
+        if len(self._due_retries) == 0:
+            return None
+        return max(self._due_retries[0][0] - monotonic(), 0.0)
@@ -1,19 +1,32 @@
 from .helpers import *
 from .contextual_subprocess import ContextualSubprocess, SubprocessError
+from .file_signature import SignatureMatch, sniff_file
 
 from pathlib import Path
 from subprocess import CompletedProcess  # For type hinting
 
+import tempfile
+
+# Printed by 7-Zip when extracting a file it does not recognise, depending on its version
+_NOT_ARCHIVE_MESSAGES: tuple[str, ...] = (
+    "can not open the file as archive",
+    "cannot open the file as archive",
+)
+
 
 class SevenZip(ContextualSubprocess):
+    _test_before_extract: bool = True
+
     @classmethod
     def configure(
         cls,
         context_pool_names: set[str],
         sevenzip_path: Path,
         destination_root_dir: Path,
+        test_before_extract: bool = True,
     ) -> None:
         cls.raise_exception_if_class_configured()
+        cls._test_before_extract = test_before_extract
         super().configure(context_pool_names, sevenzip_path, destination_root_dir)
 
     def raise_exception_if_proc_failed(self, proc: CompletedProcess) -> None:
@@ -23,26 +36,102 @@ class SevenZip(ContextualSubprocess):
         else:
             raise SevenZipError(cmd_string, proc.returncode, proc.stdout, proc.stderr)
 
-    def extract(self) -> None:
+    def extract(self, member_paths: list[Path] | None = None) -> None:
         self.raise_exception_if_class_not_configured()
         self.raise_exception_if_context_not_set()
+        # Only the given members are extracted if member_paths is set, matched literally through an include list
         cmd_args = [
             "x",
             "-bd",
             "-aoa",
             f"-o{str(self.get_extract_root_dir())}",
-            str(self.get_destination_path()),
         ]
-        extract_proc = self.run_subprocess(cmd_args)
+        include_file_path = None
+        if member_paths is not None:
+            with tempfile.NamedTemporaryFile(
+                mode="w", encoding="utf-8", suffix=".txt", delete=False
+            ) as include_file:
+                include_file.write(
+                    "\n".join(str(member_path) for member_path in member_paths) + "\n"
+                )
+            include_file_path = Path(include_file.name)
+            cmd_args += ["-scsUTF-8", "-spd", f"-i@{include_file_path}"]
+        cmd_args.append(str(self.get_destination_path()))
+        try:
+            extract_proc = self.run_subprocess(cmd_args)
+        finally:
+            if include_file_path is not None:
+                include_file_path.unlink(missing_ok=True)
+        if extract_proc.returncode != 0 and any(
+            message in f"{extract_proc.stdout}\n{extract_proc.stderr}".lower()
+            for message in _NOT_ARCHIVE_MESSAGES
+        ):
+            try:
+                self.get_extract_root_dir().rmdir()  # Only removed if 7-Zip left it empty
+            except OSError:
+                pass
+            raise SevenZipNotArchiveError(
+                " ".join(map(str, extract_proc.args)),
+                extract_proc.returncode,
+                extract_proc.stdout,
+                extract_proc.stderr,
+            )
         self.raise_exception_if_proc_failed(extract_proc)
 
     def is_archive_file(self) -> bool:
         self.raise_exception_if_class_not_configured()
         self.raise_exception_if_context_not_set()
+        # Only files without a recognised signature are fully tested by 7-Zip. Without test_before_extract they are
+        # assumed to be archives instead, and extract raises SevenZipNotArchiveError for those that are not
+        signature_match, _ = sniff_file(self.get_destination_path())
+        if signature_match != SignatureMatch.AMBIGUOUS:
+            return signature_match == SignatureMatch.ARCHIVE
+        if not self._test_before_extract:
+            return True
         cmd_args = ["t", "-bd", "-p", str(self.get_destination_path())]
         test_proc = self.run_subprocess(cmd_args)
         return test_proc.returncode == 0
 
+    def get_member_info(self) -> dict[Path, tuple[int, str]]:
+        self.raise_exception_if_class_not_configured()
+        self.raise_exception_if_context_not_set()
+        # Size and CRC of each file in the archive as listed by 7-Zip, keyed by its path in the archive. Formats
+        # without CRCs, such as tar, use the modified time instead. Compressed single files such as .tar.gz list the
+        # file they hold. Empty if 7-Zip cannot list the file
+        cmd_args = ["l", "-slt", "-bd", "-p", str(self.get_destination_path())]
+        list_proc = self.run_subprocess(cmd_args)
+        if list_proc.returncode != 0:
+            return dict[Path, tuple[int, str]]()
+        member_info = dict[Path, tuple[int, str]]()
+        # Properties above the separator describe the archive itself, below it each member is a block of lines
+        member_lines = list_proc.stdout.partition("\n----------\n")[2]
+        for member_block in member_lines.split("\n\n"):
+            properties = dict[str, str]()
+            for line in member_block.splitlines():
+                key, separator, value = line.partition(" = ")
+                if separator != "":
+                    properties[key] = value
+            if (
+                "Path" not in properties
+                or properties.get("Folder") == "+"
+                or properties.get("Attributes", "").startswith("D")
+            ):
+                continue
+            try:
+                member_size = int(properties.get("Size", ""))
+            except ValueError:
+                member_size = 0  # Left blank by some formats
+            member_info[Path(properties["Path"])] = (
+                member_size,
+                properties.get("CRC") or f'modified:{properties.get("Modified", "")}',
+            )
+        return member_info
+
+    def delete_archive(self) -> None:
+        self.raise_exception_if_class_not_configured()
+        self.raise_exception_if_context_not_set()
+        self.get_destination_path().unlink(missing_ok=True)
+
     def get_extract_root_dir(self) -> Path:
         self.raise_exception_if_class_not_configured()
         self.raise_exception_if_context_not_set()
@@ -56,3 +145,14 @@ class SevenZipError(SubprocessError):
 
     def get_default_message(self, rc: int) -> str:
         return f"An error occured during the 7zip operation. Return code was {rc}"
+
+
+class SevenZipNotArchiveError(SevenZipError):
+    """
+    Exception raised when 7zip cannot open a file it was asked to extract as an archive.
+
+    See SevenZipError for more information.
+    """
+
+    def get_default_message(self, rc: int) -> str:
+        return f"7zip could not open the file as an archive. Return code was {rc}"
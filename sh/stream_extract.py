@@ -0,0 +1,82 @@
+from .helpers import *
+
+from datetime import datetime
+from pathlib import Path
+from typing import IO
+
+import tarfile
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# File name suffixes of archives that can be extracted while they are read, and their tarfile compression
+_STREAMABLE_SUFFIXES: dict[str, str] = {
+    ".tar": "",
+    ".tar.gz": "gz",
+    ".tgz": "gz",
+    ".tar.bz2": "bz2",
+    ".tbz2": "bz2",
+    ".tar.xz": "xz",
+    ".txz": "xz",
+    ".tar.zst": "zst",
+    ".tzst": "zst",
+}
+
+
+def get_stream_compression(file_path: Path) -> str | None:
+    # Returns None for files that cannot be extracted from a stream, including .tar.zst without zstandard installed
+    file_name = file_path.name.lower()
+    for suffix, compression in _STREAMABLE_SUFFIXES.items():
+        if file_name.endswith(suffix):
+            if compression == "zst" and zstandard is None:
+                return None
+            return compression
+    return None
+
+
+def extract_tar_stream(
+    stream: IO[bytes], compression: str, extract_dir: Path
+) -> dict[Path, tuple[int, str]]:
+    # Returns the size and modification time of each extracted file by its path within the archive, in the format
+    # of SevenZip.get_member_info. Raises StreamNotArchiveError if the stream does not start like the expected
+    # archive, before anything is written
+    if compression == "zst":
+        stream = zstandard.ZstdDecompressor().stream_reader(stream)
+        compression = ""
+    try:
+        tar_stream = tarfile.open(fileobj=stream, mode=f"r|{compression}")
+    except (tarfile.ReadError, tarfile.CompressionError) as error:
+        raise StreamNotArchiveError(compression, str(error)) from error
+    with tar_stream:
+        extract_dir.mkdir(parents=True, exist_ok=True)
+        member_info = dict[Path, tuple[int, str]]()
+        for member in tar_stream:
+            # Members are read in order, as a stream cannot seek back to them
+            filtered_member = tarfile.data_filter(member, str(extract_dir))
+            tar_stream.extract(filtered_member, extract_dir, filter="fully_trusted")
+            if filtered_member.isfile():
+                member_info[Path(filtered_member.name)] = (
+                    filtered_member.size,
+                    f"modified:{datetime.fromtimestamp(filtered_member.mtime):%Y-%m-%d %H:%M:%S}",
+                )
+        return member_info
+
+
+class StreamNotArchiveError(Exception):
+    """Exception raised when a stream expected to hold an archive does not
+
+    Attributes:
+        compression -- the compression the stream was expected to use
+        message     -- explanation of the error
+    """
+
+    def __init__(self, compression: str, message: str | None = None) -> None:
+        self.compression = compression
+        if message is None:
+            message = (
+                f"Stream is not a tar archive with compression: {safe_str(compression)}"
+            )
+
+        super().__init__(message)
@@ -0,0 +1,123 @@
+from sh.concurrency import AdaptiveLimiter
+
+from collections.abc import Callable
+
+import unittest
+
+MEBIBYTE: int = 1024 * 1024
+
+
+class SimulatedClock:
+    def __init__(self) -> None:
+        self.time = 0.0
+
+    def __call__(self) -> float:
+        return self.time
+
+
+def run_windows(
+    limiter: AdaptiveLimiter,
+    clock: SimulatedClock,
+    window_sizes: list[int],
+    get_task_seconds: Callable[[int, int], float],
+    temporary_error_windows: set[int] = set(),
+) -> None:
+    # Runs one window of as many tasks as the limit for each entry of window_sizes, with all tasks of a window
+    # started together and each taking get_task_seconds(limit, transfer_bytes)
+    for window_index, transfer_bytes in enumerate(window_sizes):
+        limit = limiter.get_limit()
+        start_time = clock.time
+        slots = [limiter.slot(transfer_bytes) for _ in range(limit)]
+        slot_outcomes = [slot.__enter__() for slot in slots]
+        slot_outcomes[0].temporary_error = window_index in temporary_error_windows
+        for slot in slots:
+            clock.time = start_time + get_task_seconds(limit, transfer_bytes)
+            slot.__exit__(None, None, None)
+
+
+class AdaptiveLimiterTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.clock = SimulatedClock()
+        self.limit_changes = list[tuple[int, int, str]]()
+        self.limiter = AdaptiveLimiter(
+            "remote",
+            1,
+            16,
+            1,
+            lambda name, previous_limit, limit, reason: self.limit_changes.append(
+                (previous_limit, limit, reason)
+            ),
+            self.clock,
+        )
+
+    def test_bandwidth_bound_remote_does_not_flap(self) -> None:
+        # Tasks share 100 MiB/s, so each takes longer as more run at once
+        run_windows(
+            self.limiter,
+            self.clock,
+            [64 * MEBIBYTE] * 40,
+            lambda limit, transfer_bytes: transfer_bytes * limit / (100 * MEBIBYTE),
+        )
+        self.assertEqual(self.limit_changes, [(1, 2, "probing for more throughput")])
+
+    def test_latency_bound_remote_reaches_max_limit(self) -> None:
+        # Each task takes a second however many run at once
+        run_windows(
+            self.limiter,
+            self.clock,
+            [MEBIBYTE] * 40,
+            lambda limit, transfer_bytes: 1.0,
+        )
+        self.assertEqual(self.limiter.get_limit(), 16)
+        self.assertTrue(
+            all(
+                limit > previous_limit
+                for previous_limit, limit, _ in self.limit_changes
+            )
+        )
+
+    def test_largest_first_sizes_cut_limit_at_most_once(self) -> None:
+        # Large files first and small files last, with a fixed overhead per task on a bandwidth-bound remote. The
+        # small files are bound by the overhead instead, so the limit may rise again once they start
+        run_windows(
+            self.limiter,
+            self.clock,
+            [1024 * MEBIBYTE] * 20 + [MEBIBYTE] * 20,
+            lambda limit, transfer_bytes: 0.5
+            + transfer_bytes * limit / (100 * MEBIBYTE),
+        )
+        self.assertLessEqual(
+            len(
+                [
+                    limit
+                    for previous_limit, limit, _ in self.limit_changes
+                    if limit < previous_limit
+                ]
+            ),
+            1,
+        )
+
+    def test_temporary_error_halves_limit_without_raising_right_after(self) -> None:
+        run_windows(
+            self.limiter,
+            self.clock,
+            [MEBIBYTE] * 20,
+            lambda limit, transfer_bytes: 1.0,
+        )
+        limit_before_error = self.limiter.get_limit()
+        self.limit_changes.clear()
+        run_windows(
+            self.limiter,
+            self.clock,
+            [MEBIBYTE] * 2,
+            lambda limit, transfer_bytes: 1.0,
+            {0},
+        )
+        self.assertEqual(
+            self.limit_changes,
+            [(limit_before_error, limit_before_error // 2, "temporary error")],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()